@@ -0,0 +1,385 @@
+"""
+analytics.py
+
+Description: An optional NumPy engine for the aggregation queries 4-7.
+The integer columns those queries group by are read out of the database
+once and saved as .npy files in a directory next to it (movies.db.columns
+for movies.db).  Later runs memory-map the files instead of reading
+SQLite.  The files are rebuilt when the database file changes.
+
+  pairMovie, pairActor, pairRoles   Casts grouped by (movieID, actorID),
+                                    with the number of roles, sorted by
+                                    movie so a movie's cast is one range
+  directsDirector, directsMovie     DirectsMovie rows whose movie exists
+  yearByMovie                       each movie's year, indexed by movie id
+                                    (0 if unknown)
+
+The queries are answered with bincount, searchsorted and sort-based
+group-bys over these arrays.  Names and titles are read from SQLite only
+for the rows that are returned.  Rows that tie on the ordering columns
+are returned in id order, which the SQL versions leave unspecified.
+
+NumPy is only needed by this module: without it, queryDB.py runs the SQL
+versions of the queries.
+
+Usage: python3 analytics.py databaseName [--query N] [--repeat N]
+  (re)builds the column files and times queries 4-7 (or query N)
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+try:
+  import numpy
+except ImportError:   # the engine is optional; queryDB.py falls back to SQL
+  numpy = None
+
+import querycache
+
+# Bumped when the files change shape, so old directories are rebuilt
+FORMAT = 1
+
+# Rows fetched from SQLite at a time while reading the columns
+FETCH_SIZE = 100000
+
+# The names of the column files
+COLUMNS = ["pairMovie", "pairActor", "pairRoles", "directsDirector",
+           "directsMovie", "yearByMovie"]
+
+# The thresholds of queries 4-7, as written in their SQL, and the default
+# year of query 6
+MIN_DIRECTED = 500
+MIN_SHARED = 8
+ROLES_YEAR = 2010
+MIN_ROLES = 5
+TOP_ACTORS = 10
+
+# Result columns of each query, as the SQL versions name them
+QUERY_COLUMNS = {
+  4: ["fname", "lname", "FilmCount"],
+  5: ["fname", "lname", "NumFilms"],
+  6: ["fname", "lname", "title", "NumRoles"],
+  7: ["fname", "lname", "TotalMovie"],
+}
+
+def columnDir(filename):
+  """
+  @param filename - the database file
+  @return the directory its column files are kept in
+  """
+  return filename + ".columns"
+
+def readColumns(db, sql, ncols):
+  """
+  Reads integer columns from SQLite into arrays
+  @param db - the database connection
+  @param sql - a query selecting ncols integer columns
+  @param ncols - the number of columns
+  @return a list of ncols int64 arrays
+  """
+  cursor = db.execute(sql)
+  parts = []
+  while True:
+    batch = cursor.fetchmany(FETCH_SIZE)
+    if not batch:
+      break
+    parts.append(numpy.array(batch, dtype=numpy.int64).reshape(-1, ncols))
+  table = numpy.concatenate(parts) if parts else numpy.zeros((0, ncols), numpy.int64)
+  return [table[:, i] for i in range(ncols)]
+
+def buildColumns(db, directory):
+  """
+  Reads the columns of the aggregation queries and saves them as .npy files
+  @param db - the database connection
+  @param directory - the directory to write (replaced if it exists)
+  @return a dict mapping each column name to its array
+  """
+  movie, actor = readColumns(db, "SELECT movieID, actorID FROM Casts", 2)
+  # group by (movieID, actorID): sort the combined key and count the runs
+  keys, roles = numpy.unique((movie << 32) | actor, return_counts=True)
+  columns = {
+    "pairMovie": (keys >> 32).astype(numpy.int32),
+    "pairActor": (keys & 0xFFFFFFFF).astype(numpy.int32),
+    "pairRoles": roles.astype(numpy.int32),
+  }
+
+  director, directed = readColumns(db, """
+      SELECT DM.directorID, DM.movieID
+      FROM DirectsMovie AS DM
+      JOIN Movie AS M ON DM.movieID = M.id""", 2)
+  columns["directsDirector"] = director.astype(numpy.int32)
+  columns["directsMovie"] = directed.astype(numpy.int32)
+
+  ids, years = readColumns(db, """
+      SELECT id, year FROM Movie WHERE typeof(year) = 'integer'""", 2)
+  yearByMovie = numpy.zeros(int(ids.max()) + 1 if len(ids) else 1, numpy.int32)
+  yearByMovie[ids] = years
+  columns["yearByMovie"] = yearByMovie
+
+  # write to a scratch directory and rename it, so readers never see a
+  # half-written set of files
+  scratch = directory + ".tmp"
+  shutil.rmtree(scratch, ignore_errors=True)
+  os.makedirs(scratch)
+  for name in COLUMNS:
+    numpy.save(os.path.join(scratch, name + ".npy"), columns[name])
+  shutil.rmtree(directory, ignore_errors=True)
+  os.replace(scratch, directory)
+  return columns
+
+def rangeIndex(starts, ends):
+  """
+  @param starts - array of range starts
+  @param ends - array of range ends (exclusive), one per start
+  @return an array of every index in the ranges, in order
+  """
+  lengths = ends - starts
+  total = int(lengths.sum())
+  if total == 0:
+    return numpy.zeros(0, numpy.int64)
+  # each index is its range's start plus its position in the range
+  offsets = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+  return offsets + numpy.arange(total)
+
+def topOrder(counts, ids):
+  """
+  @param counts - array of counts
+  @param ids - array of the ids they belong to
+  @return the positions of the arrays, by count descending then id
+  """
+  return numpy.lexsort((ids, -counts))
+
+class Analytics:
+  """
+  Answers queries 4-7 from memory-mapped column files of one database
+  """
+
+  def __init__(self, filename, rebuild=False):
+    """
+    Opens the column files of a database, building them first if they
+    are missing, stale or rebuild is set
+    @param filename - the database file
+    @param rebuild - rebuild the files even if they are current
+    @raise RuntimeError if NumPy is not installed
+    """
+    if numpy is None:
+      raise RuntimeError("the analytics engine requires the numpy package")
+    self.filename = filename
+    self.directory = columnDir(filename)
+    self.db = sqlite3.connect("file:%s?mode=ro" % filename, uri=True,
+                              check_same_thread=False)
+    self.built = False
+    version = list(querycache.fileVersion(filename))
+    meta = {"format": FORMAT, "version": version}
+    metaFile = os.path.join(self.directory, "meta.json")
+    try:
+      with open(metaFile) as f:
+        current = json.load(f) == meta
+    except (OSError, ValueError):
+      current = False
+
+    if rebuild or not current:
+      buildColumns(self.db, self.directory)
+      with open(metaFile, "w") as f:
+        json.dump(meta, f)
+      self.built = True
+    self.columns = {name: numpy.load(os.path.join(self.directory, name + ".npy"),
+                                     mmap_mode="r")
+                    for name in COLUMNS}
+
+  def close(self):
+    self.db.close()
+
+  def names(self, table, ids):
+    """
+    @param table - "Actor" or "Director"
+    @param ids - the ids to look up
+    @return a dict mapping each id that exists to its (fname, lname)
+    """
+    ids = [int(i) for i in ids]
+    if not ids:
+      return {}
+    rows = self.db.execute(
+        "SELECT id, fname, lname FROM %s WHERE id IN (SELECT value FROM json_each(?))"
+        % table, (json.dumps(ids),))
+    return {row[0]: row[1:] for row in rows}
+
+  def titles(self, ids):
+    """
+    @param ids - the movie ids to look up
+    @return a dict mapping each id that exists to its title
+    """
+    rows = self.db.execute(
+        "SELECT id, title FROM Movie WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps([int(i) for i in ids]),))
+    return dict(rows)
+
+  def castRange(self, movies):
+    """
+    @param movies - a sorted array of movie ids
+    @return the positions of the (movie, actor) pairs of those movies
+    """
+    pairMovie = self.columns["pairMovie"]
+    return rangeIndex(numpy.searchsorted(pairMovie, movies, "left"),
+                      numpy.searchsorted(pairMovie, movies, "right"))
+
+  def directors(self, minFilms=MIN_DIRECTED):
+    """
+    Query 4: the directors of minFilms movies or more, most first
+    @return a list of (fname, lname, FilmCount)
+    """
+    counts = numpy.bincount(self.columns["directsDirector"])
+    ids = numpy.flatnonzero(counts >= minFilms)
+    ids = ids[topOrder(counts[ids], ids)]
+    names = self.names("Director", ids)
+    rows = []
+    seen = set()     # the SQL selects DISTINCT rows
+    for i in ids:
+      if int(i) in names:
+        row = names[int(i)] + (int(counts[i]),)
+        if row not in seen:
+          seen.add(row)
+          rows.append(row)
+    return rows
+
+  def favoriteCoStars(self, fname="Kevin", lname="Bacon", minFilms=MIN_SHARED):
+    """
+    Query 5: the actors who share minFilms movies or more with an actor,
+    most first
+    @return a list of (fname, lname, NumFilms)
+    """
+    actorIDs = [row[0] for row in self.db.execute(
+        "SELECT id FROM Actor WHERE fname = ? AND lname = ? ORDER BY id", (fname, lname))]
+    if not actorIDs:
+      return []
+    pairActor = self.columns["pairActor"]
+    mine = numpy.isin(pairActor, actorIDs)
+    movies = numpy.unique(self.columns["pairMovie"][mine])
+    costars = pairActor[self.castRange(movies)]
+    costars = costars[costars != actorIDs[0]]
+    # each pair is one movie, so counting pairs counts distinct movies
+    ids, counts = numpy.unique(costars, return_counts=True)
+    keep = counts >= minFilms
+    ids, counts = ids[keep], counts[keep]
+    order = topOrder(counts, ids)
+    names = self.names("Actor", ids)
+    return [names[int(i)] + (int(c),) for i, c in zip(ids[order], counts[order])
+            if int(i) in names]
+
+  def versatile(self, year=ROLES_YEAR, minRoles=MIN_ROLES):
+    """
+    Query 6: the actors who played minRoles roles or more in one movie of
+    the year
+    @return a list of (fname, lname, title, NumRoles)
+    """
+    movies = numpy.flatnonzero(numpy.asarray(self.columns["yearByMovie"]) == year)
+    pairs = self.castRange(movies)
+    pairs = pairs[self.columns["pairRoles"][pairs] >= minRoles]
+    actors = self.columns["pairActor"][pairs]
+    movieIDs = self.columns["pairMovie"][pairs]
+    roles = self.columns["pairRoles"][pairs]
+    names = self.names("Actor", numpy.unique(actors))
+    titles = self.titles(numpy.unique(movieIDs))
+    rows = [names[int(a)] + (titles[int(m)], int(r))
+            for a, m, r in zip(actors, movieIDs, roles)
+            if int(a) in names and int(m) in titles]
+    rows.sort(key=lambda row: (-row[3], row[2], row[0], row[1]))
+    return rows
+
+  def topActors(self, limit=TOP_ACTORS):
+    """
+    Query 7: the limit actors in the most movies
+    @return a list of (fname, lname, TotalMovie)
+    """
+    counts = numpy.bincount(self.columns["pairActor"])
+    want = limit
+    while True:
+      # the want largest counts, then every id tied with the smallest of them
+      k = min(want, len(counts))
+      if k == 0:
+        return []
+      cutoff = numpy.partition(counts, len(counts) - k)[len(counts) - k]
+      ids = numpy.flatnonzero(counts >= max(cutoff, 1))
+      ids = ids[topOrder(counts[ids], ids)]
+      names = self.names("Actor", ids)
+      rows = [names[int(i)] + (int(counts[i]),) for i in ids if int(i) in names]
+      # ids without an Actor row are dropped, as the SQL join drops them
+      if len(rows) >= limit or k == len(counts):
+        return rows[:limit]
+      want *= 2
+
+  def answers(self, number):
+    """
+    @param number - a query number
+    @return True if the engine answers the query
+    """
+    return number in QUERY_COLUMNS
+
+  def query(self, number, params=()):
+    """
+    @param number - the query number, 4 to 7
+    @param params - the parameters of query 5 (fname, lname) or 6 (year),
+      as queryregistry binds them; by default Kevin Bacon and 2010
+    @return (column names, rows) of the query
+    """
+    if number == 4:
+      rows = self.directors()
+    elif number == 5:
+      rows = self.favoriteCoStars(*params)
+    elif number == 6:
+      rows = self.versatile(*params)
+    elif number == 7:
+      rows = self.topActors()
+    else:
+      raise ValueError("the analytics engine answers queries 4-7, not %r" % number)
+    return QUERY_COLUMNS[number], rows
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="analytics.py",
+      description="Builds the NumPy column files of a database and times "
+                  "queries 4-7 on them")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("--query", type=int, choices=sorted(QUERY_COLUMNS),
+      help="only run this query")
+  parser.add_argument("--repeat", type=int, default=5,
+      help="runs per query; the fastest is reported (default %(default)s)")
+  return parser.parse_args(argv)
+
+def main():
+  args = parseArgs(sys.argv[1:])
+  if not os.path.exists(args.filename):
+    print("Error: file does not exist")
+    return 1
+  if numpy is None:
+    print("Error: the analytics engine requires numpy (pip install numpy)")
+    return 1
+
+  print("...Building Column Files...")
+  start = time.time()
+  engine = Analytics(args.filename, rebuild=True)
+  print("  built %s in %.2f seconds" % (engine.directory, time.time() - start))
+
+  for number in [args.query] if args.query else sorted(QUERY_COLUMNS):
+    best = None
+    for i in range(max(1, args.repeat)):
+      start = time.perf_counter()
+      columns, rows = engine.query(number)
+      elapsed = time.perf_counter() - start
+      best = elapsed if best is None else min(best, elapsed)
+    print("  query%d %6d rows in %.4f seconds" % (number, len(rows), best))
+  engine.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
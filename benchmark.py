@@ -0,0 +1,350 @@
+"""
+benchmark.py
+
+Description: A reproducible benchmark of the database build and the menu
+queries.  The runner builds a database from a directory of source files
+(or from synthetic files it generates with gendata.py).  It times each
+createdb phase: creating the tables, inserting each table, building the
+indexes, and building the summary and name search tables.  It then runs
+each query many times and reports p50/p95/p99 latencies; with --analytics
+it also times queries 4-7 on the NumPy engine of analytics.py.  The
+results are written as JSON, and --compare checks them against an earlier
+run.
+
+Usage: python3 benchmark.py [--data-dir DIR | --casts N] [--iterations N]
+                            [--analytics] [--output FILE]
+                            [--compare BASELINE.json]
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import analytics
+import costar
+import filmography
+import createdb
+import gendata
+import queryDB
+import queryregistry
+import search
+import sources
+import summaries
+
+# Query runs timed per query, after the untimed warm-up runs
+ITERATIONS = 20
+WARMUP = 2
+
+# A timing counts as a regression in --compare when it grows by more than
+# this fraction and by more than this many seconds (so sub-millisecond
+# noise is not reported)
+REGRESSION = 0.10
+REGRESSION_SECONDS = 0.001
+
+def percentile(ordered, p):
+  """
+  @param ordered - a sorted, non-empty list of numbers
+  @param p - the percentile, from 0 to 100
+  @return the nearest-rank percentile of the list
+  """
+  rank = max(1, -(-len(ordered) * p // 100))
+  return ordered[int(rank) - 1]
+
+def summarize(times):
+  """
+  @param times - a list of durations in seconds
+  @return a dict of their count, mean, min, max and p50/p95/p99
+  """
+  ordered = sorted(times)
+  return {"iterations": len(ordered), "mean": statistics.mean(ordered),
+          "min": ordered[0], "max": ordered[-1],
+          "p50": percentile(ordered, 50), "p95": percentile(ordered, 95),
+          "p99": percentile(ordered, 99)}
+
+def timeBuild(filename, paths, fast=False, batchSize=createdb.BATCH_SIZE,
+              buildCoStar=False, encode=False, buildSnapshot=False, buildSearch=False,
+              buildSummaries=False):
+  """
+  Builds a database the way createdb.py does, timing each phase
+  @param filename - the database file to create (replaced if it exists)
+  @param paths - a dict mapping each table to its source file
+  @param fast - build as createdb.py --fast does
+  @param batchSize - the number of rows per insert batch
+  @param buildCoStar - also build the CoStar graph
+  @param encode - use the dictionary-encoded schema (createdb.py --dictionary)
+  @param buildSnapshot - also build the filmography snapshot
+  @param buildSearch - also build the name search tables
+  @param buildSummaries - also build the summary tables
+  @return a dict of phase timings in seconds, with the rows inserted per
+    table
+  """
+  if os.path.exists(filename):
+    os.remove(filename)
+  conn = sqlite3.connect(filename)
+  db = conn.cursor()
+  build = {"insert": {}}
+  total = time.perf_counter()
+
+  start = time.perf_counter()
+  createdb.createTables(db, encode)
+  if fast:
+    createdb.beginFastLoad(db)
+  build["tables"] = time.perf_counter() - start
+
+  for table, ncols, keyCols in createdb.TABLES:
+    start = time.perf_counter()
+    rows = createdb.readRows(paths[table])
+    if fast or createdb.isCoded(db, table):
+      count = createdb.insertSorted(db, table, ncols, keyCols, rows, batchSize)
+    else:
+      count = createdb.insertTable(db, table, ncols, rows, batchSize)
+    elapsed = time.perf_counter() - start
+    build["insert"][table] = {"rows": count, "seconds": elapsed,
+                              "rowsPerSecond": count / elapsed if elapsed > 0 else 0}
+
+  start = time.perf_counter()
+  createdb.createIndexes(db)
+  if fast:
+    createdb.finishFastLoad(db)
+  conn.commit()
+  build["indexes"] = time.perf_counter() - start
+
+  if buildSummaries:
+    start = time.perf_counter()
+    summaries.buildSummaries(conn)
+    build["summaries"] = time.perf_counter() - start
+
+  if buildSearch:
+    start = time.perf_counter()
+    search.buildSearch(conn)
+    build["search"] = time.perf_counter() - start
+
+  if buildCoStar:
+    start = time.perf_counter()
+    costar.buildCoStar(conn)
+    build["costar"] = time.perf_counter() - start
+
+  if buildSnapshot:
+    start = time.perf_counter()
+    filmography.buildFilmography(conn)
+    build["filmography"] = time.perf_counter() - start
+
+  build["total"] = time.perf_counter() - total
+  build["fileBytes"] = os.path.getsize(filename)
+  conn.close()
+  return build
+
+def timeQueries(filename, iterations=ITERATIONS, warmup=WARMUP):
+  """
+  Times each menu query against a database, with the SQL and sample
+  parameters of queryregistry.WORKLOAD and the derived-table variants the
+  menu would use
+  @param filename - the database file
+  @param iterations - the timed runs per query
+  @param warmup - the untimed runs per query before them
+  @return a dict mapping each query name to its summarized timings and
+    row count
+  """
+  db = queryDB.openReadOnly(filename)
+  results = {}
+  sqls = queryregistry.statements(db)
+  for query in queryregistry.QUERIES:
+    name, sql, params = query.key, sqls[query.number], query.sample
+    times = []
+    for i in range(warmup + iterations):
+      start = time.perf_counter()
+      rows = db.execute(sql, params).fetchall()
+      if i >= warmup:
+        times.append(time.perf_counter() - start)
+    results[name] = summarize(times)
+    results[name]["rows"] = len(rows)
+    print("  %-8s p50 %.4f p95 %.4f p99 %.4f seconds (%d rows)"
+          % (name, results[name]["p50"], results[name]["p95"],
+             results[name]["p99"], len(rows)), file=sys.stderr)
+  db.close()
+  return results
+
+def timeAnalytics(filename, iterations=ITERATIONS, warmup=WARMUP):
+  """
+  Times queries 4-7 on the NumPy engine, after building its column files
+  @param filename - the database file
+  @param iterations - the timed runs per query
+  @param warmup - the untimed runs per query before them
+  @return a dict with the seconds taken to build the column files and,
+    for each query name, its summarized timings and row count
+  """
+  start = time.perf_counter()
+  engine = analytics.Analytics(filename, rebuild=True)
+  results = {"columns": time.perf_counter() - start}
+  for number in sorted(analytics.QUERY_COLUMNS):
+    name = "query%d" % number
+    times = []
+    for i in range(warmup + iterations):
+      start = time.perf_counter()
+      columns, rows = engine.query(number)
+      if i >= warmup:
+        times.append(time.perf_counter() - start)
+    results[name] = summarize(times)
+    results[name]["rows"] = len(rows)
+    print("  %-8s p50 %.4f p95 %.4f p99 %.4f seconds (%d rows, analytics)"
+          % (name, results[name]["p50"], results[name]["p95"],
+             results[name]["p99"], len(rows)), file=sys.stderr)
+  engine.close()
+  return results
+
+def compare(current, baseline, threshold=REGRESSION):
+  """
+  Prints how each timing changed from a baseline run
+  @param current - the results of this run
+  @param baseline - the results of an earlier run
+  @param threshold - the fractional slowdown reported as a regression
+  @return the names of the timings that regressed
+  """
+  pairs = [("build " + phase, baseline["build"].get(phase), current["build"].get(phase))
+           for phase in ("tables", "indexes", "summaries", "search", "costar",
+                         "filmography", "total")]
+  pairs += [("insert " + table, baseline["build"]["insert"].get(table, {}).get("seconds"),
+             current["build"]["insert"][table]["seconds"])
+            for table in current["build"]["insert"]]
+  pairs += [(name + " p50", baseline["queries"].get(name, {}).get("p50"),
+             current["queries"][name]["p50"])
+            for name in current["queries"]]
+  if "analytics" in current and "analytics" in baseline:
+    pairs += [("analytics " + name + " p50", baseline["analytics"].get(name, {}).get("p50"),
+               current["analytics"][name]["p50"])
+              for name in current["analytics"] if name != "columns"]
+
+  regressions = []
+  print("%-22s %12s %12s %8s" % ("timing", "baseline", "current", "change"),
+        file=sys.stderr)
+  for name, before, after in pairs:
+    if before is None or after is None:
+      continue
+    change = (after - before) / before if before > 0 else 0.0
+    flag = ""
+    if change > threshold and after - before > REGRESSION_SECONDS:
+      regressions.append(name)
+      flag = "  REGRESSION"
+    print("%-22s %12.6f %12.6f %+7.1f%%%s"
+          % (name, before, after, 100 * change, flag), file=sys.stderr)
+  return regressions
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="benchmark.py",
+      description="Times the database build and the menu queries")
+  data = parser.add_mutually_exclusive_group()
+  data.add_argument("--data-dir",
+      help="directory of source files to build from")
+  data.add_argument("--casts", type=int, default=100000,
+      help="generate synthetic source files with about this many Casts "
+           "rows (default %(default)s)")
+  parser.add_argument("--seed", type=int, default=1,
+      help="random seed for the synthetic data (default %(default)s)")
+  parser.add_argument("--database",
+      help="database file to build (default a temporary file)")
+  parser.add_argument("--fast", action="store_true",
+      help="build as createdb.py --fast does")
+  parser.add_argument("--summaries", action="store_true",
+      help="also build and time the summary tables (queries 4, 6 and 7 read "
+           "them)")
+  parser.add_argument("--search", action="store_true",
+      help="also build and time the name search tables")
+  parser.add_argument("--costar", action="store_true",
+      help="also build and time the CoStar graph")
+  parser.add_argument("--filmography", action="store_true",
+      help="also build and time the filmography snapshot")
+  parser.add_argument("--dictionary", action="store_true",
+      help="build the dictionary-encoded schema, as createdb.py --dictionary does")
+  parser.add_argument("--analytics", action="store_true",
+      help="also time queries 4-7 on the NumPy engine (requires numpy)")
+  parser.add_argument("--iterations", type=int, default=ITERATIONS,
+      help="timed runs per query (default %(default)s)")
+  parser.add_argument("--warmup", type=int, default=WARMUP,
+      help="untimed runs per query before timing (default %(default)s)")
+  parser.add_argument("--output", metavar="FILE",
+      help="write the JSON results to FILE instead of stdout")
+  parser.add_argument("--compare", metavar="BASELINE",
+      help="compare against the JSON results of an earlier run; exits 1 if "
+           "any timing regressed by more than %d%%%%" % (100 * REGRESSION))
+  args = parser.parse_args(argv)
+  if args.iterations < 1:
+    parser.error("--iterations must be at least 1")
+  if args.analytics and analytics.numpy is None:
+    parser.error("--analytics requires numpy (pip install numpy)")
+  return args
+
+def main():
+  args = parseArgs(sys.argv[1:])
+
+  with tempfile.TemporaryDirectory(prefix="moviedb-bench-") as tmp:
+    dataDir = args.data_dir
+    if dataDir is None:
+      dataDir = os.path.join(tmp, "data")
+      print("...Generating %d Casts rows..." % args.casts, file=sys.stderr)
+      gendata.generate(dataDir, args.casts, args.seed)
+    paths = sources.findSources(createdb.TABLE_NAMES, dataDir)
+    filename = args.database or os.path.join(tmp, "bench.db")
+
+    print("...Timing Build...", file=sys.stderr)
+    with contextlib.redirect_stdout(sys.stderr):
+      build = timeBuild(filename, paths, args.fast,
+                        buildCoStar=args.costar, encode=args.dictionary,
+                        buildSnapshot=args.filmography, buildSearch=args.search,
+                        buildSummaries=args.summaries)
+    print("  built in %.2f seconds" % build["total"], file=sys.stderr)
+
+    print("...Timing Queries...", file=sys.stderr)
+    queries = timeQueries(filename, args.iterations, args.warmup)
+    if args.analytics:
+      print("...Timing Analytics Engine...", file=sys.stderr)
+      engineTimes = timeAnalytics(filename, args.iterations, args.warmup)
+
+  results = {
+    "meta": {
+      "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      "python": platform.python_version(),
+      "sqlite": sqlite3.sqlite_version,
+      "platform": platform.platform(),
+      "dataDir": args.data_dir,
+      "casts": None if args.data_dir else args.casts,
+      "seed": None if args.data_dir else args.seed,
+      "fast": args.fast,
+      "dictionary": args.dictionary,
+    },
+    "build": build,
+    "queries": queries,
+  }
+  if args.analytics:
+    results["analytics"] = engineTimes
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+      f.write("\n")
+  else:
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline):
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+buildstats.py
+
+Description: Instrumentation for createdb.py builds, turned on with
+--stats FILE, --profile FILE or --trace-memory.  Each build phase
+(creating tables, inserting, building indexes, checking foreign keys,
+summaries, name search, co-star graph) is timed.  After each phase it
+records the database file size and the process's peak resident memory.
+The sqlite3 module cannot read SQLite's page cache counters, so the file
+growth of each phase stands in for its page writes.  Each table load is
+timed too, with its rows per second and the time spent parsing the
+source file kept apart from the time spent inserting.  Optionally the
+whole build runs under cProfile, and tracemalloc reports the peak Python
+memory of each phase and where it was allocated.  The report is written as
+JSON and printed as a summary, so a slow build can be traced to parsing,
+inserting or indexing.
+"""
+
+import contextlib
+import cProfile
+import datetime
+import itertools
+import json
+import os
+import platform
+import pstats
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+try:
+  import resource
+except ImportError:   # not available on Windows
+  resource = None
+
+# Rows read from a source file per timed chunk, so the parse timer costs
+# almost nothing per row
+CHUNK = 1000
+
+# Functions and allocation sites listed in the report
+TOP = 15
+
+def peakRSS():
+  """
+  @return the peak resident set size, in bytes, of this process or of the
+    largest of its finished worker processes, or None if unknown
+  """
+  if resource is None:
+    return None
+  peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  return peak if sys.platform == "darwin" else peak * 1024   # KB on Linux
+
+def fileSize(filename):
+  """
+  @param filename - the database file
+  @return its size in bytes, with its rollback journal or write-ahead log
+  """
+  return sum(os.path.getsize(path)
+             for path in (filename, filename + "-journal", filename + "-wal")
+             if os.path.exists(path))
+
+class TimedRows:
+  """
+  Wraps the rows of a source file, adding up the time spent reading and
+  parsing them in seconds
+  """
+  def __init__(self, rows):
+    self.rows = iter(rows)
+    self.seconds = 0.0
+
+  def __iter__(self):
+    while True:
+      start = time.perf_counter()
+      chunk = list(itertools.islice(self.rows, CHUNK))
+      self.seconds += time.perf_counter() - start
+      if not chunk:
+        return
+      yield from chunk
+
+class BuildStats:
+  """
+  Collects the timings and counters of one build
+  """
+  def __init__(self, filename, mode, profile=None, traceMemory=False):
+    """
+    @param filename - the database file being built
+    @param mode - the kind of build, e.g. createdb.FULL_BUILD
+    @param profile - a file to save cProfile statistics to, or None
+    @param traceMemory - whether to trace Python allocations with
+      tracemalloc
+    """
+    self.filename = filename
+    self.mode = mode
+    self.profileFile = profile
+    self.traceMemory = traceMemory
+    self.phases = []
+    self.tables = []
+    self.parsing = {}    # table -> TimedRows of its source file
+    self.profiler = cProfile.Profile() if profile else None
+    self.started = datetime.datetime.now(datetime.timezone.utc)
+    self.start = time.perf_counter()
+    if traceMemory:
+      tracemalloc.start()
+    if self.profiler:
+      self.profiler.enable()
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """
+    Times the statements in a with block as one build phase
+    @param name - the name of the phase
+    """
+    if self.traceMemory:
+      tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      record = {"name": name, "seconds": time.perf_counter() - start,
+                "fileBytes": fileSize(self.filename), "peakRSSBytes": peakRSS()}
+      if self.traceMemory:
+        record["pythonPeakBytes"] = tracemalloc.get_traced_memory()[1]
+      self.phases.append(record)
+
+  def timeRows(self, table, rows):
+    """
+    @param table - the name of the table being loaded
+    @param rows - the rows of its source file
+    @return the rows, timed as they are read
+    """
+    self.parsing[table] = TimedRows(rows)
+    return self.parsing[table]
+
+  def table(self, table, rows, seconds, parseSeconds=None, **counts):
+    """
+    Records the load of one table
+    @param table - the name of the table
+    @param rows - the number of rows read from its source file
+    @param seconds - the time the load took
+    @param parseSeconds - the part of it spent reading and parsing the
+      source file; defaults to the time taken by the rows passed to
+      timeRows
+    @param counts - other numbers to report, e.g. the rows inserted
+    """
+    if parseSeconds is None and table in self.parsing:
+      parseSeconds = self.parsing.pop(table).seconds
+    record = {"table": table, "rows": rows, "seconds": seconds,
+              "rowsPerSecond": rows / seconds if seconds > 0 else 0,
+              "parseSeconds": parseSeconds,
+              "insertSeconds": seconds - parseSeconds if parseSeconds is not None else None}
+    record.update(counts)
+    self.tables.append(record)
+
+  def finish(self):
+    """
+    Stops the profilers and puts the report together
+    @return the report, as a JSON-serializable dict
+    """
+    report = {
+      "meta": {
+        "database": self.filename,
+        "mode": self.mode,
+        "started": self.started.isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+      },
+      "phases": self.phases,
+      "tables": self.tables,
+      "total": {"seconds": time.perf_counter() - self.start,
+                "fileBytes": fileSize(self.filename), "peakRSSBytes": peakRSS()},
+    }
+    if self.profiler:
+      self.profiler.disable()
+      self.profiler.dump_stats(self.profileFile)
+      stats = pstats.Stats(self.profiler)
+      top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+      report["profile"] = {"file": self.profileFile, "top": [
+          {"function": "%s:%d(%s)" % func, "calls": calls,
+           "totalSeconds": total, "cumulativeSeconds": cumulative}
+          for func, (primitive, calls, total, cumulative, callers) in top[:TOP]]}
+    if self.traceMemory:
+      snapshot = tracemalloc.take_snapshot()
+      report["memory"] = {"peakBytes": tracemalloc.get_traced_memory()[1], "top": [
+          {"site": str(stat.traceback[0]), "bytes": stat.size, "blocks": stat.count}
+          for stat in snapshot.statistics("lineno")[:TOP]]}
+      tracemalloc.stop()
+    return report
+
+def megabytes(size):
+  """
+  @param size - a number of bytes, or None
+  @return it in megabytes for printing
+  """
+  return "-" if size is None else "%.1f" % (size / 1e6)
+
+def printSummary(report):
+  """
+  Prints a build report as tables
+  @param report - the report returned by BuildStats.finish
+  """
+  print("\nBuild summary (%s build, %.2f seconds)" % (report["meta"]["mode"],
+                                                      report["total"]["seconds"]))
+  format = "  %-12s %9s %9s %9s"
+  print(format % ("phase", "seconds", "file MB", "peak MB"))
+  for phase in report["phases"]:
+    print(format % (phase["name"], "%.2f" % phase["seconds"],
+                    megabytes(phase["fileBytes"]), megabytes(phase["peakRSSBytes"])))
+  if report["tables"]:
+    format = "  %-13s %10s %9s %11s %9s %9s"
+    print(format % ("table", "rows", "seconds", "rows/sec", "parse", "insert"))
+    for table in report["tables"]:
+      print(format % (table["table"], table["rows"], "%.2f" % table["seconds"],
+                      "%.0f" % table["rowsPerSecond"],
+                      *("-" if table[key] is None else "%.2f" % table[key]
+                        for key in ("parseSeconds", "insertSeconds"))))
+  if "profile" in report:
+    print("  cProfile statistics saved to %s; slowest functions (cumulative):"
+          % report["profile"]["file"])
+    for func in report["profile"]["top"][:5]:
+      print("    %8.2f s  %s" % (func["cumulativeSeconds"], func["function"]))
+  if "memory" in report:
+    print("  Python peak traced memory %s MB; largest allocation sites:"
+          % megabytes(report["memory"]["peakBytes"]))
+    for site in report["memory"]["top"][:5]:
+      print("    %8s MB  %s" % (megabytes(site["bytes"]), site["site"]))
+
+def writeReport(report, path):
+  """
+  Saves a build report as JSON
+  @param report - the report returned by BuildStats.finish
+  @param path - the file to write
+  """
+  with open(path, "w") as f:
+    json.dump(report, f, indent=2)
+    f.write("\n")
@@ -0,0 +1,271 @@
+"""
+costar.py
+
+Description: The co-star graph.  buildCoStar materializes, for every pair
+of actors who appeared in a movie together, the number of movies they
+share into the CoStar table.  The table is stored in both directions and
+clustered by (actorID, costarID), so an actor's co-stars are one
+contiguous range of an index.  updateCoStar recomputes just the edges of
+the actors whose Casts rows changed, for createdb.py --update.  The
+functions below answer frequent co-star, shared movie and Bacon number
+questions from it.
+
+Usage: python3 costar.py databaseName
+  (re)builds the CoStar table of an existing database
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+COSTAR_SQL = """CREATE TABLE IF NOT EXISTS CoStar (
+    actorID INTEGER,
+    costarID INTEGER,
+    numFilms INTEGER,
+    PRIMARY KEY (actorID, costarID)
+  ) WITHOUT ROWID"""
+
+# Each distinct (actor, movie) pair once, grouped by movie, so roles played
+# twice in one movie are not counted twice
+ACTORMOVIE_SQL = """CREATE TEMP TABLE ActorMovie (
+    movieID INTEGER,
+    actorID INTEGER,
+    PRIMARY KEY (movieID, actorID)
+  ) WITHOUT ROWID"""
+
+# The edges of a set of actors, passed as a JSON array, counted from Casts
+ACTOR_EDGES_SQL = """
+    SELECT C1.actorID, C2.actorID, COUNT(DISTINCT C1.movieID)
+    FROM Casts AS C1
+    JOIN Casts AS C2 ON C2.movieID = C1.movieID
+    WHERE C1.actorID IN (SELECT value FROM json_each(?))
+      AND C2.actorID != C1.actorID
+    GROUP BY C1.actorID, C2.actorID
+    """
+
+# The neighbours of a set of actors, passed as a JSON array.  The Casts
+# form is used when the CoStar table has not been built.
+NEIGHBOURS_SQL = """
+    SELECT S.actorID, S.costarID
+    FROM CoStar AS S
+    WHERE S.actorID IN (SELECT value FROM json_each(?))
+    """
+
+CASTS_NEIGHBOURS_SQL = """
+    SELECT DISTINCT C1.actorID, C2.actorID
+    FROM Casts AS C1
+    JOIN Casts AS C2 ON C2.movieID = C1.movieID
+    WHERE C1.actorID IN (SELECT value FROM json_each(?))
+      AND C2.actorID != C1.actorID
+    """
+
+def hasCoStar(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the CoStar table has been built
+  """
+  return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'CoStar'").fetchone() is not None
+
+def buildCoStar(db):
+  """
+  Builds (or rebuilds) the CoStar table from Casts
+  @param db - the database connection
+  @return the number of edges stored (each pair of actors counts twice)
+  """
+  db.execute("DROP TABLE IF EXISTS CoStar")
+  db.execute(COSTAR_SQL)
+  db.execute("DROP TABLE IF EXISTS temp.ActorMovie")
+  db.execute(ACTORMOVIE_SQL)
+  db.execute("INSERT INTO temp.ActorMovie SELECT DISTINCT movieID, actorID FROM Casts")
+  db.execute("""
+    INSERT INTO CoStar (actorID, costarID, numFilms)
+    SELECT A.actorID, B.actorID, COUNT(*)
+    FROM temp.ActorMovie AS A
+    JOIN temp.ActorMovie AS B ON B.movieID = A.movieID
+    WHERE B.actorID != A.actorID
+    GROUP BY A.actorID, B.actorID""")
+  db.execute("DROP TABLE temp.ActorMovie")
+  db.commit()
+  return db.execute("SELECT COUNT(*) FROM CoStar").fetchone()[0]
+
+def updateCoStar(db, actorIDs):
+  """
+  Brings the CoStar table up to date after Casts rows of some actors were
+  inserted or deleted.  Only the pairs that include one of those actors
+  can have changed, so their edges are deleted and counted again from
+  Casts, in both directions.  Nothing is committed.
+  @param db - the database connection or cursor
+  @param actorIDs - the ids of the actors whose Casts rows changed
+  @return the number of edges stored for those actors
+  """
+  ids = json.dumps(sorted(actorIDs))
+  db.execute("""DELETE FROM CoStar WHERE (actorID, costarID) IN
+                (SELECT costarID, actorID FROM CoStar
+                 WHERE actorID IN (SELECT value FROM json_each(?)))""", (ids,))
+  db.execute("DELETE FROM CoStar WHERE actorID IN (SELECT value FROM json_each(?))",
+             (ids,))
+  edges = db.execute(ACTOR_EDGES_SQL, (ids,)).fetchall()
+  db.executemany("INSERT INTO CoStar (actorID, costarID, numFilms) VALUES (?, ?, ?)",
+                 edges)
+  # a pair of two changed actors is already stored both ways
+  db.executemany("INSERT OR IGNORE INTO CoStar (actorID, costarID, numFilms) "
+                 "VALUES (?, ?, ?)",
+                 [(costarID, actorID, numFilms) for actorID, costarID, numFilms in edges])
+  return len(edges)
+
+def actorIDs(db, fname, lname):
+  """
+  @param db - the database connection or cursor
+  @param fname - the actor's first name
+  @param lname - the actor's last name
+  @return the ids of the actors with that name, in id order
+  """
+  return [row[0] for row in db.execute(
+      "SELECT id FROM Actor WHERE fname = ? AND lname = ? ORDER BY id",
+      (fname, lname))]
+
+def frequentCoStars(db, actorID, minFilms=1):
+  """
+  Finds the actors who share at least minFilms movies with an actor
+  @param db - the database connection or cursor
+  @param actorID - the actor's id
+  @param minFilms - the least number of shared movies to report
+  @return a list of (id, fname, lname, numFilms) tuples, most shared
+    movies first
+  """
+  return db.execute("""
+    SELECT A.id, A.fname, A.lname, S.numFilms
+    FROM CoStar AS S
+    JOIN Actor AS A ON A.id = S.costarID
+    WHERE S.actorID = ?
+      AND S.numFilms >= ?
+    ORDER BY S.numFilms DESC, A.lname, A.fname""", (actorID, minFilms)).fetchall()
+
+def sharedMovies(db, actorA, actorB):
+  """
+  Finds the movies two actors appeared in together
+  @param db - the database connection or cursor
+  @param actorA - the first actor's id
+  @param actorB - the second actor's id
+  @return a list of (id, title) tuples, in title order
+  """
+  if hasCoStar(db) and db.execute(
+      "SELECT 1 FROM CoStar WHERE actorID = ? AND costarID = ?",
+      (actorA, actorB)).fetchone() is None:
+    return []
+  return db.execute("""
+    SELECT M.id, M.title
+    FROM Movie AS M
+    WHERE M.id IN (SELECT movieID FROM Casts WHERE actorID = ?
+                   INTERSECT
+                   SELECT movieID FROM Casts WHERE actorID = ?)
+    ORDER BY M.title""", (actorA, actorB)).fetchall()
+
+def expand(db, frontier, sql):
+  """
+  Fetches the neighbours of every actor in a BFS frontier
+  @param db - the database connection or cursor
+  @param frontier - the ids of the actors to expand
+  @param sql - NEIGHBOURS_SQL or CASTS_NEIGHBOURS_SQL
+  @return a generator of (actorID, neighbourID) pairs
+  """
+  return db.execute(sql, (json.dumps(list(frontier)),))
+
+def baconPath(db, source, target, maxDepth=None):
+  """
+  Finds a shortest chain of co-stars linking two actors with a
+  bidirectional breadth-first search: the smaller of the two frontiers is
+  expanded a level at a time until they meet
+  @param db - the database connection or cursor
+  @param source - the id of the first actor
+  @param target - the id of the second actor
+  @param maxDepth - give up on chains longer than this, or None
+  @return the list of actor ids from source to target, or None if the
+    actors are not connected (within maxDepth)
+  """
+  if source == target:
+    return [source]
+  sql = NEIGHBOURS_SQL if hasCoStar(db) else CASTS_NEIGHBOURS_SQL
+
+  # parents[0] maps actors reached from source to the actor they were
+  # reached from, parents[1] the same from target
+  parents = [{source: None}, {target: None}]
+  frontiers = [[source], [target]]
+  depth = 0
+  while frontiers[0] and frontiers[1]:
+    if maxDepth is not None and depth >= maxDepth:
+      return None
+    depth += 1
+    side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+    seen, other = parents[side], parents[1 - side]
+    meet = None
+    nextFrontier = []
+    for actor, neighbour in expand(db, frontiers[side], sql):
+      if neighbour in seen:
+        continue
+      seen[neighbour] = actor
+      nextFrontier.append(neighbour)
+      if neighbour in other and meet is None:
+        meet = neighbour
+    if meet is not None:
+      return joinPath(parents, meet)
+    frontiers[side] = nextFrontier
+  return None
+
+def joinPath(parents, meet):
+  """
+  Joins the two halves of a bidirectional search at the actor where they
+  met
+  @param parents - the parent maps of the source and target searches
+  @param meet - the id of an actor reached by both searches
+  @return the list of actor ids from source to target
+  """
+  path = []
+  actor = meet
+  while actor is not None:
+    path.append(actor)
+    actor = parents[0][actor]
+  path.reverse()
+  actor = parents[1][meet]
+  while actor is not None:
+    path.append(actor)
+    actor = parents[1][actor]
+  return path
+
+def baconNumber(db, source, target, maxDepth=None):
+  """
+  @param db - the database connection or cursor
+  @param source - the id of the first actor
+  @param target - the id of the second actor
+  @param maxDepth - give up on chains longer than this, or None
+  @return the number of co-star links between the actors, or None if they
+    are not connected
+  """
+  path = baconPath(db, source, target, maxDepth)
+  return None if path is None else len(path) - 1
+
+############### main program ###########################
+def main():
+
+  if len(sys.argv) != 2:
+    print("Error: Incorrect arguments")
+    print("Usage: python3 costar.py databaseName")
+    return 1
+
+  if not os.path.exists(sys.argv[1]):
+    print("Error: file does not exist")
+    return 1
+
+  db = sqlite3.connect(sys.argv[1])
+  print("...Building CoStar...")
+  start = time.time()
+  edges = buildCoStar(db)
+  print("  %d edges in %.2f seconds" % (edges, time.time() - start))
+  db.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -10,141 +10,906 @@ Description: Creates the database tables, inserts all the data into the database
 and creates indexes that are useful
 """
 
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import itertools
 import sqlite3
 import os
+import re
 import sys
+import tempfile
+import time
 
-def createTables(db):
-  """Creates the database schema
+import buildstats
+import costar
+import dictionary
+import filmography
+import publish
+import search
+import shards
+import sources
+import summaries
 
-  Creates 6 tables according to the following schema:
-        Actor (id, fname, lname, gender)
-        Movie (id, title, year)
-        Director (id, fname, lname)
-        Cast (actorID, movieID, role)
-        DirectsMovie (directorID, movieID)
-        Genre (movieID, genre)
-  @param db - a Cursor object for the database connection
-  @return None.  The 6 tables are added to the database
-  """
+# Default directory holding the pipe-delimited source files, one per table
+DATA_DIR = "/scratch/newhall/public/cs44/movieDB"
 
-  #Example for executing a SQL command.  This enforces foreign key constraints
-  db.execute("PRAGMA foreign_keys=ON")
+# Default number of rows handed to each executemany/commit during the load
+BATCH_SIZE = 50000
 
-  print("...Creating Tables ...")
+# (table, number of columns, primary key columns) for every table, in load
+# order.  Genre has no foreign key; every other child table follows the
+# tables it references.
+TABLES = [
+  ("Actor", 4, (0,)),
+  ("Movie", 3, (0,)),
+  ("Director", 3, (0,)),
+  ("Casts", 3, (0, 1, 2)),
+  ("DirectsMovie", 2, (0, 1)),
+  ("Genre", 2, (0, 1)),
+]
+TABLE_NAMES = [table for table, ncols, keyCols in TABLES]
+
+# Connection settings for a --fast build: no rollback journal or fsyncs, a
+# 256MB page cache and memory-mapped I/O while the file is being loaded
+FAST_PRAGMAS = [
+  "PRAGMA journal_mode=OFF",
+  "PRAGMA synchronous=OFF",
+  "PRAGMA cache_size=-262144",
+  "PRAGMA mmap_size=1073741824",
+  "PRAGMA foreign_keys=OFF",
+]
 
-  db.execute("""CREATE TABLE Actor (
+# Settings restored once a --fast build has finished loading
+SAFE_PRAGMAS = [
+  "PRAGMA journal_mode=DELETE",
+  "PRAGMA synchronous=FULL",
+  "PRAGMA foreign_keys=ON",
+]
+
+# CREATE TABLE statement for each table
+TABLE_SQL = {
+  "Actor": """CREATE TABLE Actor (
     id INTEGER PRIMARY KEY,
     fname VARCHAR(30),
     lname VARCHAR(30),
     gender CHAR(1)
-    )""")
-  
-  db.execute("""CREATE TABLE Movie (
+    )""",
+
+  "Movie": """CREATE TABLE Movie (
     id INTEGER PRIMARY KEY,
     title VARCHAR(30),
     year INTEGER
-  )""")
+  )""",
 
-  db.execute("""CREATE TABLE Director (
+  "Director": """CREATE TABLE Director (
     id INTEGER PRIMARY KEY,
     fname VARCHAR(30),
     lname VARCHAR(30)
-  )""")
+  )""",
 
-  db.execute("""CREATE TABLE Casts (
+  "Casts": """CREATE TABLE Casts (
     actorID INTEGER,
     movieID INTEGER,
     role VARCHAR(50),
     PRIMARY KEY (actorID, movieID, role),
     FOREIGN KEY (actorID) REFERENCES Actor(id),
     FOREIGN KEY (movieID) REFERENCES Movie(id)
-  )""")
+  )""",
 
-  db.execute(""" CREATE TABLE DirectsMovie (
+  "DirectsMovie": """ CREATE TABLE DirectsMovie (
     directorID INTEGER,
     movieID INTEGER,
     PRIMARY KEY (directorID, movieID),
     FOREIGN KEY (directorID) REFERENCES Director(id)
     FOREIGN KEY (movieID) REFERENCES Movie(id)
-  )""")
+  )""",
 
-  db.execute(""" CREATE TABLE Genre (
+  "Genre": """ CREATE TABLE Genre (
     movieID INTEGER,
     type VARCHAR(50),
     PRIMARY KEY (movieID, type)
-  )""")
+  )""",
+}
+
+# Secondary indexes built after the load.  Casts(actorID) and
+# DirectsMovie(directorID) are not listed: they are the leading columns of
+# those tables' primary keys, whose indexes already serve them.
+INDEXES = [
+  # Speeds up selection of actors by name (queries 2, 3, 5)
+  "CREATE INDEX IF NOT EXISTS idx_actor_name ON Actor(fname, lname);",
+
+  # Speeds up movie title selection (query 1)
+  "CREATE INDEX IF NOT EXISTS idx_movie_title ON Movie(title);",
+
+  # Speeds up movie year filtering (query 6)
+  "CREATE INDEX IF NOT EXISTS idx_movie_year ON Movie(year);",
 
+  # Speeds up joins on movieID (queries 1, 5, 6); carrying actorID makes
+  # the index covering for the co-actor joins
+  "CREATE INDEX IF NOT EXISTS idx_casts_movie_actor ON Casts(movieID, actorID);",
+]
 
+# Records what was loaded from each source file, so a later incremental
+# update can skip files that have not changed
+LOADMETA_SQL = """CREATE TABLE IF NOT EXISTS LoadMeta (
+    tableName VARCHAR(30) PRIMARY KEY,
+    checksum CHAR(64),
+    numRows INTEGER,
+    loadedAt TEXT
+  )"""
 
-  pass
+# The hash of every row loaded from a source file, by table and primary key
+# (its key fields joined by "|"), so an update can tell which rows changed
+# without reading the table.  Casts, DirectsMovie and Genre have no hashes:
+# every column is in their key, so a row cannot change without becoming
+# another row.
+ROWHASH_SQL = """CREATE TABLE IF NOT EXISTS RowHash (
+    tableName VARCHAR(30),
+    rowKey TEXT,
+    hash BLOB,
+    PRIMARY KEY (tableName, rowKey)
+  ) WITHOUT ROWID"""
 
-def insertAll(db):
+# What checkDB decided to do with the database file
+FULL_BUILD = "full"
+INDEX_REBUILD = "indexes"
+INCREMENTAL_UPDATE = "update"
+SHARD_REBUILD = "shards"
+
+# A foreign key from a shard table to Actor or Director, which are in the
+# shared file; SQLite cannot enforce it across files, so checkShard checks
+# it instead
+SHARED_FOREIGN_KEY = re.compile(r",?\s*FOREIGN KEY \(\w+\) REFERENCES (Actor|Director)\(id\)")
+
+def createTables(db, encode=False):
+  """Creates the database schema
+
+  Creates 6 tables according to the following schema:
+        Actor (id, fname, lname, gender)
+        Movie (id, title, year)
+        Director (id, fname, lname)
+        Cast (actorID, movieID, role)
+        DirectsMovie (directorID, movieID)
+        Genre (movieID, genre)
+  @param db - a Cursor object for the database connection
+  @param encode - create Casts and Genre as views over the
+    dictionary-encoded tables of dictionary.py
+  @return None.  The 6 tables are added to the database
+  """
+
+  #Example for executing a SQL command.  This enforces foreign key constraints
+  db.execute("PRAGMA foreign_keys=ON")
+
+  print("...Creating Tables ...")
+
+  for table, ncols, keyCols in TABLES:
+    if not (encode and table in dictionary.CODED):
+      db.execute(TABLE_SQL[table])
+  if encode:
+    dictionary.createSchema(db)
+  db.execute(LOADMETA_SQL)
+  db.execute(ROWHASH_SQL)
+
+
+def readRows(path):
+  """
+  Streams the rows of a pipe-delimited source file one line at a time
+  @param path - the path of the source file, which may be compressed
+  @return a generator of field lists, one per line of the file
+  """
+  for line in sources.readLines(path):
+    yield line.strip().split('|')
+
+def fileChecksum(path):
+  """
+  Computes the SHA-256 checksum of a source file
+  @param path - the path of the source file
+  @return the hex digest of the file contents
+  """
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def recordLoad(db, table, checksum, count):
+  """
+  Records the checksum and row count of the file a table was loaded from
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table
+  @param checksum - the checksum of the source file
+  @param count - the number of rows in the source file
+  """
+  db.execute("INSERT OR REPLACE INTO LoadMeta VALUES (?, ?, ?, ?)",
+             (table, checksum, count, datetime.datetime.now().isoformat()))
+  db.connection.commit()
+
+def batches(rows, size):
+  """
+  Groups an iterable of rows into lists of at most size rows
+  @param rows - an iterable of rows
+  @param size - the maximum number of rows per batch
+  @return a generator of row lists
+  """
+  rows = iter(rows)
+  while True:
+    batch = list(itertools.islice(rows, size))
+    if not batch:
+      return
+    yield batch
+
+def insertTable(db, table, ncols, rows, batchSize=BATCH_SIZE):
+  """
+  Inserts rows into a table in fixed-size batches, one transaction per batch,
+  so only a single batch is ever held in memory
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table to insert into
+  @param ncols - the number of columns in the table
+  @param rows - an iterable of rows to insert
+  @param batchSize - the number of rows per executemany/commit
+  @return the number of rows inserted
+  """
+  sql = "INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * ncols))
+  count = 0
+  for batch in batches(rows, batchSize):
+    db.executemany(sql, batch)
+    db.connection.commit()
+    count += len(batch)
+  return count
+
+def insertSorted(db, table, ncols, keyCols, rows, batchSize=BATCH_SIZE):
+  """
+  Inserts rows into a table in primary key order.  Rows are first streamed
+  into an unindexed temporary staging table, then copied into the table
+  with ORDER BY, so SQLite's external sorter does the sort in bounded
+  memory and the key B-trees are filled by appending.
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table to insert into
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param rows - an iterable of rows to insert
+  @param batchSize - the number of rows per executemany/commit
+  @return the number of rows inserted
+  """
+  staging = "Staging" + table
+  db.execute("CREATE TEMP TABLE %s AS SELECT * FROM main.%s WHERE 0" % (staging, table))
+  count = insertTable(db, "temp." + staging, ncols, rows, batchSize)
+  if isCoded(db, table):
+    dictionary.insertCoded(db, table, "temp." + staging)
+  else:
+    order = ", ".join(str(col + 1) for col in keyCols)
+    db.execute("INSERT INTO main.%s SELECT * FROM temp.%s ORDER BY %s" % (table, staging, order))
+  db.connection.commit()
+  db.execute("DROP TABLE temp." + staging)
+  return count
+
+def isCoded(db, table):
+  """
+  @param db - a Cursor object for the database connection
+  @param table - the name of a table
+  @return True if the table is a view over a dictionary-encoded table,
+    which bulk loads fill with dictionary.insertCoded
+  """
+  return table in dictionary.CODED and dictionary.isEncoded(db)
+
+def printThroughput(table, count, elapsed):
+  """
+  Prints the number of rows loaded into a table and the load rate
+  @param table - the name of the table
+  @param count - the number of rows inserted
+  @param elapsed - the load time in seconds
+  """
+  rate = count / elapsed if elapsed > 0 else 0
+  print("  %-13s %10d rows in %7.2f seconds (%.0f rows/sec)" % (table, count, elapsed, rate))
+
+def insertAll(db, batchSize=BATCH_SIZE, presort=False, paths=None, stats=None):
   """
   Inserts all tuples from source files into the database
-  The data is located in /scratch/newhall/public/cs44/swatDB/RelationName.txt.
+  By default the data is located in DATA_DIR/RelationName.txt.
   Each field is separated by a horizontal bar |
+  Files are streamed in batches of batchSize rows, so memory use does not
+  grow with the size of the input.
   @param db - a Cursor object for the database connection
+  @param batchSize - the number of rows per executemany/commit
+  @param presort - if True, rows are sorted by primary key before inserting
+  @param paths - a dict mapping each table to its source file (see
+    sources.findSources); defaults to the files in DATA_DIR
+  @param stats - a buildstats.BuildStats to record each table's load in,
+    or None
   """
   print("...Inserting Records...")
+  paths = paths or sources.findSources(TABLE_NAMES, DATA_DIR)
+
+  # Parents are loaded before the tables that reference them
+  for table, ncols, keyCols in TABLES:
+    start = time.time()
+    path = paths[table]
+    rows = readRows(path)
+    if stats:
+      rows = stats.timeRows(table, rows)
+    if presort or isCoded(db, table):
+      count = insertSorted(db, table, ncols, keyCols, rows, batchSize)
+    else:
+      count = insertTable(db, table, ncols, rows, batchSize)
+    elapsed = time.time() - start
+    printThroughput(table, count, elapsed)
+    if stats:
+      stats.table(table, count, elapsed)
+    recordLoad(db, table, fileChecksum(path), count)
+    recordHashes(db, table, ncols, keyCols, path, batchSize)
+
+
+
+def loadTablePart(table, ncols, keyCols, path, partFile, batchSize=BATCH_SIZE):
+  """
+  Loads one source file into its own scratch database.  Runs in a worker
+  process of insertAllParallel.
+  @param table - the name of the table
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param path - the path of the source file
+  @param partFile - the scratch database file to create
+  @param batchSize - the number of rows per executemany/commit
+  @return (table, partFile, number of rows, source checksum,
+    load time in seconds, time spent reading and parsing the source file)
+  """
+  start = time.time()
+  conn = sqlite3.connect(partFile)
+  db = conn.cursor()
+  for pragma in FAST_PRAGMAS:
+    db.execute(pragma)
+  db.execute(TABLE_SQL[table])
+  rows = buildstats.TimedRows(readRows(path))
+  count = insertSorted(db, table, ncols, keyCols, rows, batchSize)
+  recordHashes(db, table, ncols, keyCols, path, batchSize)
+  conn.close()
+  return table, partFile, count, fileChecksum(path), time.time() - start, rows.seconds
+
+def insertAllParallel(db, jobs, batchSize=BATCH_SIZE, paths=None, stats=None):
+  """
+  Inserts all tuples from source files into the database, parsing and
+  loading the tables concurrently.  Each table is loaded into a scratch
+  database file by a worker process; as each worker finishes, its file is
+  attached and copied into the main database with INSERT INTO ... SELECT.
+  Foreign keys are off during the copy (finishFastLoad checks them after).
+  @param db - a Cursor object for the database connection
+  @param jobs - the number of worker processes
+  @param batchSize - the number of rows per executemany/commit
+  @param paths - a dict mapping each table to its source file; defaults to
+    the files in DATA_DIR
+  @param stats - a buildstats.BuildStats to record each table's load in,
+    or None
+  """
+  print("...Inserting Records (%d workers)..." % jobs)
+  paths = paths or sources.findSources(TABLE_NAMES, DATA_DIR)
+  db.execute("PRAGMA foreign_keys=OFF")
+
+  # keep the scratch files on the same disk as the database being built
+  mainFile = db.execute("PRAGMA database_list").fetchone()[2]
+  workDir = os.path.dirname(os.path.abspath(mainFile))
+
+  with tempfile.TemporaryDirectory(dir=workDir, prefix=".createdb-") as tmp:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+      futures = [pool.submit(loadTablePart, table, ncols, keyCols,
+                             paths[table],
+                             os.path.join(tmp, table + ".db"), batchSize)
+                 for table, ncols, keyCols in TABLES]
+      for future in concurrent.futures.as_completed(futures):
+        table, partFile, count, checksum, elapsed, parseSeconds = future.result()
+        printThroughput(table, count, elapsed)
+        start = time.time()
+        db.execute("ATTACH DATABASE ? AS part", (partFile,))
+        if isCoded(db, table):
+          dictionary.insertCoded(db, table, "part." + table)
+        else:
+          db.execute("INSERT INTO main.%s SELECT * FROM part.%s" % (table, table))
+        if db.execute("SELECT 1 FROM part.sqlite_master "
+                      "WHERE name = 'RowHash'").fetchone():   # a hashed table
+          db.execute("INSERT INTO main.RowHash SELECT * FROM part.RowHash")
+        db.connection.commit()
+        db.execute("DETACH DATABASE part")
+        os.remove(partFile)
+        if stats:
+          stats.table(table, count, elapsed, parseSeconds,
+                      mergeSeconds=time.time() - start)
+        recordLoad(db, table, checksum, count)
+
+def rowKey(line, keyCols):
+  """
+  @param line - a line of a source file, without its line break
+  @param keyCols - the positions of the primary key columns
+  @return the primary key fields of the line, joined by "|"
+  """
+  fields = line.split('|')
+  return "|".join(fields[i] for i in keyCols)
+
+def rowHash(line):
+  """
+  @param line - a line of a source file, without its line break
+  @return an 8 byte BLAKE2 digest of the line
+  """
+  return hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest()
+
+def isHashed(ncols, keyCols):
+  """
+  @param ncols - the number of columns in a table
+  @param keyCols - the positions of its primary key columns
+  @return True if the table has columns outside its key, so RowHash keeps
+    a hash of each of its rows
+  """
+  return len(keyCols) < ncols
+
+def recordHashes(db, table, ncols, keyCols, path, batchSize=BATCH_SIZE):
+  """
+  Records the hash of every row of a source file in RowHash, replacing
+  the table's old ones.  Tables without columns outside their key are
+  skipped.
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param path - the path of the source file the table was loaded from
+  @param batchSize - the number of rows per executemany/commit
+  """
+  if not isHashed(ncols, keyCols):
+    return
+  db.execute(ROWHASH_SQL)
+  db.execute("DELETE FROM RowHash WHERE tableName = ?", (table,))
+  lines = (line.strip() for line in sources.readLines(path))
+  insertTable(db, "RowHash", 3,
+              ((table, rowKey(line, keyCols), rowHash(line)) for line in lines),
+              batchSize)
+
+def storedRows(db, table, ncols, keyCols, batchSize=BATCH_SIZE):
+  """
+  Reads what an update compares a source file with: the hash of each row
+  of the table, by key, from RowHash.  A table loaded before RowHash was
+  kept has its rows hashed, and the hashes recorded, first.  A table whose
+  key is the whole row has no hashes; its rows are read back as source
+  lines instead, which are their keys.
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param batchSize - the number of hashes per executemany/commit when
+    they are recorded
+  @return a dict mapping the key of each row to its hash (None if the
+    table has no hashes)
+  """
+  if isHashed(ncols, keyCols):
+    hashes = dict(db.execute("SELECT rowKey, hash FROM RowHash WHERE tableName = ?",
+                             (table,)))
+    if hashes:
+      return hashes
+  cols = [row[1] for row in db.execute("PRAGMA main.table_info(%s)" % table)]
+  line = " || '|' || ".join("coalesce(%s, '')" % col for col in cols)
+  lines = (row[0] for row in db.execute("SELECT %s FROM main.%s" % (line, table)))
+  if not isHashed(ncols, keyCols):
+    return dict.fromkeys(lines)
+  hashes = {rowKey(line, keyCols): rowHash(line) for line in lines}
+  insertTable(db, "RowHash", 3,
+              ((table, key, digest) for key, digest in hashes.items()), batchSize)
+  return hashes
 
-  # Insert Actor
-  with open('/scratch/newhall/public/cs44/movieDB/Actor.txt', 'r', errors='backslashreplace') as f:
-      actors = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO Actor VALUES (?, ?, ?, ?)", actors)
+def diffTable(db, table, ncols, keyCols, path, batchSize=BATCH_SIZE):
+  """
+  Works out how a source file differs from what was loaded into a table,
+  by looking up the key and hash of each of its lines in storedRows.
+  Only the differences are kept, not the file.
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param path - the path of the new source file
+  @param batchSize - passed to storedRows
+  @return (rows in the new file, lines of the rows inserted or changed,
+    number of them changed, keys of the rows deleted)
+  """
+  stored = storedRows(db, table, ncols, keyCols, batchSize)
+  hashed = isHashed(ncols, keyCols)
+  count = changed = 0
+  upserts = []
+  for line in sources.readLines(path):
+    line = line.strip()
+    count += 1
+    key = rowKey(line, keyCols) if hashed else line
+    digest = rowHash(line) if hashed else None
+    if key not in stored:
+      upserts.append(line)
+    elif stored.pop(key) != digest:
+      upserts.append(line)
+      changed += 1
+  return count, upserts, changed, list(stored)
 
-  # Insert Movie
-  with open('/scratch/newhall/public/cs44/movieDB/Movie.txt', 'r', errors='backslashreplace') as f:
-      movies = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO Movie VALUES (?, ?, ?)", movies)
+def applyDelta(db, table, ncols, keyCols, upserts, deleted):
+  """
+  Applies the differences found by diffTable to a table and its row
+  hashes.  Indexes, and the summary tables' triggers, are updated for just
+  the rows that changed.
+  @param db - a Cursor object for the database connection
+  @param table - the name of the table
+  @param ncols - the number of columns in the table
+  @param keyCols - the positions of the primary key columns
+  @param upserts - the lines of the rows inserted or changed
+  @param deleted - the keys of the rows deleted
+  """
+  cols = [row[1] for row in db.execute("PRAGMA main.table_info(%s)" % table)]
+  key = ", ".join(cols[i] for i in keyCols)
+  updates = ", ".join("%s = excluded.%s" % (col, col)
+                      for i, col in enumerate(cols) if i not in keyCols)
+  values = ", ".join("?" * ncols)
 
-  # Insert Director
-  with open('/scratch/newhall/public/cs44/movieDB/Director.txt', 'r', errors='backslashreplace') as f:
-      directors = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO Director VALUES (?, ?, ?)", directors)
+  db.executemany("DELETE FROM main.%s WHERE %s" % (table, " AND ".join(
+                   "%s = ?" % cols[i] for i in keyCols)),
+                 [deletedKey.split('|') for deletedKey in deleted])
+  rows = [line.split('|') for line in upserts]
+  if updates:
+    db.executemany("INSERT INTO main.%s VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s"
+                   % (table, values, key, updates), rows)
+  else:
+    # every column is in the key; OR IGNORE also works on the views of a
+    # dictionary-encoded database, which cannot take an upsert
+    db.executemany("INSERT OR IGNORE INTO main.%s VALUES (%s)" % (table, values), rows)
+  if isHashed(ncols, keyCols):
+    db.executemany("DELETE FROM RowHash WHERE tableName = ? AND rowKey = ?",
+                   [(table, deletedKey) for deletedKey in deleted])
+    db.executemany("INSERT OR REPLACE INTO RowHash VALUES (?, ?, ?)",
+                   [(table, rowKey(line, keyCols), rowHash(line)) for line in upserts])
 
-  # Insert Casts
-  with open('/scratch/newhall/public/cs44/movieDB/Casts.txt', 'r', errors='backslashreplace') as f:
-      casts = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO Casts VALUES (?, ?, ?)", casts)
+def deltaIDs(delta, col):
+  """
+  @param delta - a table's (keyCols, upserts, deleted) from diffTable, or
+    None if its file did not change
+  @param col - the position of one of the table's key columns
+  @return the set of values in that column of the rows inserted, changed
+    or deleted
+  """
+  if delta is None:
+    return set()
+  keyCols, upserts, deleted = delta
+  ids = {line.split('|')[col] for line in upserts}
+  ids.update(key.split('|')[keyCols.index(col)] for key in deleted)
+  return ids
 
-  # Insert DirectsMovie
-  with open('/scratch/newhall/public/cs44/movieDB/DirectsMovie.txt', 'r', errors='backslashreplace') as f:
-      directs = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO DirectsMovie VALUES (?, ?)", directs) 
+def updateDerived(db, deltas, names):
+  """
+  Brings the search tables, the CoStar graph and the filmography snapshot
+  up to date with an applied update, from the ids in its delta rather
+  than by rebuilding them.  The summary tables are kept by their
+  triggers.  Nothing is committed.
+  @param db - a Cursor object for the database connection
+  @param deltas - a dict mapping each changed table to its (keyCols,
+    upserts, deleted)
+  @param names - the filmography names the update touched, as found by
+    filmography.actorNames before it, or None if there is no snapshot
+  """
+  start = time.time()
+  if search.hasSearch(db):
+    for table, kind in (("Actor", "actor"), ("Director", "director"), ("Movie", "movie")):
+      ids = deltaIDs(deltas.get(table), 0)
+      if ids:
+        search.updateSearch(db, kind, ids)
+  actors = deltaIDs(deltas.get("Casts"), 0)
+  if actors and costar.hasCoStar(db):
+    costar.updateCoStar(db, actors)
+  if names is not None:
+    names |= filmography.actorNames(db, actors | deltaIDs(deltas.get("Actor"), 0),
+                                    deltaIDs(deltas.get("Movie"), 0))
+    filmography.updateFilmography(db, names)
+  print("  derived tables updated in %.2f seconds" % (time.time() - start))
 
-  # Insert Genre (no foreign key!)
-  with open('/scratch/newhall/public/cs44/movieDB/Genre.txt', 'r', errors='backslashreplace') as f:
-      genres = [line.strip().split('|') for line in f]
-  db.executemany("INSERT INTO Genre VALUES (?, ?)", genres)
+def updateAll(db, batchSize=BATCH_SIZE, paths=None, stats=None):
+  """
+  Brings an existing database up to date with the source files without
+  rebuilding it.  Files whose checksum matches the one recorded in
+  LoadMeta are skipped.  The rest are diffed with the row hashes in
+  RowHash, and only the inserted, changed and deleted rows are applied,
+  along with the changes they make to the derived tables.  All the
+  changes are made in one transaction, with foreign keys checked when it
+  commits.
+  @param db - a Cursor object for the database connection
+  @param batchSize - the number of row hashes per executemany/commit when
+    a table loaded without them has them recorded
+  @param paths - a dict mapping each table to its source file; defaults to
+    the files in DATA_DIR
+  @param stats - a buildstats.BuildStats to record each table's diff in,
+    or None
+  """
+  print("...Applying Incremental Update...")
+  paths = paths or sources.findSources(TABLE_NAMES, DATA_DIR)
+  db.execute("PRAGMA foreign_keys=ON")
+  db.execute(LOADMETA_SQL)
+  db.execute(ROWHASH_SQL)
+  loaded = dict(db.execute("SELECT tableName, checksum FROM LoadMeta").fetchall())
 
+  # diff every changed file first, so the update transaction is short
+  changed = []
+  deltas = {}
+  for table, ncols, keyCols in TABLES:
+    path = paths[table]
+    checksum = fileChecksum(path)
+    if loaded.get(table) == checksum:
+      print("  %-13s unchanged" % table)
+      continue
+    start = time.time()
+    count, upserts, updated, deleted = diffTable(db, table, ncols, keyCols, path,
+                                                  batchSize)
+    elapsed = time.time() - start
+    inserted = len(upserts) - updated
+    print("  %-13s %8d inserted %8d changed %8d deleted (%.2f seconds)"
+          % (table, inserted, updated, len(deleted), elapsed))
+    if stats:
+      stats.table(table, count, elapsed, inserted=inserted, changed=updated,
+                  deleted=len(deleted))
+    changed.append((table, ncols, keyCols, checksum, count))
+    deltas[table] = (keyCols, upserts, deleted)
 
+  db.connection.commit()
+  db.execute("BEGIN")
+  db.execute("PRAGMA defer_foreign_keys=ON")
+  try:
+    # the snapshot's old names are read before the rows change
+    names = None
+    if filmography.hasFilmography(db):
+      names = filmography.actorNames(db, deltaIDs(deltas.get("Casts"), 0)
+                                         | deltaIDs(deltas.get("Actor"), 0),
+                                     deltaIDs(deltas.get("Movie"), 0))
+    for table, ncols, keyCols, checksum, count in changed:
+      keyCols, upserts, deleted = deltas[table]
+      applyDelta(db, table, ncols, keyCols, upserts, deleted)
+      db.execute("INSERT OR REPLACE INTO LoadMeta VALUES (?, ?, ?, ?)",
+                 (table, checksum, count, datetime.datetime.now().isoformat()))
+    if deltas:
+      updateDerived(db, deltas, names)
+    db.connection.commit()
+  except sqlite3.Error:
+    db.connection.rollback()
+    raise
 
-def createIndexes(db):
+def createIndexes(db, indexes=None):
     """
     Create indexes to optimize performance for specific queries.
     Usefulness of indexes is described in README.adoc
+    @param db - a Cursor object for the database connection
+    @param indexes - CREATE INDEX statements to run instead of INDEXES,
+      e.g. the set chosen by indexadvisor.py
     """
 
     print("...Building Indexes...")
 
-    # Speeds up selection of actors by name (queries 1, 2, 3, 5, 6, 7)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_actor_name ON Actor(fname, lname);")
+    for sql in (INDEXES if indexes is None else indexes):
+        db.execute(dictionary.retargetIndex(db, sql))
 
-    # Speeds up movie title selection (queries 2, 3, 6)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_movie_title ON Movie(title);")
+def readIndexFile(path):
+    """
+    Reads the CREATE INDEX statements saved by indexadvisor.py --save
+    @param path - the path of the file, with one statement per line
+    @return a list of the statements
+    """
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.lstrip().startswith("--")]
 
-    # Speeds up movie year filtering (query 6 and query 7: year 2000)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_movie_year ON Movie(year);")
+def beginFastLoad(db):
+  """
+  Switches the connection to bulk-load settings for a --fast build.
+  Foreign keys are not checked during the load; finishFastLoad checks them
+  all in a single pass afterwards.
+  @param db - a Cursor object for the database connection
+  """
+  print("...Using fast build settings...")
+  for pragma in FAST_PRAGMAS:
+    db.execute(pragma)
+
+def finishFastLoad(db):
+  """
+  Verifies referential integrity after a --fast or parallel build and
+  restores the default journal, sync and foreign key settings
+  @param db - a Cursor object for the database connection
+  @raise sqlite3.IntegrityError if any row violates a foreign key
+  """
+  print("...Checking Foreign Keys...")
+  db.connection.commit()
+  violations = db.execute("PRAGMA foreign_key_check").fetchall()
+  for pragma in SAFE_PRAGMAS:
+    db.execute(pragma)
+  if violations:
+    for table, rowid, parent, fkid in violations[:10]:
+      print("  %s row %s references a missing %s" % (table, rowid, parent))
+    raise sqlite3.IntegrityError("%d foreign key violations" % len(violations))
+
+def shardTableSQL(table):
+  """
+  @param table - the name of a table kept in the shard files
+  @return its CREATE TABLE statement, without the foreign keys to the
+    shared file
+  """
+  return SHARED_FOREIGN_KEY.sub("", TABLE_SQL[table])
+
+def tableIndexes(indexes, tables):
+  """
+  @param indexes - CREATE INDEX statements
+  @param tables - the names of the tables in one file
+  @return the statements on those tables
+  """
+  return [sql for sql in indexes
+          if dictionary.INDEX_TARGET.search(sql).group(2) in tables]
+
+def buildShared(db, paths, batchSize=BATCH_SIZE, indexes=None, stats=None):
+  """
+  Loads (or reloads) Actor and Director into the shared file of a
+  partitioned database, in one transaction
+  @param db - a Cursor object for the shared file, which already has the
+    tables
+  @param paths - a dict mapping each table to its source file
+  @param batchSize - the number of rows per executemany
+  @param indexes - CREATE INDEX statements to run instead of INDEXES
+  @param stats - a buildstats.BuildStats to record each table's load in,
+    or None
+  """
+  print("...Loading Shared Tables...")
+  for table, ncols, keyCols in TABLES:
+    if table in shards.SHARD_TABLES:
+      continue
+    start = time.time()
+    db.execute("DELETE FROM " + table)
+    rows = readRows(paths[table])
+    if stats:
+      rows = stats.timeRows(table, rows)
+    sql = "INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * ncols))
+    count = 0
+    for batch in batches(rows, batchSize):
+      db.executemany(sql, batch)
+      count += len(batch)
+    elapsed = time.time() - start
+    printThroughput(table, count, elapsed)
+    if stats:
+      stats.table(table, count, elapsed)
+    db.execute("INSERT OR REPLACE INTO LoadMeta VALUES (?, ?, ?, ?)",
+               (table, fileChecksum(paths[table]), count,
+                datetime.datetime.now().isoformat()))
+  for sql in tableIndexes(INDEXES if indexes is None else indexes, ("Actor", "Director")):
+    db.execute(sql)
+  db.connection.commit()
 
-    # Speeds up joins on actorID (queries 1, 2, 3, 5, 6, 7)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_casts_actor ON Casts(actorID);")
+def checkShard(conn, sharedFile):
+  """
+  Checks the foreign keys of a shard file, both those within it and those
+  to Actor and Director in the shared file
+  @param conn - a connection to the shard file
+  @param sharedFile - the shared file
+  @raise sqlite3.IntegrityError if any row violates a foreign key
+  """
+  violations = [(table, parent) for table, rowid, parent, fkid
+                in conn.execute("PRAGMA foreign_key_check")]
+  conn.execute("ATTACH DATABASE ? AS shared", (sharedFile,))
+  for table, column, parent in (("Casts", "actorID", "Actor"),
+                                ("DirectsMovie", "directorID", "Director")):
+    missing = conn.execute("""SELECT COUNT(*) FROM main.%s
+                              WHERE %s NOT IN (SELECT id FROM shared.%s)"""
+                           % (table, column, parent)).fetchone()[0]
+    violations += [(table, parent)] * missing
+  conn.execute("DETACH DATABASE shared")
+  if violations:
+    for table, parent in sorted(set(violations))[:10]:
+      print("  %s rows reference a missing %s" % (table, parent))
+    raise sqlite3.IntegrityError("%d foreign key violations" % len(violations))
+
+def buildShards(db, filename, names=None, paths=None, batchSize=BATCH_SIZE,
+                indexes=None, stats=None):
+  """
+  Splits Movie, Casts, DirectsMovie and Genre into the shard files of a
+  partitioned database, in one pass over each source file.  Each movie
+  goes to the shard shards.shardName picks for it, and the other rows go
+  with their movie; rows of a movie missing from Movie go to the shard of
+  a movie without a year (decade layout) or to their hash (hash layout).
+  Every shard is built in a scratch file with its own indexes and
+  checked; only when all of them pass are they swapped in with a rename,
+  so queries never see half a shard.
+  @param db - a Cursor object for the shared file, which already has its
+    ShardLayout
+  @param filename - the shared file
+  @param names - the shards to build, or None for all of them (removing
+    any others)
+  @param paths - a dict mapping each table to its source file
+  @param batchSize - the number of rows per executemany
+  @param indexes - CREATE INDEX statements to run instead of INDEXES
+  @param stats - a buildstats.BuildStats to record each table's load in,
+    or None
+  """
+  print("...Building Shards...")
+  scheme, numShards = shards.layout(db)
+  movieKey = lambda value: int(value) if str(value).strip().lstrip("-").isdigit() else value
+  os.makedirs(shards.shardDir(filename), exist_ok=True)
+  files = {}    # shard -> (scratch file, connection, rows waiting per table)
 
-    # Speeds up joins on movieID (queries 1, 2, 3, 5, 6)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_casts_movie ON Casts(movieID);")
+  def shard(name):
+    if name not in files:
+      scratch = shards.shardFile(filename, name) + ".tmp"
+      if os.path.exists(scratch):
+        os.remove(scratch)
+      conn = sqlite3.connect(scratch)
+      for pragma in FAST_PRAGMAS:
+        conn.execute(pragma)
+      for table in shards.SHARD_TABLES:
+        conn.execute(shardTableSQL(table))
+      files[name] = scratch, conn, {}
+    return files[name]
 
-    # Speeds up grouping by director for prolific directors (query 4)
-    db.execute("CREATE INDEX IF NOT EXISTS idx_directsmovie_director ON DirectsMovie(directorID);")
+  try:
+    movieShard = {}
+    for table, ncols, keyCols in TABLES:
+      if table not in shards.SHARD_TABLES:
+        continue
+      start = time.time()
+      column = shards.SHARD_TABLES[table]
+      sql = "INSERT INTO %s VALUES (%s)" % (table, ", ".join("?" * ncols))
+      rows = readRows(paths[table])
+      if stats:
+        rows = stats.timeRows(table, rows)
+      count = 0
+      for row in rows:
+        count += 1
+        key = movieKey(row[column])
+        if table == "Movie":
+          name = movieShard[key] = shards.shardName(scheme, numShards, key, row[2])
+        else:
+          name = movieShard.get(key) or shards.shardName(scheme, numShards, key, None)
+        if names is not None and name not in names:
+          continue
+        scratch, conn, pending = shard(name)
+        batch = pending.setdefault(table, [])
+        batch.append(row)
+        if len(batch) >= batchSize:
+          conn.executemany(sql, batch)
+          batch.clear()
+      for scratch, conn, pending in files.values():
+        if pending.get(table):
+          conn.executemany(sql, pending.pop(table))
+      elapsed = time.time() - start
+      printThroughput(table, count, elapsed)
+      if stats:
+        stats.table(table, count, elapsed)
+      db.execute("INSERT OR REPLACE INTO LoadMeta VALUES (?, ?, ?, ?)",
+                 (table, fileChecksum(paths[table]), count,
+                  datetime.datetime.now().isoformat()))
+
+    for name in names or ():
+      shard(name)   # a shard left with no rows is still rebuilt, empty
+    #every shard is checked before any is swapped in
+    summary = {}
+    for name, (scratch, conn, pending) in sorted(files.items()):
+      for sql in tableIndexes(INDEXES if indexes is None else indexes, shards.SHARD_TABLES):
+        conn.execute(sql)
+      conn.commit()
+      checkShard(conn, filename)
+      summary[name] = conn.execute(
+          "SELECT MIN(year), MAX(year), COUNT(*) FROM Movie").fetchone()
+    built = datetime.datetime.now().isoformat()
+    for name, (scratch, conn, pending) in sorted(files.items()):
+      minYear, maxYear, movies = summary[name]
+      conn.close()
+      os.replace(scratch, shards.shardFile(filename, name))
+      db.execute("INSERT OR REPLACE INTO Shards VALUES (?, ?, ?, ?, ?, ?)",
+                 (name, os.path.relpath(shards.shardFile(filename, name),
+                                        os.path.dirname(os.path.abspath(filename))),
+                  minYear, maxYear, movies, built))
+      print("  %-13s %10d movies, years %s to %s" % (name, movies, minYear, maxYear))
+
+    if names is None:
+      for (name,) in db.execute("SELECT name FROM Shards").fetchall():
+        if name not in files:
+          db.execute("DELETE FROM Shards WHERE name = ?", (name,))
+          if os.path.exists(shards.shardFile(filename, name)):
+            os.remove(shards.shardFile(filename, name))
+    db.connection.commit()
+  finally:
+    for scratch, conn, pending in files.values():
+      conn.close()
+      if os.path.exists(scratch):
+        os.remove(scratch)
 
 """PROVIDED METHODS BELOW"""
 
@@ -166,58 +931,305 @@ def checkDB(filename):
   Checks to see if the database exists
 
   Determines if a database with the given filename already exists.
-  If so, the user can exit the program, choose to rebuild the DB, or
-  choose to rebuild only the indexes (and keep the data intact)
+  If so, the user can exit the program, choose to rebuild the DB,
+  choose to rebuild only the indexes (and keep the data intact), or
+  apply an incremental update from the source files
 
   @param filename - a str containing the name of the database file
-  @return true if the entire DB should be built, false if only the indexes
-    should be reconstructed, or exits the program
+  @return FULL_BUILD if the entire DB should be built, INDEX_REBUILD if only
+    the indexes should be reconstructed, INCREMENTAL_UPDATE if only the
+    changed rows should be applied, or exits the program
   """
   if os.path.exists(filename):
      choice = -1
-     while(choice not in [0,1,2]):
+     while(choice not in [0,1,2,3]):
          print("File already exists.  Would you like to:")
          print("  0) Exit the program")
          print("  1) Remove the file and rebuild the entire DB")
          print("  2) Keep the file and rebuild the indexes only")
+         print("  3) Keep the file and apply changes from the source files")
          choice = int(input("Enter choice: "))
      if choice == 0:
          print("Exiting...")
          exit(1)
      elif choice == 1:
          os.remove(filename)
-         return True
+         return FULL_BUILD
+     elif choice == 2:
+         return INDEX_REBUILD
      else:
-         return False
-  return True
+         return INCREMENTAL_UPDATE
+  return FULL_BUILD
 
 
 ###########################################################
 # main is complete: you can add functionality, but it is not required
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="createDB.py",
+      description="Creates and populates the movie database")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("--data-dir", default=DATA_DIR,
+      help="directory holding Table.txt (or .txt.gz/.bz2/.xz/.zst) for "
+           "each table (default %(default)s)")
+  parser.add_argument("--source", action="append", default=[],
+      metavar="TABLE=PATH",
+      help="source file for one table, overriding --data-dir; may be repeated")
+  parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+      help="rows per insert batch/transaction (default %(default)s)")
+  parser.add_argument("--fast", action="store_true",
+      help="bulk-load with journaling and fsync off, presorted input and "
+           "a single foreign key check at the end")
+  parser.add_argument("--update", action="store_true",
+      help="if the database exists, apply only the changes in the source "
+           "files instead of asking what to do")
+  parser.add_argument("--indexes", metavar="FILE",
+      help="build the CREATE INDEX statements in FILE (as saved by "
+           "indexadvisor.py --save) instead of the default set")
+  parser.add_argument("--dictionary", action="store_true",
+      help="store Casts.role and Genre.type as ids into Role and GenreType "
+           "lookup tables, behind views with the usual columns (new "
+           "databases only)")
+  parser.add_argument("--summaries", action="store_true",
+      help="also build the summary tables that queries 4, 6 and 7 read "
+           "(triggers keep existing ones current)")
+  parser.add_argument("--search", action="store_true",
+      help="also build the name search tables used by search.py and menu "
+           "option 10 (--update keeps existing ones current)")
+  parser.add_argument("--costar", action="store_true",
+      help="also build the CoStar graph used for co-star and Bacon number "
+           "queries (--update keeps an existing one current)")
+  parser.add_argument("--filmography", action="store_true",
+      help="also build the read-optimized filmography snapshot that "
+           "queries 1 and 2 read (--update keeps an existing one "
+           "current)")
+  parser.add_argument("--shard-by", choices=shards.SCHEMES,
+      help="partition Movie, Casts, DirectsMovie and Genre into shard files "
+           "by each movie's decade or a hash of its id, keeping Actor and "
+           "Director in the database file (new databases only)")
+  parser.add_argument("--shards", type=int, default=shards.HASH_SHARDS,
+      help="number of shards of --shard-by hash (default %(default)s)")
+  parser.add_argument("--rebuild-shard", action="append", default=[],
+      metavar="NAME",
+      help="rebuild one shard of a partitioned database from the source "
+           "files, or 'shared' for Actor and Director; may be repeated")
+  parser.add_argument("--publish", metavar="FILE",
+      help="after the build, write a compacted, analyzed and versioned "
+           "read-only snapshot of the database to FILE for queryDB.py and "
+           "server.py (replacing any earlier one)")
+  parser.add_argument("--page-size", type=int, default=publish.PAGE_SIZE,
+      choices=publish.PAGE_SIZES,
+      help="page size of the --publish snapshot (default %(default)s)")
+  parser.add_argument("--jobs", type=int, default=1,
+      help="number of worker processes loading tables in parallel "
+           "(default %(default)s)")
+  parser.add_argument("--stats", metavar="FILE",
+      help="write the time, rows/sec, file size and peak memory of each "
+           "build phase and table to FILE as JSON, and print a summary")
+  parser.add_argument("--profile", metavar="FILE",
+      help="run the build under cProfile and save the statistics to FILE "
+           "(worker processes of --jobs are not profiled)")
+  parser.add_argument("--trace-memory", action="store_true",
+      help="trace Python allocations with tracemalloc and report the peak "
+           "of each phase and the largest allocation sites")
+  args = parser.parse_args(argv)
+  if args.batch_size < 1:
+    parser.error("--batch-size must be at least 1")
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+  if args.shards < 1:
+    parser.error("--shards must be at least 1")
+  if (args.shard_by or args.rebuild_shard) and (args.dictionary or args.costar
+      or args.filmography or args.publish or args.jobs > 1):
+    parser.error("--dictionary, --costar, --filmography, --publish and --jobs "
+                 "cannot be used with a partitioned database")
+  args.paths = {}
+  for source in args.source:
+    table, sep, path = source.partition("=")
+    if not sep or table not in TABLE_NAMES:
+      parser.error("--source must be TABLE=PATH with TABLE one of "
+                   + ", ".join(TABLE_NAMES))
+    args.paths[table] = path
+  return args
+
+def buildPartitioned(args, conn, mode, paths, stats):
+  """
+  Builds a partitioned database (see shards.py), or rebuilds some of its
+  shards
+  @param args - the parsed command line
+  @param conn - a connection to the shared file
+  @param mode - FULL_BUILD, SHARD_REBUILD, or what checkDB chose for an
+    existing file
+  @param paths - a dict mapping each table to its source file
+  @param stats - the build's buildstats.BuildStats
+  @return the exit status
+  """
+  db = conn.cursor()
+  indexes = readIndexFile(args.indexes) if args.indexes else None
+  if mode == FULL_BUILD:
+      print("Creating new partitioned movie database!\n")
+      with stats.phase("tables"):
+          print("...Creating Tables ...")
+          for table in TABLE_NAMES:
+              if table not in shards.SHARD_TABLES:
+                  db.execute(TABLE_SQL[table])
+          db.execute(LOADMETA_SQL)
+          db.execute(shards.LAYOUT_SQL)
+          db.execute(shards.SHARDS_SQL)
+          db.execute("INSERT INTO ShardLayout VALUES (?, ?)", (args.shard_by, args.shards))
+      with stats.phase("shared"):
+          buildShared(db, paths, args.batch_size, indexes, stats)
+      with stats.phase("shards"):
+          buildShards(db, args.filename, None, paths, args.batch_size, indexes,
+                      stats)
+      return 0
+
+  if not shards.isSharded(db):
+      print("Error: %s is not a partitioned database; remove it to build one"
+            % args.filename)
+      return 1
+  if mode != SHARD_REBUILD:
+      print("Error: %s is partitioned; rebuild its shards with --rebuild-shard"
+            % args.filename)
+      return 1
+  names = set(args.rebuild_shard)
+  known = [row[0] for row in db.execute("SELECT name FROM Shards ORDER BY name")]
+  unknown = names - set(known) - {shards.SHARED}
+  if unknown:
+      print("Error: no shard %s; the shards are %s" % (", ".join(sorted(unknown)),
+                                                      ", ".join(known)))
+      return 1
+  if shards.SHARED in names:
+      with stats.phase("shared"):
+          buildShared(db, paths, args.batch_size, indexes, stats)
+      #the shards not rebuilt must still match the new Actor and Director
+      with stats.phase("foreignKeys"):
+          print("...Checking Foreign Keys...")
+          for name in known:
+              if name not in names:
+                  shardConn = sqlite3.connect(shards.shardFile(args.filename, name))
+                  try:
+                      checkShard(shardConn, args.filename)
+                  finally:
+                      shardConn.close()
+  if names - {shards.SHARED}:
+      with stats.phase("shards"):
+          buildShards(db, args.filename, names - {shards.SHARED}, paths,
+                      args.batch_size, indexes, stats)
+  return 0
+
 def main():
-  if(len(sys.argv) != 2):
-      print("Error: Incorrect arguments")
-      print("Usage: python3 createDB.py databaseName")
-      return(1)
-  filename = sys.argv[1] #uses command line argument
-  fullbuild = checkDB(filename)
+  args = parseArgs(sys.argv[1:])
+  filename = args.filename
+  if args.rebuild_shard:
+      if not os.path.exists(filename):
+          print("Error: %s does not exist" % filename)
+          return(1)
+      mode = SHARD_REBUILD
+  elif args.update and os.path.exists(filename):
+      mode = INCREMENTAL_UPDATE
+  else:
+      mode = checkDB(filename)
 
 
   #This is how we connect to a sqlite database
   #If the database doesn't exist, sqlite will create it
+  try:
+      paths = sources.findSources(TABLE_NAMES, args.data_dir, args.paths)
+  except FileNotFoundError as e:
+      if mode == INDEX_REBUILD:
+          paths = None   #the source files are not needed
+      else:
+          print("Error: %s" % e)
+          return(1)
+
   conn = sqlite3.connect(filename)  #Open connection
   conn.text_factory = str           #Deals with string issues
   db = conn.cursor()                #A cursor takes in the sql commands
 
-  if(fullbuild): #only create table and insert entries if building a new db
+  #every phase is timed; the report is only kept if it was asked for
+  stats = buildstats.BuildStats(filename, mode, args.profile, args.trace_memory)
+
+  #a partitioned database has its own build, over its shard files
+  if args.shard_by or mode == SHARD_REBUILD or (mode != FULL_BUILD and shards.isSharded(db)):
+      status = buildPartitioned(args, conn, mode, paths, stats)
+      report = stats.finish()
+      if args.stats or args.profile or args.trace_memory:
+          buildstats.printSummary(report)
+      if args.stats:
+          buildstats.writeReport(report, args.stats)
+      return status
+
+  if(mode == FULL_BUILD): #only create table and insert entries if building a new db
       print("Creating new movie database!\n")
-      createTables(db)
-      insertAll(db)
+      with stats.phase("tables"):
+          createTables(db, args.dictionary)
+          if args.fast:
+              beginFastLoad(db)
+      with stats.phase("insert"):
+          if args.jobs > 1:
+              insertAllParallel(db, args.jobs, args.batch_size, paths, stats)
+          else:
+              insertAll(db, args.batch_size, presort=args.fast, paths=paths,
+                        stats=stats)
+  elif(mode == INCREMENTAL_UPDATE): #indexes are maintained by the update
+      with stats.phase("update"):
+          updateAll(db, args.batch_size, paths, stats)
   else:
-      dropIndexes(db)
+      with stats.phase("dropIndexes"):
+          dropIndexes(db)
+
+  with stats.phase("indexes"):
+      createIndexes(db, readIndexFile(args.indexes) if args.indexes else None)
+      conn.commit()
+  if mode == FULL_BUILD and (args.fast or args.jobs > 1):
+      with stats.phase("foreignKeys"):
+          finishFastLoad(db)
+
+  #the summary tables are kept current by triggers once they exist
+  if args.summaries or summaries.hasSummaries(db):
+      with stats.phase("summaries"):
+          summaries.ensureSummaries(conn)
+
+  #the derived tables that exist were brought up to date by an update
+  if args.search or search.hasSearch(db):
+      with stats.phase("search"):
+          search.ensureSearch(conn)
+
+  updated = (mode == INCREMENTAL_UPDATE)
+  if args.costar and not (updated and costar.hasCoStar(db)):
+      print("...Building CoStar...")
+      with stats.phase("costar"):
+          start = time.time()
+          edges = costar.buildCoStar(conn)
+      print("  %d edges in %.2f seconds" % (edges, time.time() - start))
+
+  if args.filmography and not (updated and filmography.hasFilmography(db)):
+      print("...Building Filmography Snapshot...")
+      with stats.phase("filmography"):
+          start = time.time()
+          pairs = filmography.buildFilmography(conn)
+      print("  %d filmography entries in %.2f seconds" % (pairs, time.time() - start))
+
+  #the snapshot is taken last, of the finished database
+  if args.publish:
+      print("...Publishing Snapshot...")
+      with stats.phase("publish"):
+          start = time.time()
+          info = publish.publishSnapshot(conn, args.publish, args.page_size)
+      print("  version %s of %s, %d bytes, in %.2f seconds"
+            % (info["version"], args.publish, os.path.getsize(args.publish),
+               time.time() - start))
 
-  createIndexes(db)
-  conn.commit()
+  report = stats.finish()
+  if args.stats or args.profile or args.trace_memory:
+      buildstats.printSummary(report)
+  if args.stats:
+      buildstats.writeReport(report, args.stats)
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
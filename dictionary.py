@@ -0,0 +1,207 @@
+"""
+dictionary.py
+
+Description: The dictionary-encoded schema built by createdb.py
+--dictionary.  Casts.role and Genre.type repeat a small vocabulary on
+millions of rows, so each distinct string is stored once, in the Role
+and GenreType tables.  Casts and Genre are kept in CastsCoded and
+GenreCoded, which hold the string's integer id instead.  Both are
+WITHOUT ROWID tables clustered on their primary key, so the key is not
+stored a second time in a separate index.
+
+Casts and Genre become views with the original column names, so the SQL
+of queryDB.py and the other tools reads them unchanged.  The role and type
+strings are looked up with a correlated subquery: a query that does not
+select them never touches the dictionaries.  INSTEAD OF triggers turn
+inserts, deletes and updates of the views into changes to the coded
+tables, adding new strings to the dictionaries as they appear, so the
+loaders write to Casts and Genre as before.  Bulk loads use insertCoded,
+which encodes a whole staged table with two set-based statements instead.
+Indexes and triggers cannot be placed on a view; retargetIndex and
+baseTable give the coded table to use instead.
+"""
+
+import re
+import sqlite3
+
+# The views and, for each, the coded table behind it, its dictionary and
+# the string column replaced by an id
+CODED = {
+  "Casts": ("CastsCoded", "Role", "role", "roleID"),
+  "Genre": ("GenreCoded", "GenreType", "type", "typeID"),
+}
+
+# CREATE statements of the encoded schema, in dependency order
+DICTIONARY_SQL = {
+  "Role": """CREATE TABLE Role (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(50) NOT NULL UNIQUE
+  )""",
+
+  "GenreType": """CREATE TABLE GenreType (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(50) NOT NULL UNIQUE
+  )""",
+
+  "CastsCoded": """CREATE TABLE CastsCoded (
+    actorID INTEGER,
+    movieID INTEGER,
+    roleID INTEGER,
+    PRIMARY KEY (actorID, movieID, roleID),
+    FOREIGN KEY (actorID) REFERENCES Actor(id),
+    FOREIGN KEY (movieID) REFERENCES Movie(id),
+    FOREIGN KEY (roleID) REFERENCES Role(id)
+  ) WITHOUT ROWID""",
+
+  "GenreCoded": """CREATE TABLE GenreCoded (
+    movieID INTEGER,
+    typeID INTEGER,
+    PRIMARY KEY (movieID, typeID),
+    FOREIGN KEY (typeID) REFERENCES GenreType(id)
+  ) WITHOUT ROWID""",
+
+  "Casts": """CREATE VIEW Casts (actorID, movieID, role) AS
+    SELECT C.actorID, C.movieID,
+           (SELECT R.name FROM Role AS R WHERE R.id = C.roleID)
+    FROM CastsCoded AS C""",
+
+  "Genre": """CREATE VIEW Genre (movieID, type) AS
+    SELECT G.movieID,
+           (SELECT T.name FROM GenreType AS T WHERE T.id = G.typeID)
+    FROM GenreCoded AS G""",
+}
+
+# Triggers that write changes to the views through to the coded tables.
+# A conflict clause on the statement that fires them (INSERT OR IGNORE
+# INTO Casts ...) applies to the statements inside, as for a table.
+TRIGGERS = [
+  """CREATE TRIGGER casts_insert_dictionary INSTEAD OF INSERT ON Casts
+  BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: Casts.role')
+    WHERE NEW.role IS NULL;
+    INSERT OR IGNORE INTO Role (name) VALUES (NEW.role);
+    INSERT INTO CastsCoded (actorID, movieID, roleID)
+    SELECT NEW.actorID, NEW.movieID, id FROM Role WHERE name = NEW.role;
+  END""",
+
+  """CREATE TRIGGER casts_delete_dictionary INSTEAD OF DELETE ON Casts
+  BEGIN
+    DELETE FROM CastsCoded
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID
+      AND roleID = (SELECT id FROM Role WHERE name = OLD.role);
+  END""",
+
+  """CREATE TRIGGER casts_update_dictionary INSTEAD OF UPDATE ON Casts
+  BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: Casts.role')
+    WHERE NEW.role IS NULL;
+    INSERT OR IGNORE INTO Role (name) VALUES (NEW.role);
+    UPDATE CastsCoded
+    SET actorID = NEW.actorID, movieID = NEW.movieID,
+        roleID = (SELECT id FROM Role WHERE name = NEW.role)
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID
+      AND roleID = (SELECT id FROM Role WHERE name = OLD.role);
+  END""",
+
+  """CREATE TRIGGER genre_insert_dictionary INSTEAD OF INSERT ON Genre
+  BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: Genre.type')
+    WHERE NEW.type IS NULL;
+    INSERT OR IGNORE INTO GenreType (name) VALUES (NEW.type);
+    INSERT INTO GenreCoded (movieID, typeID)
+    SELECT NEW.movieID, id FROM GenreType WHERE name = NEW.type;
+  END""",
+
+  """CREATE TRIGGER genre_delete_dictionary INSTEAD OF DELETE ON Genre
+  BEGIN
+    DELETE FROM GenreCoded
+    WHERE movieID = OLD.movieID
+      AND typeID = (SELECT id FROM GenreType WHERE name = OLD.type);
+  END""",
+
+  """CREATE TRIGGER genre_update_dictionary INSTEAD OF UPDATE ON Genre
+  BEGIN
+    SELECT RAISE(ABORT, 'NOT NULL constraint failed: Genre.type')
+    WHERE NEW.type IS NULL;
+    INSERT OR IGNORE INTO GenreType (name) VALUES (NEW.type);
+    UPDATE GenreCoded
+    SET movieID = NEW.movieID,
+        typeID = (SELECT id FROM GenreType WHERE name = NEW.type)
+    WHERE movieID = OLD.movieID
+      AND typeID = (SELECT id FROM GenreType WHERE name = OLD.type);
+  END""",
+]
+
+INDEX_TARGET = re.compile(r"(\bON\s+)(\w+)(\s*\()(.*)(\))", re.I | re.S)
+
+def createSchema(db):
+  """
+  Creates the dictionaries, the coded tables, the views over them and the
+  triggers that write through the views
+  @param db - the database connection or cursor
+  """
+  for name in DICTIONARY_SQL:
+    db.execute(DICTIONARY_SQL[name])
+  for sql in TRIGGERS:
+    db.execute(sql)
+
+def isEncoded(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the database has the dictionary-encoded schema
+  """
+  return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'CastsCoded'").fetchone() is not None
+
+def baseTable(db, table):
+  """
+  @param db - the database connection or cursor
+  @param table - the name of one of the core tables
+  @return the table that holds its rows: the coded table if table is a
+    view of the encoded schema, otherwise table itself
+  """
+  if table in CODED and isEncoded(db):
+    return CODED[table][0]
+  return table
+
+def insertCoded(db, view, source):
+  """
+  Copies the rows of a plain table into one of the views, for bulk loads.
+  New strings are added to the dictionary in one pass, and the rows are
+  then inserted with their ids, in primary key order, so the coded
+  table's B-tree is filled by appending.
+  @param db - the database connection or cursor
+  @param view - "Casts" or "Genre"
+  @param source - the table to copy from, with the view's columns
+  @raise sqlite3.IntegrityError if a row has no string to encode
+  """
+  coded, dictionary, column, idColumn = CODED[view]
+  cols = [row[1] for row in db.execute("PRAGMA main.table_info(%s)" % view)]
+  if db.execute("SELECT 1 FROM %s WHERE %s IS NULL LIMIT 1"
+                % (source, column)).fetchone() is not None:
+    raise sqlite3.IntegrityError("NOT NULL constraint failed: %s.%s" % (view, column))
+  db.execute("INSERT OR IGNORE INTO main.%s (name) SELECT DISTINCT %s FROM %s"
+             % (dictionary, column, source))
+  select = ", ".join("D.id" if col == column else "S." + col for col in cols)
+  db.execute("""INSERT INTO main.%s
+                SELECT %s FROM %s AS S JOIN main.%s AS D ON D.name = S.%s
+                ORDER BY %s"""
+             % (coded, select, source, dictionary, column,
+                ", ".join(str(i + 1) for i in range(len(cols)))))
+
+def retargetIndex(db, sql):
+  """
+  Points a CREATE INDEX statement on Casts or Genre at the coded table
+  when the database is encoded, since a view cannot be indexed.  The
+  string column becomes its id column, which serves equality lookups
+  through the dictionary.
+  @param db - the database connection or cursor
+  @param sql - a CREATE INDEX statement
+  @return the statement to run
+  """
+  m = INDEX_TARGET.search(sql)
+  if m is None or m.group(2) not in CODED or not isEncoded(db):
+    return sql
+  coded, unused, column, idColumn = CODED[m.group(2)]
+  cols = re.sub(r"\b%s\b" % column, idColumn, m.group(4))
+  return sql[:m.start()] + m.group(1) + coded + m.group(3) + cols + m.group(5) + sql[m.end():]
@@ -0,0 +1,176 @@
+"""
+filmography.py
+
+Description: A read-optimized snapshot of the two lookups by name.
+ActorFilmography holds the distinct titles of each actor name's movies,
+and MovieCast the distinct actor names of each title.  Both are joined
+and de-duplicated once, when the snapshot is built.  Both are WITHOUT
+ROWID tables clustered on the lookup key followed by the sort key:
+(fname, lname, title) and (title, fname, lname).  Query 2 (an actor's
+filmography) and query 1 (a movie's cast) then read one contiguous range
+of a B-tree, already in output order, with no join, DISTINCT or sort.
+
+The snapshot is derived from Actor, Casts and Movie.  createdb.py
+--filmography builds it.  --update keeps it current with
+updateFilmography, which recomputes the entries of just the actor names
+the changed rows touch.  Lookups compare names with =, which never matches NULL, so rows
+with a NULL name or title are left out.  The loader stores missing
+fields as empty strings, never NULL.
+
+Usage: python3 filmography.py databaseName
+  (re)builds the snapshot of an existing database
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# CREATE TABLE statement for each snapshot table
+FILMOGRAPHY_SQL = {
+  "ActorFilmography": """CREATE TABLE ActorFilmography (
+    fname VARCHAR(30),
+    lname VARCHAR(30),
+    title VARCHAR(30),
+    PRIMARY KEY (fname, lname, title)
+  ) WITHOUT ROWID""",
+
+  "MovieCast": """CREATE TABLE MovieCast (
+    title VARCHAR(30),
+    fname VARCHAR(30),
+    lname VARCHAR(30),
+    PRIMARY KEY (title, fname, lname)
+  ) WITHOUT ROWID""",
+}
+
+# Statements that fill each table, with its rows in primary key order so
+# the B-tree is filled by appending
+FILL_SQL = {
+  "ActorFilmography": """
+    INSERT INTO ActorFilmography (fname, lname, title)
+    SELECT DISTINCT A.fname, A.lname, M.title
+    FROM Actor AS A
+    JOIN Casts AS C ON A.id = C.actorID
+    JOIN Movie AS M ON C.movieID = M.id
+    WHERE A.fname IS NOT NULL AND A.lname IS NOT NULL AND M.title IS NOT NULL
+    ORDER BY 1, 2, 3""",
+
+  "MovieCast": """
+    INSERT INTO MovieCast (title, fname, lname)
+    SELECT title, fname, lname
+    FROM ActorFilmography
+    ORDER BY 1, 2, 3""",
+}
+
+# A set of names, passed as a JSON array of [fname, lname] arrays
+NAMES_SQL = """
+    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+    FROM json_each(?)"""
+
+# Statements that recompute the entries of a set of names (NAMES_SQL):
+# the old ones are deleted, MovieCast's first since they are found through
+# ActorFilmography, and the current ones filled in again
+REFRESH_SQL = [
+  """DELETE FROM MovieCast WHERE (title, fname, lname) IN
+     (SELECT title, fname, lname FROM ActorFilmography
+      WHERE (fname, lname) IN (%s))""" % NAMES_SQL,
+
+  "DELETE FROM ActorFilmography WHERE (fname, lname) IN (%s)" % NAMES_SQL,
+
+  """INSERT INTO ActorFilmography (fname, lname, title)
+     SELECT DISTINCT A.fname, A.lname, M.title
+     FROM Actor AS A
+     JOIN Casts AS C ON A.id = C.actorID
+     JOIN Movie AS M ON C.movieID = M.id
+     WHERE (A.fname, A.lname) IN (%s) AND M.title IS NOT NULL""" % NAMES_SQL,
+
+  """INSERT INTO MovieCast (title, fname, lname)
+     SELECT title, fname, lname
+     FROM ActorFilmography
+     WHERE (fname, lname) IN (%s)""" % NAMES_SQL,
+]
+
+def hasFilmography(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the snapshot tables have been built
+  """
+  names = [row[0] for row in db.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table'")]
+  return all(table in names for table in FILMOGRAPHY_SQL)
+
+def dropFilmography(db):
+  """
+  Removes the snapshot tables
+  @param db - the database connection or cursor
+  """
+  for table in FILMOGRAPHY_SQL:
+    db.execute("DROP TABLE IF EXISTS " + table)
+
+def buildFilmography(db):
+  """
+  Builds (or rebuilds) the snapshot from Actor, Casts and Movie
+  @param db - the database connection
+  @return the number of (actor name, title) pairs stored
+  """
+  dropFilmography(db)
+  for table in FILMOGRAPHY_SQL:
+    db.execute(FILMOGRAPHY_SQL[table])
+    db.execute(FILL_SQL[table])
+  db.commit()
+  return db.execute("SELECT COUNT(*) FROM ActorFilmography").fetchone()[0]
+
+def actorNames(db, actorIDs, movieIDs):
+  """
+  Finds the names whose entries depend on some actors and movies.  Called
+  before and after a change, it gives the old and the new names.
+  @param db - the database connection or cursor
+  @param actorIDs - the ids of the actors
+  @param movieIDs - the ids of the movies, whose casts are included
+  @return a set of (fname, lname) tuples
+  """
+  return set(db.execute("""
+    SELECT fname, lname FROM Actor
+    WHERE id IN (SELECT value FROM json_each(?))
+       OR id IN (SELECT actorID FROM Casts
+                 WHERE movieID IN (SELECT value FROM json_each(?)))""",
+    (json.dumps(sorted(actorIDs)), json.dumps(sorted(movieIDs)))).fetchall())
+
+def updateFilmography(db, names):
+  """
+  Recomputes the snapshot entries of some actor names, after rows of
+  Actor, Casts or Movie about them changed.  Nothing is committed.
+  @param db - the database connection or cursor
+  @param names - the (fname, lname) tuples to recompute, as found by
+    actorNames before and after the change
+  @return the number of (actor name, title) pairs now stored for them
+  """
+  names = json.dumps(sorted(name for name in names if None not in name))
+  for sql in REFRESH_SQL:
+    db.execute(sql, (names,))
+  return db.execute("SELECT COUNT(*) FROM ActorFilmography WHERE (fname, lname) IN (%s)"
+                    % NAMES_SQL, (names,)).fetchone()[0]
+
+############### main program ###########################
+def main():
+
+  if len(sys.argv) != 2:
+    print("Error: Incorrect arguments")
+    print("Usage: python3 filmography.py databaseName")
+    return 1
+
+  if not os.path.exists(sys.argv[1]):
+    print("Error: file does not exist")
+    return 1
+
+  db = sqlite3.connect(sys.argv[1])
+  print("...Building Filmography Snapshot...")
+  start = time.time()
+  pairs = buildFilmography(db)
+  print("  %d filmography entries in %.2f seconds" % (pairs, time.time() - start))
+  db.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+gendata.py
+
+Description: Writes a synthetic movie database in the pipe-delimited
+format createdb.py loads: Actor.txt, Movie.txt, Director.txt, Casts.txt,
+DirectsMovie.txt and Genre.txt.  The scale is set by the number of Casts
+rows (from about 10k to 50M); the other tables are sized in proportion.
+Participation is skewed the way the IMDb data is: most actors and
+directors appear a handful of times, while a few (Kevin Bacon among them)
+are very prolific.  The same seed always produces the same files.  Rows
+are written as they are generated, so memory use does not depend on the
+scale.
+
+Usage: python3 gendata.py outputDir [--casts N] [--seed S] [--skew F]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+# Rows of the other tables per Casts row
+ACTORS_PER_CAST = 0.3
+MOVIES_PER_CAST = 0.1
+DIRECTORS_PER_MOVIE = 0.25
+
+# Fraction of cast and director slots filled from the heavy tail, where
+# the chance of picking id k falls off as 1/k; the rest are uniform
+SKEW = 0.02
+
+# Movies in which one actor plays several roles, and the most roles
+MULTI_ROLE_RATE = 0.005
+MAX_ROLES = 8
+
+# Lines buffered before each write
+WRITE_LINES = 10000
+
+FIRST_NAMES = ["James", "Mary", "John", "Patricia", "Robert", "Jennifer",
+               "Michael", "Linda", "William", "Elizabeth", "David", "Barbara",
+               "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah",
+               "Charles", "Karen", "Meg", "Cary", "Robin", "Billy", "Mandy",
+               "Chris", "Anna", "José", "Zoë", "Søren"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia",
+              "Miller", "Davis", "Rodriguez", "Martinez", "Hernandez",
+              "Lopez", "Wilson", "Anderson", "Taylor", "Moore", "Jackson",
+              "Martin", "Lee", "Thompson", "Ryan", "Elwes", "Wright",
+              "Crystal", "Patinkin", "Guest", "Núñez", "O'Brien", "Müller",
+              "Nakamura"]
+TITLE_WORDS = ["Night", "Return", "Love", "City", "Last", "Dark", "Man",
+               "Story", "Blue", "House", "War", "Secret", "Summer", "King",
+               "Dead", "Girl", "Road", "Heart", "Fire", "Dream"]
+ROLES = ["Himself", "Herself", "Narrator", "Extra", "Guard", "Waiter",
+         "Doctor", "Detective", "Reporter", "Bartender", "Nurse", "Soldier"]
+GENRES = ["Drama", "Comedy", "Action", "Thriller", "Romance", "Horror",
+          "Documentary", "Crime", "Adventure", "Family", "Sci-Fi", "Western"]
+
+# Well-known rows the menu queries look for.  Kevin Bacon and Tom Hanks get
+# small ids, which the skewed draw makes prolific; the two titles are the
+# movies queries 1 and 8 list the cast of.
+NAMED_ACTORS = {3: ("Kevin", "Bacon", "M"), 5: ("Tom", "Hanks", "M")}
+NAMED_MOVIES = {7: "The Princess Bride", 11: "The Mexican"}
+
+def skewedID(rng, n, skew):
+  """
+  Picks an id from 1 to n, from the heavy tail with probability skew
+  @param rng - the random.Random to draw from
+  @param n - the largest id
+  @param skew - the chance of drawing from the tail
+  @return the id
+  """
+  if rng.random() < skew:
+    # log-uniform: P(id <= k) = log k / log n
+    return min(n, int(math.exp(rng.random() * math.log(n + 1))))
+  return rng.randint(1, n)
+
+class TableWriter:
+  """
+  Buffers the lines of one source file and counts them
+  """
+
+  def __init__(self, outputDir, table):
+    self.f = open(os.path.join(outputDir, table + ".txt"), "w", encoding="utf-8")
+    self.lines = []
+    self.count = 0
+
+  def write(self, *fields):
+    self.lines.append("|".join(str(field) for field in fields))
+    if len(self.lines) >= WRITE_LINES:
+      self.flush()
+
+  def flush(self):
+    if self.lines:
+      self.f.write("\n".join(self.lines) + "\n")
+      self.count += len(self.lines)
+      self.lines = []
+
+  def close(self):
+    self.flush()
+    self.f.close()
+
+def generate(outputDir, casts, seed=1, skew=SKEW):
+  """
+  Writes the six source files
+  @param outputDir - the directory to write them to (created if needed)
+  @param casts - the target number of Casts rows
+  @param seed - the random seed
+  @param skew - the fraction of slots filled from the heavy tail
+  @return a dict mapping each table to the number of rows written
+  """
+  rng = random.Random(seed)
+  os.makedirs(outputDir, exist_ok=True)
+  numActors = max(len(NAMED_ACTORS) + 2, int(casts * ACTORS_PER_CAST))
+  numMovies = max(max(NAMED_MOVIES), int(casts * MOVIES_PER_CAST))
+  numDirectors = max(1, int(numMovies * DIRECTORS_PER_MOVIE))
+  castSize = casts / numMovies
+
+  actor = TableWriter(outputDir, "Actor")
+  for i in range(1, numActors + 1):
+    if i in NAMED_ACTORS:
+      actor.write(i, *NAMED_ACTORS[i])
+    else:
+      actor.write(i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES) + str(i % 997),
+                  rng.choice("MF"))
+  actor.close()
+
+  movie = TableWriter(outputDir, "Movie")
+  for i in range(1, numMovies + 1):
+    title = NAMED_MOVIES.get(i) or "%s %s %d" % (rng.choice(TITLE_WORDS),
+                                                  rng.choice(TITLE_WORDS), i)
+    # more movies in recent years
+    year = 2015 - int(115 * rng.random() ** 2)
+    movie.write(i, title, year)
+  movie.close()
+
+  director = TableWriter(outputDir, "Director")
+  for i in range(1, numDirectors + 1):
+    director.write(i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES) + str(i % 997))
+  director.close()
+
+  cast = TableWriter(outputDir, "Casts")
+  directs = TableWriter(outputDir, "DirectsMovie")
+  genre = TableWriter(outputDir, "Genre")
+  for m in range(1, numMovies + 1):
+    size = max(1, int(rng.expovariate(1 / castSize) + 0.5))
+    actors = set()
+    while len(actors) < min(size, numActors):
+      actors.add(skewedID(rng, numActors, skew))
+    for a in sorted(actors):
+      if rng.random() < MULTI_ROLE_RATE:
+        for r in range(rng.randint(2, MAX_ROLES)):
+          cast.write(a, m, "Character %d" % (r + 1))
+      else:
+        cast.write(a, m, rng.choice(ROLES))
+
+    directors = {skewedID(rng, numDirectors, skew)}
+    if rng.random() < 0.1:
+      directors.add(rng.randint(1, numDirectors))
+    for d in sorted(directors):
+      directs.write(d, m)
+
+    for g in sorted(rng.sample(GENRES, rng.randint(1, 3))):
+      genre.write(m, g)
+  for writer in (cast, directs, genre):
+    writer.close()
+
+  return {"Actor": actor.count, "Movie": movie.count, "Director": director.count,
+          "Casts": cast.count, "DirectsMovie": directs.count, "Genre": genre.count}
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="gendata.py",
+      description="Writes synthetic source files for createdb.py")
+  parser.add_argument("outputDir", help="directory to write Table.txt files to")
+  parser.add_argument("--casts", type=int, default=100000,
+      help="approximate number of Casts rows (default %(default)s)")
+  parser.add_argument("--seed", type=int, default=1,
+      help="random seed (default %(default)s)")
+  parser.add_argument("--skew", type=float, default=SKEW,
+      help="fraction of cast and director slots drawn from the heavy tail "
+           "(default %(default)s)")
+  args = parser.parse_args(argv)
+  if args.casts < 100:
+    parser.error("--casts must be at least 100")
+  if not 0 <= args.skew <= 1:
+    parser.error("--skew must be between 0 and 1")
+  return args
+
+def main():
+  args = parseArgs(sys.argv[1:])
+  start = time.time()
+  counts = generate(args.outputDir, args.casts, args.seed, args.skew)
+  for table, count in counts.items():
+    print("  %-13s %10d rows" % (table, count))
+  print("Generated in %.2f seconds" % (time.time() - start))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,470 @@
+"""
+indexadvisor.py
+
+Description: Chooses the secondary indexes for the movie database from the
+queries that run against it.  Each query is run under EXPLAIN QUERY PLAN
+and its joins and filters are used to propose (covering) indexes.  Every
+candidate is then built, measured (build time, size on disk and query
+speedup) and dropped, and only the set of indexes that pays for itself is
+kept.  Any query still doing a full table SCAN is reported.
+
+Usage: python3 indexadvisor.py databaseName [--workload FILE] [--runs N]
+                                            [--timeout SECONDS] [--save FILE]
+                                            [--apply]
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+import createdb
+import dictionary
+import querycancel
+import queryregistry
+
+# An index is only kept if it makes some query faster by at least this
+# fraction of its current time, and by at least MIN_GAIN_SECONDS
+MIN_GAIN_FRACTION = 0.05
+MIN_GAIN_SECONDS = 0.001
+
+# Default limit on a single query run, in seconds.  Without the right
+# indexes some queries take far longer than is useful to measure; a run that
+# hits the limit is recorded as taking the limit.
+QUERY_TIMEOUT = 30
+
+# Words that can follow a table name in FROM/JOIN but are not an alias
+KEYWORDS = {"ON", "WHERE", "JOIN", "GROUP", "ORDER", "INNER", "LEFT", "CROSS",
+            "NATURAL", "LIMIT", "HAVING", "UNION", "INTERSECT", "EXCEPT", "USING"}
+
+def loadWorkload(path):
+  """
+  Reads a captured workload file.  Each line is a JSON object with the
+  query's "name", its "sql" and optionally its "params".
+  @param path - the path of the workload file
+  @return a list of (name, sql, params) tuples
+  """
+  workload = []
+  with open(path) as f:
+    for line in f:
+      if line.strip():
+        entry = json.loads(line)
+        workload.append((entry["name"], entry["sql"], tuple(entry.get("params", ()))))
+  return workload
+
+########### PARSING QUERIES AND PLANS ##########
+
+def tableAliases(sql):
+  """
+  @param sql - a query
+  @return a dict mapping each alias in the FROM/JOIN clauses to its table
+    (a table without an alias maps to itself)
+  """
+  aliases = {}
+  for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.I):
+    if not alias or alias.upper() in KEYWORDS:
+      alias = table
+    aliases[alias] = table
+  return aliases
+
+def columnUse(sql, aliases, tableColumns):
+  """
+  Works out how a query uses the columns of each table it reads
+  @param sql - a query
+  @param aliases - the query's aliases, from tableAliases
+  @param tableColumns - a dict mapping each table to its column names
+  @return a dict mapping each alias to a dict of column lists: "filter"
+    (compared with a constant, parameter or subquery), "join" (equated
+    with another table's column) and "refs" (every column referenced)
+  """
+  use = dict((alias, {"filter": [], "join": [], "refs": []}) for alias in aliases)
+
+  def add(alias, kind, col):
+    if alias in use and col in tableColumns[aliases[alias]] and col not in use[alias][kind]:
+      use[alias][kind].append(col)
+
+  for a1, c1, a2, c2 in re.findall(r"(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)", sql):
+    add(a1, "join", c1)
+    add(a2, "join", c2)
+  for alias, col in re.findall(r"(\w+)\.(\w+)\s*(?:=|>=|<=|>|<|\bIN\b)\s*[?'\d(]", sql, re.I):
+    add(alias, "filter", col)
+  for alias, col in re.findall(r"(\w+)\.(\w+)", sql):
+    add(alias, "refs", col)
+
+  # unqualified columns can only belong to a table used without an alias
+  for alias, table in aliases.items():
+    if alias == table:
+      for col in re.findall(r"(?<![.\w])(\w+)\s*(?:=|>=|<=|>|<|\bIN\b)\s*[?'\d(]", sql, re.I):
+        add(alias, "filter", col)
+      for col in re.findall(r"(?<![.\w])(\w+)(?![.\w])", sql):
+        add(alias, "refs", col)
+  return use
+
+def explain(db, sql, params=()):
+  """
+  @param db - the database cursor
+  @param sql - a query
+  @param params - the query's parameters
+  @return the detail lines of the query's EXPLAIN QUERY PLAN
+  """
+  return [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+
+def fullScans(plan):
+  """
+  @param plan - the detail lines of a query plan
+  @return the aliases the plan reads with a full table SCAN (a SCAN of a
+    covering index is not counted)
+  """
+  return [m.group(1) for m in (re.match(r"SCAN (\w+)$", line) for line in plan) if m]
+
+def automaticIndexes(plan):
+  """
+  @param plan - the detail lines of a query plan
+  @return (alias, columns) for each automatic index SQLite had to build
+  """
+  found = []
+  for line in plan:
+    m = re.match(r"SEARCH (\w+) USING AUTOMATIC (?:\w+ )*INDEX \((.*)\)", line)
+    if m:
+      found.append((m.group(1), re.findall(r"(\w+)[=<>]", m.group(2))))
+  return found
+
+########### CANDIDATES ##########
+
+def rowidColumn(db, table):
+  """
+  @param db - the database cursor
+  @param table - the name of a table
+  @return the table's INTEGER PRIMARY KEY column (the rowid), or None
+  """
+  pk = [row for row in db.execute("PRAGMA table_info(%s)" % table).fetchall() if row[5]]
+  if len(pk) == 1 and pk[0][2].upper() == "INTEGER":
+    return pk[0][1]
+  return None
+
+def keyColumns(db, table):
+  """
+  @param db - the database cursor
+  @param table - the name of a table
+  @return the column lists of the table's primary key and unique indexes
+  """
+  keys = []
+  rowid = rowidColumn(db, table)
+  if rowid:
+    keys.append([rowid])
+  for row in db.execute("PRAGMA index_list(%s)" % table).fetchall():
+    if row[3] in ("pk", "u"):
+      keys.append([col[2] for col in db.execute("PRAGMA index_info(%s)" % row[1]).fetchall()])
+  return keys
+
+def makeCandidate(table, cols, name=None, source="proposed", rowid=None):
+  """
+  @param table - the table to index
+  @param cols - the indexed columns, in order
+  @param name - the index name; generated from the columns if None
+  @param source - where the candidate came from, for the report
+  @param rowid - the table's INTEGER PRIMARY KEY column, if any.  Every
+    index already ends with the rowid, so it is left out after the first
+    column.
+  @return a dict describing the candidate index
+  """
+  cols = [col for i, col in enumerate(cols) if i == 0 or col != rowid]
+  name = name or "idx_%s_%s" % (table.lower(), "_".join(col.lower() for col in cols))
+  return {"name": name, "table": table, "columns": list(cols), "source": source,
+          "sql": "CREATE INDEX IF NOT EXISTS %s ON %s(%s);" % (name, table, ", ".join(cols))}
+
+def buildIndex(db, candidate):
+  """
+  Builds a candidate index, on the coded table if the database is
+  dictionary-encoded and the candidate is on one of its views
+  """
+  db.execute(dictionary.retargetIndex(db, candidate["sql"]))
+
+def parseIndexSQL(sql):
+  """
+  @param sql - a CREATE INDEX statement
+  @return a candidate for the index the statement builds
+  """
+  m = re.search(r"INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(\w+)\s*\((.*)\)", sql, re.I | re.S)
+  cols = [col.strip() for col in m.group(3).split(",")]
+  return makeCandidate(m.group(2), cols, m.group(1), "default")
+
+def proposeCandidates(db, workload):
+  """
+  Proposes candidate indexes for a workload: the default set from
+  createdb.INDEXES, plus, for every table each query reads, an index on its
+  filter and join columns and a covering version of it, plus any automatic
+  index SQLite builds while running the query.  Candidates that are a
+  prefix of a table's primary key are dropped as redundant.
+  @param db - the database cursor
+  @param workload - a list of (name, sql, params) tuples
+  @return a list of candidate dicts
+  """
+  candidates = {}
+
+  def add(candidate):
+    key = (candidate["table"], tuple(candidate["columns"]))
+    if key not in candidates:
+      candidates[key] = candidate
+
+  for sql in createdb.INDEXES:
+    add(parseIndexSQL(sql))
+
+  tableColumns, keys, rowids = {}, {}, {}
+  for name, sql, params in workload:
+    aliases = tableAliases(sql)
+    for table in aliases.values():
+      if table not in tableColumns:
+        tableColumns[table] = [row[1] for row in db.execute("PRAGMA table_info(%s)" % table)]
+        keys[table] = keyColumns(db, dictionary.baseTable(db, table))
+        rowids[table] = rowidColumn(db, table)
+    use = columnUse(sql, aliases, tableColumns)
+    for alias, table in aliases.items():
+      lead = use[alias]["filter"] + [c for c in use[alias]["join"] if c not in use[alias]["filter"]]
+      if lead:
+        covering = lead + [c for c in use[alias]["refs"] if c not in lead]
+        add(makeCandidate(table, lead, rowid=rowids[table]))
+        add(makeCandidate(table, covering, rowid=rowids[table]))
+    for alias, cols in automaticIndexes(explain(db, sql, params)):
+      table = aliases.get(alias, alias)
+      covering = cols + [c for c in use.get(alias, {}).get("refs", []) if c not in cols]
+      add(makeCandidate(table, cols, rowid=rowids.get(table)))
+      add(makeCandidate(table, covering, rowid=rowids.get(table)))
+
+  return [c for (table, cols), c in candidates.items()
+          if not any(list(cols) == key[:len(cols)] for key in keys.get(table, []))]
+
+########### MEASURING ##########
+
+def timeQuery(db, sql, params, runs, timeout=QUERY_TIMEOUT):
+  """
+  @param db - the database cursor
+  @param sql - a query
+  @param params - the query's parameters
+  @param runs - the number of times to run the query
+  @param timeout - the longest a single run may take, in seconds
+  @return the median time in seconds to run a query and fetch its results
+  """
+  times = []
+  for i in range(runs):
+    start = time.perf_counter()
+    deadline = start + timeout
+    db.connection.set_progress_handler(lambda: time.perf_counter() > deadline, 100000)
+    try:
+      db.execute(sql, params).fetchall()
+      times.append(time.perf_counter() - start)
+    except sqlite3.OperationalError as e:
+      if not querycancel.isInterrupted(e):
+        raise
+      times.append(timeout)   # interrupted by the progress handler
+      break
+    finally:
+      db.connection.set_progress_handler(None, 0)
+  return statistics.median(times)
+
+def timeWorkload(db, workload, runs, table=None, timeout=QUERY_TIMEOUT):
+  """
+  @param db - the database cursor
+  @param workload - a list of (name, sql, params) tuples
+  @param runs - the number of times to run each query
+  @param table - if given, only the queries that read this table are run
+  @param timeout - the longest a single run may take, in seconds
+  @return a dict mapping query names to their median times
+  """
+  return dict((name, timeQuery(db, sql, params, runs, timeout)) for name, sql, params in workload
+              if table is None or table in tableAliases(sql).values())
+
+def indexSize(db, name):
+  """
+  @return the size of an index in bytes, or None if the dbstat table is not
+    available in this SQLite build
+  """
+  try:
+    return db.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (name,)).fetchone()[0]
+  except sqlite3.OperationalError as e:
+    if "no such table: dbstat" not in str(e):
+      raise
+    return None
+
+def secondaryIndexes(db):
+  """
+  @return (name, sql) of every index on the six core tables (or the coded
+    tables behind them) that is not a primary key or unique constraint index
+  """
+  tables = [dictionary.baseTable(db, t) for t in createdb.TABLE_NAMES]
+  return db.execute("""SELECT name, sql FROM sqlite_master
+                       WHERE type = 'index' AND sql IS NOT NULL
+                         AND tbl_name IN (%s)"""
+                    % ", ".join("'%s'" % t for t in tables)).fetchall()
+
+def isGain(before, after):
+  """
+  @param before - the median time of a query without an index
+  @param after - the median time of the query with it
+  @return True if the speedup is large enough to be worth an index
+  """
+  return before - after >= max(MIN_GAIN_SECONDS, MIN_GAIN_FRACTION * before)
+
+def measureCandidate(db, workload, candidate, baseline, runs, timeout=QUERY_TIMEOUT):
+  """
+  Builds one candidate index, measures it and drops it again.  The build
+  time, size, per-query times and whether any plan used it are stored in
+  the candidate dict.
+  """
+  start = time.perf_counter()
+  buildIndex(db, candidate)
+  candidate["build"] = time.perf_counter() - start
+  candidate["size"] = indexSize(db, candidate["name"])
+  candidate["times"] = timeWorkload(db, workload, runs, candidate["table"], timeout)
+  candidate["used"] = any(candidate["name"] in line
+                          for name, sql, params in workload
+                          for line in explain(db, sql, params))
+  candidate["gain"] = sum(max(0, baseline[q] - t) for q, t in candidate["times"].items())
+  db.execute("DROP INDEX " + candidate["name"])
+
+def remainingScans(db, workload):
+  """
+  @return (query name, table) for every full table SCAN in the workload
+  """
+  scans = []
+  for name, sql, params in workload:
+    aliases = tableAliases(sql)
+    for alias in fullScans(explain(db, sql, params)):
+      scans.append((name, aliases.get(alias, alias)))
+  return scans
+
+def chooseIndexes(db, workload, candidates, baseline, runs, timeout=QUERY_TIMEOUT):
+  """
+  Picks the winning set of indexes.  Candidates are tried in order of
+  measured benefit (smallest first on ties) and kept only if, on top of
+  the indexes already kept, they still make some query faster.  Indexes
+  that remove a remaining full table SCAN are then added, and any kept
+  index no final plan uses is dropped.  The chosen indexes are left built.
+  @return the list of chosen candidates
+  """
+  chosen = []
+  current = dict(baseline)
+  for c in sorted(candidates, key=lambda c: (-c["gain"], c["size"] or 0)):
+    if not c["used"] or not any(isGain(baseline[q], t) for q, t in c["times"].items()):
+      continue
+    buildIndex(db, c)
+    times = timeWorkload(db, workload, runs, c["table"], timeout)
+    if any(isGain(current[q], t) for q, t in times.items()):
+      chosen.append(c)
+      current.update(times)
+    else:
+      db.execute("DROP INDEX " + c["name"])
+
+  for query, table in remainingScans(db, workload):
+    for c in sorted(candidates, key=lambda c: c["size"] or 0):
+      if c in chosen or c["table"] != table:
+        continue
+      buildIndex(db, c)
+      if (query, table) not in remainingScans(db, workload):
+        chosen.append(c)
+        break
+      db.execute("DROP INDEX " + c["name"])
+
+  # an index that is a prefix of another kept index can usually be served
+  # by the wider one; drop it unless that makes the queries slower
+  for c in sorted(chosen, key=lambda c: len(c["columns"])):
+    if any(w is not c and w["table"] == c["table"] and w["columns"][:len(c["columns"])] == c["columns"]
+           for w in chosen):
+      before = timeWorkload(db, workload, runs, c["table"], timeout)
+      db.execute("DROP INDEX " + c["name"])
+      after = timeWorkload(db, workload, runs, c["table"], timeout)
+      if isGain(sum(after.values()), sum(before.values())):
+        buildIndex(db, c)
+      else:
+        chosen.remove(c)
+
+  plans = [line for name, sql, params in workload for line in explain(db, sql, params)]
+  for c in list(chosen):
+    if not any(c["name"] in line for line in plans):
+      db.execute("DROP INDEX " + c["name"])
+      chosen.remove(c)
+  return chosen
+
+def printReport(candidates, chosen, baseline):
+  """
+  Prints the measurements of every candidate and the chosen set
+  """
+  print("\n%-45s %9s %10s %9s  %s" % ("Candidate", "Build(s)", "Size(KB)", "Speedup", "Chosen"))
+  print("-" * 85)
+  for c in candidates:
+    speedup = max([baseline[q] / t for q, t in c["times"].items() if t > 0] or [1.0])
+    size = "%10.0f" % (c["size"] / 1024) if c["size"] is not None else "%10s" % "?"
+    print("%-45s %9.3f %s %8.1fx  %s" % (c["name"], c["build"], size, speedup,
+                                         "yes" if c in chosen else ""))
+
+############### main program ###########################
+def main():
+  parser = argparse.ArgumentParser(prog="indexadvisor.py",
+      description="Chooses secondary indexes for the movie database from its query workload")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("--workload", metavar="FILE",
+      help="JSON lines workload file ({\"name\", \"sql\", \"params\"} per line); "
+           "defaults to the queries in queryregistry.py")
+  parser.add_argument("--runs", type=int, default=3,
+      help="times each query is run per measurement (default %(default)s)")
+  parser.add_argument("--timeout", type=float, default=QUERY_TIMEOUT,
+      help="longest a single query run may take, in seconds (default %(default)s)")
+  parser.add_argument("--save", metavar="FILE",
+      help="write the chosen CREATE INDEX statements to FILE, for createdb.py --indexes")
+  parser.add_argument("--apply", action="store_true",
+      help="keep the chosen indexes and drop the others; otherwise the "
+           "database's original indexes are restored")
+  args = parser.parse_args()
+
+  if not os.path.exists(args.filename):
+    print("Error: file does not exist")
+    return 1
+
+  workload = loadWorkload(args.workload) if args.workload else queryregistry.WORKLOAD
+  conn = sqlite3.connect(args.filename)
+  conn.isolation_level = None   # transactions are begun and ended below
+  db = conn.cursor()
+
+  # every index drop and build happens in one transaction, which is rolled
+  # back at the end (or on an error or Ctrl-C) unless --apply keeps it, so
+  # the database's original indexes come back however the run ends
+  db.execute("BEGIN")
+  keep = False
+  try:
+    original = secondaryIndexes(db)
+    print("...Measuring the workload without secondary indexes...")
+    for name, sql in original:
+      db.execute("DROP INDEX " + name)
+    baseline = timeWorkload(db, workload, args.runs, timeout=args.timeout)
+
+    candidates = proposeCandidates(db, workload)
+    print("...Measuring %d candidate indexes..." % len(candidates))
+    for c in candidates:
+      measureCandidate(db, workload, c, baseline, args.runs, args.timeout)
+
+    print("...Choosing indexes...")
+    chosen = chooseIndexes(db, workload, candidates, baseline, args.runs, args.timeout)
+    printReport(candidates, chosen, baseline)
+
+    print("\nChosen indexes:")
+    for c in chosen:
+      print("  " + c["sql"])
+    for query, table in remainingScans(db, workload):
+      print("Note: %s still scans all of %s" % (query, table))
+
+    if args.save:
+      with open(args.save, "w") as f:
+        f.write("-- indexes chosen by indexadvisor.py\n")
+        f.writelines(c["sql"] + "\n" for c in chosen)
+    keep = args.apply
+  finally:
+    db.execute("COMMIT" if keep else "ROLLBACK")
+    conn.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
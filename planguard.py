@@ -0,0 +1,272 @@
+"""
+planguard.py
+
+Description: Guards the menu queries against query plan regressions.  The
+plan of each query is captured with EXPLAIN QUERY PLAN on the statement
+the menu actually runs, parameters included, and normalized into a tree.
+--save stores the trees as a JSON baseline; --check compares the current
+plans with it.  A table that was searched through an index and is now
+scanned, a new temporary B-tree, or a new automatic index is reported as
+a regression, and the exit status is 1.  Other changes (such as a
+different index serving the same search) are reported but do not fail
+the check.
+
+On a partitioned database the shard SQL is explained on one shard (the
+largest unless --shard names another), with the shared file attached.
+
+Usage: python3 planguard.py databaseName (--save FILE | --check FILE)
+                            [--workload FILE] [--shard NAME]
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+
+import indexadvisor
+import queryDB
+import queryregistry
+import shards
+
+# Rewrites that make plan details comparable across SQLite versions and
+# unrelated schema changes
+NORMALIZE = [
+  (re.compile(r"^(SCAN|SEARCH) TABLE "), r"\1 "),         # before 3.36
+  (re.compile(r"\b(SUBQUERY|CO-ROUTINE|MATERIALIZE) \d+"), r"\1"),
+  (re.compile(r"\s+"), " "),
+]
+
+ACCESS = re.compile(r"^(SCAN|SEARCH) (\S+)")
+
+def normalizeDetail(detail):
+  """
+  @param detail - the detail column of an EXPLAIN QUERY PLAN row
+  @return the detail with version- and numbering-specific text removed
+  """
+  for pattern, replacement in NORMALIZE:
+    detail = pattern.sub(replacement, detail)
+  return detail.strip()
+
+def planTree(db, sql, params=None):
+  """
+  Captures the normalized plan tree of a statement
+  @param db - the database connection or cursor
+  @param sql - the statement, as it is run
+  @param params - its parameters
+  @return a list of {"detail": ..., "children": [...]} nodes
+  """
+  roots = []
+  stack = []   # (depth, children list) of the open nodes
+  for depth, detail in queryDB.queryPlan(db, sql, params):
+    node = {"detail": normalizeDetail(detail), "children": []}
+    while stack and stack[-1][0] >= depth:
+      stack.pop()
+    (stack[-1][1] if stack else roots).append(node)
+    stack.append((depth, node["children"]))
+  return roots
+
+def flatten(tree):
+  """
+  @param tree - a list of plan nodes
+  @return the details of every node, depth first
+  """
+  details = []
+  for node in tree:
+    details.append(node["detail"])
+    details.extend(flatten(node["children"]))
+  return details
+
+def access(details):
+  """
+  @param details - flattened plan details
+  @return a dict mapping each table alias to the set of ways it is
+    accessed ("SCAN" or "SEARCH")
+  """
+  ways = collections.defaultdict(set)
+  for detail in details:
+    m = ACCESS.match(detail)
+    if m:
+      ways[m.group(2)].add(m.group(1))
+  return ways
+
+def regressions(baseline, current):
+  """
+  Compares a query's current plan with its baseline
+  @param baseline - the baseline plan tree
+  @param current - the current plan tree
+  @return a list of regression messages (empty if none)
+  """
+  before, after = flatten(baseline), flatten(current)
+  problems = []
+
+  baselineAccess = access(before)
+  for alias, ways in sorted(access(after).items()):
+    if "SCAN" in ways and "SCAN" not in baselineAccess.get(alias, {"SCAN"}):
+      scans = [d for d in after if d.startswith("SCAN %s" % alias)]
+      problems.append("%s replaced a SEARCH of %s" % (scans[0], alias))
+
+  temps = collections.Counter(d for d in after if d.startswith("USE TEMP B-TREE"))
+  temps.subtract(d for d in before if d.startswith("USE TEMP B-TREE"))
+  for detail, extra in sorted(temps.items()):
+    if extra > 0:
+      problems.append("new %s" % detail)
+
+  automatic = collections.Counter(d for d in after if "AUTOMATIC" in d)
+  automatic.subtract(d for d in before if "AUTOMATIC" in d)
+  for detail, extra in sorted(automatic.items()):
+    if extra > 0:
+      problems.append("new automatic index: %s" % detail)
+  return problems
+
+def capture(db, workload):
+  """
+  @param db - the database connection
+  @param workload - a list of (name, sql, params)
+  @return a dict mapping each query name to its SQL, parameters and plan
+  """
+  return {name: {"sql": sql, "params": list(params), "plan": planTree(db, sql, params)}
+          for name, sql, params in workload}
+
+def menuWorkload(db, sharded=False):
+  """
+  @param db - the database connection
+  @param sharded - True if db is a shard of a partitioned database
+  @return queryregistry.WORKLOAD with each query's SQL replaced by the
+    variant the menu runs against this database (the shard SQL on a shard)
+  """
+  if sharded:
+    return [(query.key, query.shard[0], query.sample)
+            for query in queryregistry.QUERIES]
+  sqls = queryregistry.statements(db)
+  return [(query.key, sqls[query.number], query.sample)
+          for query in queryregistry.QUERIES]
+
+def openShard(filename, db, name=None):
+  """
+  Opens the shard of a partitioned database whose plans are captured: the
+  main file only holds the shared tables, so the menu queries cannot be
+  explained against it
+  @param filename - the shared database file
+  @param db - a connection to it
+  @param name - the name of the shard, or None for the one with the most
+    movies
+  @return a connection to the shard, with the shared file attached
+  """
+  names = [row[0] for row in db.execute(
+      "SELECT name FROM Shards ORDER BY numMovies DESC, name")]
+  if name is None and names:
+    name = names[0]
+  if name not in names:
+    raise ValueError("no shard named %r (shards: %s)" % (name, ", ".join(names)))
+  return shards.openShard(filename, name)
+
+def printTree(tree, indent="    "):
+  """
+  Prints a plan tree, one node per line
+  """
+  for node in tree:
+    print(indent + node["detail"])
+    printTree(node["children"], indent + "  ")
+
+def check(baseline, current):
+  """
+  Reports the differences between the baseline and current plans
+  @param baseline - the saved capture
+  @param current - the current capture
+  @return the number of queries with regressions
+  """
+  failed = 0
+  for name in current:
+    if name not in baseline:
+      print("%-8s new query (no baseline)" % name)
+      continue
+    old, new = baseline[name], current[name]
+    if old["plan"] == new["plan"]:
+      print("%-8s ok" % name)
+      continue
+    problems = regressions(old["plan"], new["plan"])
+    note = " (query SQL changed)" if old["sql"] != new["sql"] else ""
+    if problems:
+      failed += 1
+      print("%-8s REGRESSION%s" % (name, note))
+      for problem in problems:
+        print("    " + problem)
+    else:
+      print("%-8s plan changed%s" % (name, note))
+    print("  baseline:")
+    printTree(old["plan"])
+    print("  current:")
+    printTree(new["plan"])
+  for name in baseline:
+    if name not in current:
+      print("%-8s missing from this run" % name)
+  return failed
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="planguard.py",
+      description="Saves or checks the query plans of the menu queries")
+  parser.add_argument("filename", help="name of the database file")
+  action = parser.add_mutually_exclusive_group(required=True)
+  action.add_argument("--save", metavar="FILE",
+      help="write the current plans to FILE as the baseline")
+  action.add_argument("--check", metavar="FILE",
+      help="compare the current plans with the baseline in FILE")
+  parser.add_argument("--workload", metavar="FILE",
+      help="JSON lines of {\"name\", \"sql\", \"params\"} to explain instead "
+           "of the menu queries")
+  parser.add_argument("--shard", metavar="NAME",
+      help="on a partitioned database, the shard to explain the queries on "
+           "(default: the one with the most movies)")
+  return parser.parse_args(argv)
+
+def main():
+  args = parseArgs(sys.argv[1:])
+  if not os.path.exists(args.filename):
+    print("Error: file does not exist")
+    return 1
+
+  db = queryDB.openReadOnly(args.filename)
+  sharded = shards.isSharded(db)
+  if sharded:
+    try:
+      shardDB = openShard(args.filename, db, args.shard)
+    except ValueError as e:
+      print("Error: %s" % e)
+      return 1
+    db.close()
+    db = shardDB
+  elif args.shard:
+    print("Error: --shard needs a partitioned database")
+    return 1
+  if args.workload:
+    workload = indexadvisor.loadWorkload(args.workload)
+  else:
+    workload = menuWorkload(db, sharded)
+  current = capture(db, workload)
+  db.close()
+
+  if args.save:
+    with open(args.save, "w") as f:
+      json.dump(current, f, indent=2)
+      f.write("\n")
+    print("Saved the plans of %d queries to %s" % (len(current), args.save))
+    return 0
+
+  with open(args.check) as f:
+    baseline = json.load(f)
+  failed = check(baseline, current)
+  if failed:
+    print("%d quer%s regressed" % (failed, "y" if failed == 1 else "ies"))
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
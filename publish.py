@@ -0,0 +1,170 @@
+"""
+publish.py
+
+Description: Publishes a built database as a read-only snapshot for
+queryDB.py and server.py.  VACUUM INTO writes a compacted copy of the
+database, with no free pages and every table and index stored in order,
+at the chosen page size.  The copy is then analyzed, so the query
+planner has real row counts (sqlite_stat1) to choose plans from, and
+stamped with a version in the SnapshotMeta table.  It replaces the
+previous snapshot in one rename.
+
+queryDB.py and server.py recognize a snapshot by its SnapshotMeta table.
+They open it immutable, so SQLite takes no locks and never checks the
+file for changes, and memory-mapped, so pages are read straight from the
+OS page cache with no copy.  A snapshot must therefore never be written:
+rebuild the database and publish it again instead.
+
+Usage: python3 publish.py databaseName snapshotName [pageSize]
+  writes a snapshot of an existing database (page size default 8192)
+"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+import shards
+
+# Default page size of a snapshot.  Larger pages make B-trees shallower
+# and scans cheaper; smaller pages read less for each point lookup.
+PAGE_SIZE = 8192
+
+# The page sizes SQLite supports
+PAGE_SIZES = [512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+
+SNAPSHOT_SQL = """CREATE TABLE SnapshotMeta (
+    key VARCHAR(30) PRIMARY KEY,
+    value TEXT
+  )"""
+
+def isSnapshot(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the database is a published snapshot
+  """
+  return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'SnapshotMeta'").fetchone() is not None
+
+def snapshotInfo(db):
+  """
+  @param db - a connection to a snapshot
+  @return a dict of its SnapshotMeta entries
+  """
+  return dict(db.execute("SELECT key, value FROM SnapshotMeta"))
+
+def dataVersion(db):
+  """
+  @param db - a connection to the database being published
+  @return a digest of the source file checksums recorded in LoadMeta, the
+    same for every snapshot of the same data
+  """
+  digest = hashlib.sha256()
+  try:
+    for table, checksum in db.execute(
+        "SELECT tableName, checksum FROM LoadMeta ORDER BY tableName"):
+      digest.update(("%s %s\n" % (table, checksum)).encode())
+  except sqlite3.OperationalError:   # a database built before LoadMeta
+    return None
+  return digest.hexdigest()
+
+def previousVersion(target):
+  """
+  @param target - the snapshot file about to be replaced
+  @return the version stamped in it, or 0 if there is none
+  """
+  if not os.path.exists(target):
+    return 0
+  try:
+    conn = sqlite3.connect("file:%s?mode=ro" % target, uri=True)
+    try:
+      return int(snapshotInfo(conn).get("version", 0))
+    finally:
+      conn.close()
+  except (sqlite3.Error, ValueError):
+    return 0
+
+def publishSnapshot(conn, target, pageSize=PAGE_SIZE):
+  """
+  Writes a compacted, analyzed and versioned snapshot of a database
+  @param conn - a connection to the database, with no open transaction
+  @param target - the snapshot file to write; an existing one is replaced
+  @param pageSize - the page size of the snapshot, one of PAGE_SIZES
+  @return the snapshot's SnapshotMeta entries
+  @raise ValueError if the database is partitioned or the page size is
+    not supported
+  """
+  if pageSize not in PAGE_SIZES:
+    raise ValueError("page size must be one of %s" % ", ".join(map(str, PAGE_SIZES)))
+  if shards.isSharded(conn):
+    raise ValueError("a partitioned database cannot be published as one file")
+  if os.path.abspath(target) == os.path.abspath(
+      conn.execute("PRAGMA database_list").fetchone()[2]):
+    raise ValueError("the snapshot must be a different file from the database")
+
+  scratch = target + ".tmp"
+  if os.path.exists(scratch):
+    os.remove(scratch)
+  conn.commit()
+  # on a database with content, page_size only takes effect in a VACUUM
+  original = conn.execute("PRAGMA page_size").fetchone()[0]
+  conn.execute("PRAGMA page_size=%d" % pageSize)
+  try:
+    conn.execute("VACUUM INTO ?", (scratch,))
+  finally:
+    conn.execute("PRAGMA page_size=%d" % original)
+
+  info = {
+    "version": str(previousVersion(target) + 1),
+    "publishedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    "source": os.path.abspath(conn.execute("PRAGMA database_list").fetchone()[2]),
+    "dataVersion": dataVersion(conn),
+    "pageSize": str(pageSize),
+    "sqlite": sqlite3.sqlite_version,
+  }
+  snap = sqlite3.connect(scratch)
+  try:
+    snap.execute("ANALYZE")
+    snap.execute("PRAGMA optimize")
+    snap.execute(SNAPSHOT_SQL)
+    snap.executemany("INSERT INTO SnapshotMeta VALUES (?, ?)", info.items())
+    snap.commit()
+  finally:
+    snap.close()
+  with open(scratch, "rb") as f:
+    os.fsync(f.fileno())
+  os.replace(scratch, target)
+  return info
+
+############### main program ###########################
+def main():
+
+  if len(sys.argv) not in (3, 4):
+    print("Error: Incorrect arguments")
+    print("Usage: python3 publish.py databaseName snapshotName [pageSize]")
+    return 1
+
+  if not os.path.exists(sys.argv[1]):
+    print("Error: file does not exist")
+    return 1
+
+  conn = sqlite3.connect(sys.argv[1])
+  print("...Publishing Snapshot...")
+  start = time.time()
+  try:
+    info = publishSnapshot(conn, sys.argv[2],
+                           int(sys.argv[3]) if len(sys.argv) == 4 else PAGE_SIZE)
+  except ValueError as e:
+    print("Error: %s" % e)
+    return 1
+  finally:
+    conn.close()
+  print("  version %s of %s, %d bytes (%d-byte pages), in %.2f seconds"
+        % (info["version"], sys.argv[2], os.path.getsize(sys.argv[2]),
+           int(info["pageSize"]), time.time() - start))
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -8,31 +8,193 @@ Names: George Ackall, Neil Zhu
 Date: April 7th, 2025
 Description: Create runs 8 sql query searches   
 """
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import json
 import sqlite3
+import statistics
+import threading
+import urllib.parse
 import os
 import sys
 import time
 
+import costar
+import publish
+import querycache
+import querycancel
+import queryregistry
+import querytrace
+import resultwriter
+import search
+import shards
+
+# Prepared statements kept per connection.  The query SQL in
+# queryregistry.py is constant, so repeated menu selections and lookups
+# reuse the compiled statement.
+CACHED_STATEMENTS = 256
+
+# Lookups of a --jobs batch submitted ahead of the one being written, per
+# worker, so a large batch file is read as it is run, not all at once
+BATCH_AHEAD = 4
+
+# The result cache used by executeQuery, set up in main (None disables it)
+resultCache = None
+
+# The NumPy engine answering queries 4-7 with --analytics (None runs the SQL)
+analyticsEngine = None
+
+# The tracer timing each query run by executeQuery and runBatch, set up in
+# main with --trace or --slow-log (None disables tracing)
+queryTracer = None
+
+# The router running queries on the shards of a partitioned database, set
+# up in main when the database is one (None for a single file)
+shardRouter = None
+
+# The most seconds a menu or batch query may run (--timeout), or None for
+# no limit
+queryTimeout = None
+
+# The format executeQuery writes results in, one of resultwriter.FORMATS
+outputFormat = "table"
+
 ############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="queryDB.py",
+      description="Runs queries against the movie database")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("--format", choices=resultwriter.FORMATS, default="table",
+      help="how query results are written (default %(default)s)")
+  parser.add_argument("--no-cache", action="store_true",
+      help="always run queries instead of reusing cached results")
+  parser.add_argument("--cache-size", type=int, default=querycache.MAX_ENTRIES,
+      help="most query results kept in memory (default %(default)s)")
+  parser.add_argument("--cache-file", metavar="FILE",
+      help="load cached results from FILE and save them back on exit")
+  parser.add_argument("--analytics", action="store_true",
+      help="answer queries 4-7 from NumPy column files kept next to the "
+           "database (requires numpy)")
+  parser.add_argument("--trace", action="store_true",
+      help="report the VM steps, full scan steps and sorts of each "
+           "query, and a latency histogram per query on exit")
+  parser.add_argument("--slow-log", metavar="FILE",
+      help="append each query slower than --slow-ms to FILE as a JSON line, "
+           "with its parameters and plan (implies --trace)")
+  parser.add_argument("--slow-ms", type=float,
+      default=1000 * querytrace.SLOW_SECONDS,
+      help="the latency in milliseconds above which a query is logged as "
+           "slow (default %(default)s)")
+  parser.add_argument("--timeout", type=float, metavar="SECONDS",
+      help="stop any query still running after SECONDS (default no limit); "
+           "Ctrl-C also stops a menu query")
+  batch = parser.add_argument_group("batch mode",
+      "run lookups without the menu; results go to stdout and per-lookup "
+      "latencies to stderr")
+  lookups = batch.add_mutually_exclusive_group()
+  lookups.add_argument("--query", metavar="QUERY",
+      help="run one query, by number (1-%d) or name (%s)"
+           % (len(queryregistry.QUERIES), ", ".join(sorted(queryregistry.BY_NAME))))
+  lookups.add_argument("--batch", metavar="FILE",
+      help="run the lookups in FILE: JSON lines of {\"query\": ..., "
+           "\"params\": [...]}, or CSV rows of query,param,... if FILE ends "
+           "in .csv; - reads JSON lines from stdin")
+  batch.add_argument("--params", nargs="*", default=[], metavar="VALUE",
+      help="the parameters of --query; those left off take their defaults")
+  batch.add_argument("--jobs", type=int, default=1,
+      help="run batch lookups on N threads, each with its own read-only "
+           "connection (default %(default)s)")
+  batch.add_argument("--no-results", action="store_true",
+      help="only report latencies, for load tests")
+  args = parser.parse_args(argv)
+  if args.cache_size < 1:
+    parser.error("--cache-size must be at least 1")
+  if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+  if args.params and not args.query:
+    parser.error("--params requires --query")
+  if args.slow_ms < 0:
+    parser.error("--slow-ms must not be negative")
+  if args.timeout is not None and args.timeout <= 0:
+    parser.error("--timeout must be positive")
+  args.trace = args.trace or args.slow_log is not None
+  return args
+
 def main():
+  global resultCache, outputFormat, analyticsEngine, queryTracer, shardRouter
+  global queryTimeout
 
-  # make sure it is run with correct num command line args
-  if(len(sys.argv) != 2):
-      print("Error: Incorrect arguments")
-      print("Usage: python3 queryDB.py databaseName")
-      return(1)
+  args = parseArgs(sys.argv[1:])
+  outputFormat = args.format
+  queryTimeout = args.timeout
 
   # check if database file exists
-  if(not os.path.exists(sys.argv[1])):
+  if(not os.path.exists(args.filename)):
       print("Error: file does not exist")
       exit(1)
 
-  conn = sqlite3.connect(sys.argv[1])  # open connection
+  if args.trace:
+    queryTracer = querytrace.QueryTracer(args.slow_ms / 1000, args.slow_log,
+                                         explain=queryPlan)
+
+  with contextlib.closing(openReadOnly(args.filename)) as conn:
+    sharded = shards.isSharded(conn)
+    # a published snapshot never changes, so it is opened immutable and
+    # memory-mapped
+    args.snapshot = publish.isSnapshot(conn)
+  if sharded:
+    if args.analytics:
+      print("Error: --analytics is not available on a partitioned database")
+      return 1
+    shardRouter = shards.ShardRouter(args.filename)
+
+  if args.analytics:
+    import analytics   # loads NumPy, so only when the engine is asked for
+    if analytics.numpy is None:
+      print("Error: --analytics requires numpy (pip install numpy)")
+      return 1
+    start = time.time()
+    analyticsEngine = analytics.Analytics(args.filename)
+    if analyticsEngine.built:
+      print("Built the column files in %.2f seconds" % (time.time() - start),
+            file=sys.stderr if args.query or args.batch else sys.stdout)
+
+  if args.query or args.batch:
+    status = runBatch(args)
+    if queryTracer is not None:
+      querytrace.printSummary(queryTracer.summary(), sys.stderr)
+      queryTracer.close()
+    if shardRouter is not None:
+      shardRouter.close()
+    return status
+
+  if not args.no_cache:
+    resultCache = querycache.QueryCache(args.filename, args.cache_size,
+                                        persistFile=args.cache_file)
+
+  if args.snapshot:
+    conn = openReadOnly(args.filename, immutable=True, mmap=True)
+  else:
+    # queries run on a worker thread, so they can be stopped
+    conn = sqlite3.connect(args.filename, cached_statements=CACHED_STATEMENTS,
+                           check_same_thread=False,
+                           factory=queryregistry.Connection)  # open connection
   conn.text_factory = str              # deals with string issues
   db = conn.cursor()                   # a cursor takes in the sql commands
 
   print
   print("Welcome to the Movie Database!")
+  if args.snapshot:
+    info = publish.snapshotInfo(db)
+    print("Snapshot version %s, published %s" % (info.get("version"), info.get("publishedAt")))
 
   #  Repeatedly call printMenu and execute the chosen query until the user
   #  Selects to Exit
@@ -42,7 +204,7 @@ def main():
       option = printMenu()  # This may raise ValueError if user typed a non-integer
     except ValueError:
       print()
-      print("Invalid Input! Please enter an integer from 0 to 8.\n")
+      print("Invalid Input! Please enter an integer from 0 to 10.\n")
       continue  # go back to top of while-loop to re-prompt
 
 
@@ -50,23 +212,26 @@ def main():
     if option == 0:
       print("Exiting ...\n")
       break
-    # if the user choses option 1-8, execute query X (1-8)
-    elif option == 1:
-      query1(db)
-    elif option == 2:
-      query2(db)
-    elif option == 3:
-      query3(db)
-    elif option == 4:
-      query4(db)
-    elif option == 5:
-      query5(db)
-    elif option == 6:
-      query6(db)
-    elif option == 7:
-      query7(db)
+    # if the user choses option 1-7, execute that query of the registry
+    elif option in queryregistry.BY_NUMBER:
+      menuQuery(db, queryregistry.BY_NUMBER[option])
     elif option == 8:
       testquery(db)
+    elif option == 9:
+      query9(db)
+    elif option == 10:
+      query10(db)
+
+  if resultCache is not None:
+    resultCache.save()
+
+  if queryTracer is not None:
+    print()
+    querytrace.printSummary(queryTracer.summary(), sys.stdout)
+    queryTracer.close()
+
+  if shardRouter is not None:
+    shardRouter.close()
 
   print()
   print("Thank you for using the Movie Database!")
@@ -81,360 +246,556 @@ def testquery(db):
   """
   print("in testquery")
   title =  "The Mexican"
-  query = """SELECT DISTINCT A.fname, A.lname 
-          FROM Actor AS A
-          JOIN Casts AS C ON A.id = C.actorID
-          JOIN Movie AS M ON C.movieID = M.id
-          WHERE M.title = ?
-          ORDER BY A.fname, A.lname 
-          """ 
-
-  explainable_query = f"""
-      SELECT DISTINCT A.fname, A.lname 
-        FROM Actor AS A
-        JOIN Casts AS C ON A.id = C.actorID
-        JOIN Movie AS M ON C.movieID = M.id
-        WHERE M.title = '{title}'
-        ORDER BY A.fname, A.lname 
-    """
-  executeQuery(db, query, params=(title,), explain_query=explainable_query)
-  return 
-
 
-def query1(db):
-  """
-  Query 1: Cast of the Princess Bride
-  List the names of all distinct actors in 
-  the movie "The Princess Bride  
-  """
-  title =  "The Princess Bride"
-  query = """SELECT DISTINCT A.fname, A.lname 
-          FROM Actor AS A
-          JOIN Casts AS C ON A.id = C.actorID
-          JOIN Movie AS M ON C.movieID = M.id
-          WHERE M.title = ?
-          ORDER BY A.fname, A.lname 
-          """ 
-  
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-        SELECT DISTINCT A.fname, A.lname 
-        FROM Actor AS A
-        JOIN Casts AS C ON A.id = C.actorID
-        JOIN Movie AS M ON C.movieID = M.id
-        WHERE M.title = '{title}'
-        ORDER BY A.fname, A.lname 
-    """
-  executeQuery(db, query, params=(title,), explain_query=explainable_query)
+  executeQuery(db, queryregistry.BY_NUMBER[1], params=(title,))
   return 
 
 
-def query2(db):
+def menuQuery(db, query):
   """
-  Query 2: Actor Filmography
- 	Ask the user for the name of an actor, and print 
-  all the movies starring an actor with that name 
-  (only print each title once).  
+  Queries 1-7: asks for the query's parameters, runs it and prints
+  the results, on the analytics engine if it answers the query
+  @param db - the database cursor
+  @param query - the queryregistry.Query
   """
-  #promts the user to enter name of an actor
-  fname = input("Enter Actor's first name: ")
-  lname = input("Enter Actor's last name: ")
+  try:
+    params = query.bind(askParams(query))
+  except ValueError as e:
+    print()
+    print("Invalid Input! %s\n" % e)
+    return
 
-  query = """
-      SELECT DISTINCT M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = ?
-        AND A.lname = ?
-      ORDER BY M.title
-      """
-
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-      SELECT DISTINCT M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = '{fname}'
-        AND A.lname = '{lname}'
-      ORDER BY M.title
-    """
-  executeQuery(db, query, params=(fname,lname,), explain_query=explainable_query)
-  return 
+  if analyticsEngine is not None and analyticsEngine.answers(query.number):
+    printAnalytics(query.number, params)
+    return
 
-def query3(db):
-  """
-  Query 3: Co-stars
-  Ask the user for the name of two actors. Print the names
-  of all distinct movies in which those two actors co-starred.
-  """
-  #prompts the user to enter the name of actor 1 
-  fname1 = input("Enter first actor's first name: ")
-  lname1 = input("Enter first actor's last name: ")
-  
-  #prompts the user to enter the name of actor 1 
-  fname2 = input("Enter second actor's first name: ")
-  lname2 = input("Enter second actor's last name: ")
-
-  query = """
-      SELECT DISTINCT M.id, M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = ?
-        AND A.lname = ?
-
-      INTERSECT
-
-      SELECT DISTINCT M.id, M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = ?
-        AND A.lname = ?
-
-      """
-
-  # Build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-      SELECT DISTINCT M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = '{fname1}'
-        AND A.lname = '{lname1}'
-
-      INTERSECT
-
-      SELECT DISTINCT M.title
-      FROM Actor AS A
-      JOIN Casts AS C ON A.id = C.actorID
-      JOIN Movie AS M ON C.movieID = M.id
-      WHERE A.fname = '{fname2}'
-        AND A.lname = '{lname2}'
-      """
-  executeQuery(db, query, params=(fname1, lname1, fname2, lname2,), explain_query=explainable_query)
+  if executeQuery(db, query, params=params) == 0:
+    suggestActors(db, query.actorNames(params))
   return 
 
+def askParams(query):
+  """
+  Prompts for each parameter of a query.  An empty answer takes the
+  parameter's default, if it has one.
+  @param query - the queryregistry.Query
+  @return the list of answers
+  """
+  values = []
+  for param in query.params:
+    if param.default is None:
+      values.append(input("%s: " % param.prompt))
+    else:
+      value = input("%s [%s]: " % (param.prompt, param.default))
+      values.append(value if value.strip() else param.default)
+  return values
+
+def query9(db):
+  """
+  Query 9: Bacon Number
+  Ask the user for the name of an actor and print the shortest chain
+  of co-stars linking them to Kevin Bacon, with a movie for each link.
+  """
+  if shardRouter is not None:
+    print("\n Bacon numbers are not available on a partitioned database\n ")
+    return
 
-def query4(db):
-  """
-  Query 4: Prolific Directors
-  List all directors who directed 500 movies or more, in descending
-  order of the number of movies they directed. Include the director's 
-  name and the number of movies they directed.
-  """
-  query = """
-      SELECT DISTINCT D.fname, D.lname, COUNT(M.id) AS FilmCount
-      FROM Director AS D
-      JOIN DirectsMovie AS DM ON DM.directorID = D.id
-      JOIN Movie AS M ON DM.movieID = M.id
-      GROUP BY DM.directorID
-      HAVING COUNT(M.id) >= 500
-      ORDER BY COUNT(M.id) DESC;
-      """
-
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-      SELECT DISTINCT D.fname, D.lname, COUNT(M.id) AS FilmCount
-      FROM Director AS D
-      JOIN DirectsMovie AS DM ON DM.directorID = D.id
-      JOIN Movie AS M ON DM.movieID = M.id
-      GROUP BY DM.directorID
-      HAVING COUNT(M.id) >= 500
-      ORDER BY COUNT(M.id) DESC;
-      """
-  executeQuery(db, query, params=None, explain_query=explainable_query)
-  return 
+  fname = input("Enter Actor's first name: ")
+  lname = input("Enter Actor's last name: ")
 
-def query5(db):
-  """
-  Query 5: Bacon's Favorites
-  Find Kevin Bacon's favorite co-stars. Print all actors that co-starred
-  with Kevin Bacon in 8 or more movies, as well as the number of movies
-  they co-starred in. Be sure that Kevin Bacon isn't in your results! 
-  Only count each movie once per actor.
-  """
-  query = """
-    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) as 'NumFilms'
-    FROM Actor AS A
-    JOIN Casts AS C ON A.id = C.actorID
-    WHERE  C.movieID IN
-      (SELECT cB.movieID
-      FROM Actor AS B
-      JOIN Casts AS cB ON B.id = cB.actorID
-      WHERE  B.fname = 'Kevin'
-        AND B.lname = 'Bacon')
-      AND A.id != 
-        (SELECT B.id
-        FROM   Actor AS B
-        WHERE  B.fname = 'Kevin'
-          AND  B.lname = 'Bacon')
-    GROUP BY A.id
-      HAVING COUNT(DISTINCT C.movieID) >= 8
-      ORDER BY NumFilms DESC;
-    """
+  start = time.time()
+  source = costar.actorIDs(db, fname, lname)
+  target = costar.actorIDs(db, "Kevin", "Bacon")
+  path = None
+  if source and target:
+    path = costar.baconPath(db, source[0], target[0])
+  end = time.time()
 
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) as 'NumFilms'
-    FROM Actor AS A
-    JOIN Casts AS C ON A.id = C.actorID
-    WHERE  C.movieID IN
-      (SELECT cB.movieID
-      FROM Actor AS B
-      JOIN Casts AS cB ON B.id = cB.actorID
-      WHERE  B.fname = 'Kevin'
-        AND B.lname = 'Bacon')
-      AND A.id != 
-        (SELECT B.id
-        FROM   Actor AS B
-        WHERE  B.fname = 'Kevin'
-          AND  B.lname = 'Bacon')
-    GROUP BY A.id
-      HAVING COUNT(DISTINCT C.movieID) >= 8
-      ORDER BY NumFilms DESC;
-    """
+  if path is None:
+    print("\n %s %s is not connected to Kevin Bacon; Completed in %.3f seconds\n "
+          % (fname, lname, end - start))
+    return
+
+  print("\n Bacon number %d; Completed in %.3f seconds\n "
+        % (len(path) - 1, end - start))
+  format = "%-20s %-20s %-40s"
+  print(format % ("fname", "lname", "linked by"))
+  print("-"*80)
+  for i, actorID in enumerate(path):
+    name = db.execute("SELECT fname, lname FROM Actor WHERE id = ?",
+                      (actorID,)).fetchone()
+    movie = ""
+    if i + 1 < len(path):
+      movie = costar.sharedMovies(db, actorID, path[i + 1])[0][1]
+    print(format % (name[0], name[1], movie))
+  return
 
-  executeQuery(db, query, params= None, explain_query=explainable_query)
-  return 
+def query10(db):
+  """
+  Query 10: Name Search
+  Ask the user for part of a name and list the actors, directors
+  and movies whose names start with it, have a word starting with
+  it, or (failing those) are spelled like it.
+  """
+  if shardRouter is not None:
+    print("\n Name search is not available on a partitioned database\n ")
+    return
 
+  text = input("Enter a name or the start of one: ")
 
-def query6(db):
-  """
-  Query 6: Versatile Actors
-  Find actors who played five or more roles in the same movie
-  during the year 2010.
-  """
-
-  query = """
-    SELECT A.fname, A.lname, M.title, COUNT(*) AS NumRoles
-    FROM Actor A
-    JOIN Casts C  ON A.id = C.actorID
-    JOIN Movie M  ON C.movieID = M.id
-    WHERE M.id IN 
-      (SELECT id
-      FROM Movie
-      WHERE year = 2010)
-    GROUP BY A.id, M.id
-    HAVING COUNT(*) >= 5
-    ORDER BY NumRoles DESC, M.title, A.fname, A.lname;
-  """
-
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-    SELECT A.fname, A.lname, M.title, COUNT(*) AS NumRoles
-    FROM Actor A
-    JOIN Casts C  ON A.id = C.actorID
-    JOIN Movie M  ON C.movieID = M.id
-    WHERE M.id IN 
-      (SELECT id
-      FROM Movie
-      WHERE year = 2010)
-    GROUP BY A.id, M.id
-    HAVING COUNT(*) >= 5
-    ORDER BY NumRoles DESC, M.title, A.fname, A.lname;
-  """
-  executeQuery(db, query, params= None, explain_query=explainable_query)
-  return 
+  if not search.hasSearch(db):
+    print("\n The database has no search tables; build them with "
+          "python3 search.py databaseName\n ")
+    return
+
+  start = time.time()
+  results = search.search(db, text)
+  end = time.time()
+
+  print()
+  writeRow = resultwriter.rowWriter(outputFormat, ["kind", "id", "name", "match"],
+                                    sys.stdout)
+  for row in results:
+    writeRow(row)
+  print("\n %s results; completed in %.3f seconds\n " % (len(results), end - start))
+  return
 
+############ HELPER FUNCTIONS ######
 
-def query7(db):
+def suggestActors(db, names):
   """
-  Query 7: Actors with Most Movies 
-  Finds the top 10 actors with the most Filmography 
+  Prints the actors whose names are closest to names the user typed,
+  for lookups that need the exact name and found nothing
+  @param db - the database cursor
+  @param names - a list of (fname, lname) as typed
+  """
+  if not search.hasSearch(db):
+    return
+  for fname, lname in names:
+    if costar.actorIDs(db, fname, lname):
+      continue
+    matches = search.search(db, "%s %s" % (fname, lname), "actor", 5)
+    if matches:
+      print(" No actor is named %s %s.  Did you mean: %s?\n "
+            % (fname, lname, ", ".join(name for kind, refID, name, match in matches)))
+
+def printAnalytics(number, params=()):
   """
-  query = """
-    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) AS TotalMovie
-    FROM Actor A
-    JOIN Casts C ON A.id = C.actorID
-    GROUP BY A.id
-    ORDER BY TotalMovie DESC
-    LIMIT 10;
+  Runs one of queries 4-7 on analyticsEngine and prints the results
+  and runtime the way executeQuery does
+  @param number - the query number
+  @param params - its parameter tuple
   """
+  start = time.time()
+  columns, results = analyticsEngine.query(number, params)
+  end = time.time()
+
+  print()
+  writeRow = resultwriter.rowWriter(outputFormat, columns, sys.stdout)
+  for row in results:
+    writeRow(row)
+  print("\n %s results; completed in %.3f seconds (analytics engine)\n "
+        % (len(results), end - start))
 
-  # build parameter-free version of the query for EXPLAIN
-  explainable_query = f"""
-    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) AS TotalMovie
-    FROM Actor A
-    JOIN Casts C ON A.id = C.actorID
-    GROUP BY A.id
-    ORDER BY TotalMovie DESC
-    LIMIT 10;
+def routeQuery(router, query, params, db=None, stop=None):
   """
-  executeQuery(db, query, params= None, explain_query=explainable_query)
-  return 
+  Runs a query on the shards of a partitioned database
+  @param router - the database's shards.ShardRouter
+  @param query - the queryregistry.Query, one with shard SQL
+  @param params - its parameter tuple
+  @param db - the connection or cursor on the shared file to merge the
+    shard rows on, or None
+  @param stop - a threading.Event that stops the shard queries once set,
+    or None
+  @return (column names, rows, names of the shards read)
+  """
+  shardSQL, mergeSQL = query.shard
+  return router.query(shardSQL, mergeSQL, params, query.year(params), db, stop,
+                      query.shardPrune)
 
-############ HELPER FUNCTIONS ######
+def explainRouted(router, query, params):
+  """
+  Prints the plan of a routed query on the first shard it runs on
+  @param router - the database's shards.ShardRouter
+  @param query - the queryregistry.Query, one with shard SQL
+  @param params - its parameter tuple
+  """
+  names = router.shards(query.year(params))
+  if names:
+    with router.connection(names[0]) as shardDB:
+      explainQuery(shardDB, query.shard[0], params)
 
-def executeQuery(db, query, params=None, explain_query=None):
+def executeQuery(db, query, params=None, explain=True):
   """
   This helper method executes the query, measures run-time
   and prints the results, runtime, and explains the query. 
-  @param db - the database cursor
-  @param query - the query to execute 
-  @param params - the params passed in the query
-  @param explain_query - parameter-free version of the query
+  Rows are fetched in batches and written as they arrive, in
+  outputFormat, so a large result is never held in memory.
+  Results are served from resultCache when the same query has
+  already been run against the current database file.  Queries
+  that run are traced by queryTracer, if it is set.  On a
+  partitioned database, queries 1-7 are run by shardRouter.
+  A query that runs is run by a querycancel.QueryRunner, so it
+  reports its progress while it runs a long time, and is stopped
+  by Ctrl-C or at queryTimeout.
+  @param db - the database cursor, on a connection opened with
+    check_same_thread=False
+  @param query - the queryregistry.Query to execute 
+  @param params - its parameter tuple, as query.bind returns it
+  @param explain - whether to print the query plan after the results
+  @return the number of result rows, or None if the query was stopped
   """
   # start timing
   start = time.time()
 
-  # execute query
-  if params is not None:
-    db.execute(query, params)
-  else:
-    db.execute(query)
+  # the SQL the query runs on this database
+  sql = queryregistry.statements(db)[query.number]
+  cached = resultCache.get(sql, params) if resultCache is not None else None
+  routed = shardRouter is not None and query.shard is not None
+  traced = None
+  if cached is None and queryTracer is not None:
+    traced = queryTracer.trace(db, query.key, sql, params)
+
+  shardNames = []
+  stop = threading.Event()
+  def begin():
+    # runs on the runner's worker thread
+    if routed:
+      columns, results, names = routeQuery(shardRouter, query, params, db, stop)
+      shardNames.extend(names)
+      return columns, [results] if results else []
+    # execute query
+    db.execute(sql, params or ())
+    return [d[0] for d in db.description], resultwriter.fetchBatches(db)
+
+  runner = None
+  if cached is None:
+    hooks = queryTracer.attach(db.connection) if traced is not None else None
+    runner = querycancel.QueryRunner(db.connection, queryTimeout,
+        chain=hooks.progress if hooks is not None else None,
+        interrupt=stop.set)
+
+  count = 0
+  first = None
+  stopped = None
+  kept = None
+  with traced or contextlib.nullcontext({}) as record:
+    try:
+      if cached is not None:
+        columns, results = cached
+        batches = [results] if results else []
+      else:
+        columns, batches = runner.run(begin)
+
+      # keep the rows for the cache only while they fit in it
+      kept = [] if cached is None and resultCache is not None else None
 
-  # fetch all results
-  results = db.fetchall()
+      print()
+      writeRow = resultwriter.rowWriter(outputFormat, columns, sys.stdout)
+      for batch in batches:
+        if first is None:
+          first = time.time()
+        for row in batch:
+          writeRow(row)
+        sys.stdout.flush()
+        count += len(batch)
+        if kept is not None:
+          kept.extend(batch)
+          if len(kept) * len(columns) > resultCache.maxCells:
+            kept = None
+    except querycancel.QueryStopped as e:
+      stopped = e
+    except KeyboardInterrupt:
+      # Ctrl-C while rows were being printed
+      stopped = querycancel.QueryCancelled("cancelled")
+    finally:
+      if runner is not None:
+        runner.close()
+    record["rows"] = count
+    if stopped is not None:
+      record["error"] = str(stopped)
 
   # 4) end timing
   end = time.time()
+  if first is None:
+    first = end
 
-  # print the number of results and time that it took for the query 
-  print("\n %s results; Completed in %.3f seconds\n " % (len(results), (end - start)))
+  if stopped is not None:
+    print("\n Query %s after %.3f seconds; %d rows printed\n "
+          % (stopped, (end - start), count))
+    return None
+
+  if kept is not None:
+    resultCache.put(sql, params, columns, kept)
 
-  # calls printResults
-  printResults(db, results)
+  # print the number of results and time that it took for the query 
+  print("\n %s results; first row in %.3f seconds; completed in %.3f seconds%s\n "
+        % (count, (first - start), (end - start),
+           " (cached)" if cached is not None else ""))
+  if routed and cached is None:
+    print(" Shards: %s\n " % (", ".join(shardNames) or "none"))
+  if traced is not None:
+    print(" Trace: %s\n " % querytrace.formatRecord(record))
 
   # calls explinQuery 
-  if explain_query:
-    explainQuery(db, explain_query)
+  if explain and routed:
+    explainRouted(shardRouter, query, params)
+  elif explain:
+    explainQuery(db, sql, params)
 
-  return results
+  return count
 
 
-############ PROVIDED METHODS - READ AND USE WHERE APPROPRIATE ######
-def printResults(db, results):
-    """
-    Prints the formatted results of an already executed query.
-    @param db - the database cursor
-    @param results - the data returned by fetchall after the query was
-    executed.
-    """
-    format = "%-20s " * len(db.description) #format template
+############ BATCH MODE ######
 
-    #print column headers
-    colNames = [db.description[i][0] for i in range(len(db.description))]
-    print(format % tuple(colNames))
-    print("-"*20*len(colNames))
+def readLookups(path):
+  """
+  Reads the lookups of a batch file
+  @param path - a JSON lines file, a CSV file (by its .csv extension), or
+    - for JSON lines on stdin
+  @return a generator of (line number, query name, parameter list)
+  @raise ValueError if a line cannot be parsed
+  """
+  f = sys.stdin if path == "-" else open(path, newline="")
+  try:
+    if path.endswith(".csv"):
+      for lineNo, row in enumerate(csv.reader(f), 1):
+        if not row or (lineNo == 1 and row[0].strip().lower() == "query"):
+          continue
+        yield lineNo, row[0], row[1:]
+      return
+    for lineNo, line in enumerate(f, 1):
+      if not line.strip():
+        continue
+      try:
+        lookup = json.loads(line)
+      except ValueError as e:
+        raise ValueError("line %d: %s" % (lineNo, e))
+      yield lineNo, lookup.get("query"), list(lookup.get("params", []))
+  finally:
+    if f is not sys.stdin:
+      f.close()
+
+def lookupSQL(db, name, params):
+  """
+  @param db - the database cursor
+  @param name - the query number or name
+  @param params - the list of parameters; those left off the end take
+    their defaults
+  @return the queryregistry.Query, the SQL it runs on the database and
+    its parameter tuple
+  @raise ValueError if the query is unknown, or its parameters are too
+    few, too many or of the wrong type
+  """
+  query = queryregistry.find(name)
+  params = query.bind(params)
+  return query, queryregistry.statements(db)[query.number], params
 
-    #print tuples
-    for row in results:
-      print(format%row)
+def openReadOnly(filename, immutable=False, mmap=False):
+  """
+  @param filename - the path of the database file
+  @param immutable - promise SQLite the file will not change while it is
+    open, so it skips file locking and change detection
+  @param mmap - memory-map the whole file, so pages are read from the OS
+    page cache without a copy
+  @return a read-only queryregistry.Connection to it
+  """
+  uri = "file:%s?mode=ro" % urllib.parse.quote(os.path.abspath(filename))
+  if immutable:
+    uri += "&immutable=1"
+  conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS,
+                         check_same_thread=False, factory=queryregistry.Connection)
+  if mmap:
+    conn.execute("PRAGMA mmap_size=%d" % os.path.getsize(filename))
+  return conn
+
+def runLookup(db, query, sql, params, out=None, lookup=None, collect=True,
+              tracer=None, stop=None):
+  """
+  Runs one lookup, on analyticsEngine if it answers the query, and times it
+  @param db - the database connection or cursor
+  @param query - the queryregistry.Query
+  @param sql - the SQL to run
+  @param params - the parameter tuple
+  @param out - a file to stream the rows to in outputFormat, or None to
+    collect them
+  @param lookup - the line number written in front of each row, or None
+  @param collect - when out is None, whether to keep the rows or only
+    count them
+  @param tracer - a querytrace.QueryTracer to trace the lookup with, or
+    None
+  @param stop - a threading.Event that stops the shard queries of a
+    partitioned database once set, or None
+  @return (columns, rows, row count, time to first row, total time), where
+    rows is None if they were streamed or not collected
+  """
+  traced = tracer.trace(db, query.key, sql, params) if tracer else None
+  start = time.perf_counter()
+  with traced or contextlib.nullcontext({}) as record:
+    if analyticsEngine is not None and analyticsEngine.answers(query.number):
+      columns, results = analyticsEngine.query(query.number, params)
+      batches = [results] if results else []
+    elif shardRouter is not None and query.shard is not None:
+      columns, results, unused = routeQuery(shardRouter, query, params, db, stop)
+      batches = [results] if results else []
+    else:
+      cursor = db.execute(sql, params)
+      columns = [d[0] for d in cursor.description]
+      batches = resultwriter.fetchBatches(cursor)
+    rows = [] if out is None and collect else None
+    writeRow = None
+    if out:
+      names = columns if lookup is None else ["lookup"] + columns
+      writeRow = resultwriter.rowWriter(outputFormat, names, out)
+    count = 0
+    first = None
+    for batch in batches:
+      if first is None:
+        first = time.perf_counter()
+      count += len(batch)
+      if writeRow:
+        for row in batch:
+          writeRow(row if lookup is None else (lookup,) + row)
+      elif rows is not None:
+        rows.extend(batch)
+    record["rows"] = count
+  end = time.perf_counter()
+  if first is None:
+    first = end
+  return columns, rows, count, first - start, end - start
+
+def mapAhead(pool, fn, items, ahead):
+  """
+  Like pool.map, but only reads items as results are taken: at most ahead
+  calls are pending at once
+  @param pool - a concurrent.futures executor
+  @param fn - the function to call on each item
+  @param items - an iterable of items
+  @param ahead - the most calls submitted but not yet taken
+  @return a generator of the results, in the order of items
+  """
+  pending = collections.deque()
+  try:
+    for item in items:
+      pending.append(pool.submit(fn, item))
+      if len(pending) >= ahead:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+  finally:
+    for future in pending:
+      future.cancel()
+
+def runBatch(args):
+  """
+  Runs --query or the lookups of a --batch file.  Results are written to
+  stdout in outputFormat, each row preceded by the lookup's line number
+  when there is more than one lookup; a latency line per lookup and a
+  summary are written to stderr.
+  @param args - the parsed command line
+  @return the exit status: 0, or 1 if any lookup failed
+  """
+  if args.query:
+    lookups = [(1, args.query, args.params)]
+  else:
+    lookups = readLookups(args.batch)
+  numbered = args.batch is not None
+  out = None if args.no_results else sys.stdout
+
+  local = threading.local()
+  def connection():
+    if not hasattr(local, "db"):
+      local.db = openReadOnly(args.filename, args.snapshot, args.snapshot)
+    return local.db
+
+  def run(lookup, stream=None):
+    lineNo, name, params = lookup
+    db = connection()
+    try:
+      query, sql, params = lookupSQL(db, name, params)
+      stop = threading.Event()
+      with querycancel.deadline(db, args.timeout, stop.set):
+        result = runLookup(db, query, sql, params, stream,
+                           lineNo if numbered else None, collect=out is not None,
+                           tracer=queryTracer, stop=stop)
+    except (ValueError, sqlite3.Error, querycancel.QueryStopped) as e:
+      return lineNo, name, params, None, e
+    return lineNo, query.key, params, result, None
+
+  print("lookup\tquery\trows\tfirst_s\ttotal_s\tparams", file=sys.stderr)
+  latencies = []
+  errors = 0
+  start = time.perf_counter()
+  pool = None
+  try:
+    if args.jobs == 1:
+      results = (run(lookup, out) for lookup in lookups)
+    else:
+      pool = concurrent.futures.ThreadPoolExecutor(args.jobs)
+      results = mapAhead(pool, run, lookups, BATCH_AHEAD * args.jobs)
+    for lineNo, name, params, result, error in results:
+      if error is not None:
+        errors += 1
+        print("%d\t%s\terror: %s" % (lineNo, name, error), file=sys.stderr)
+        continue
+      columns, rows, count, first, total = result
+      if rows is not None and out is not None:
+        writeRow = resultwriter.rowWriter(outputFormat,
+            columns if not numbered else ["lookup"] + columns, out)
+        for row in rows:
+          writeRow(row if not numbered else (lineNo,) + row)
+      if out is not None:
+        out.flush()
+      latencies.append(total)
+      print("%d\t%s\t%d\t%.6f\t%.6f\t%s"
+            % (lineNo, name, count, first, total, json.dumps(list(params))),
+            file=sys.stderr)
+  except (OSError, ValueError) as e:   # an unreadable batch file
+    print("Error: %s" % e, file=sys.stderr)
+    errors += 1
+  finally:
+    if pool is not None:
+      pool.shutdown(cancel_futures=True)
+  elapsed = time.perf_counter() - start
+
+  if latencies:
+    ordered = sorted(latencies)
+    pct = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    print("%d lookups (%d failed) in %.3f seconds, %.1f lookups/sec; "
+          "latency mean %.4f p50 %.4f p95 %.4f p99 %.4f max %.4f seconds"
+          % (len(latencies) + errors, errors, elapsed, len(latencies) / elapsed,
+             statistics.mean(latencies), pct(0.50), pct(0.95), pct(0.99),
+             ordered[-1]), file=sys.stderr)
+  return 1 if errors else 0
 
-def explainQuery(db, query):
+############ PROVIDED METHODS - READ AND USE WHERE APPROPRIATE ######
+def explainQuery(db, query, params=None):
     """
-    Prints the query plan for the given query
+    Prints the query plan for the given query, indented to show its tree
     @param db - the database cursor
     @param query - the query to explain
+    @param params - the params passed in the query
     """
-    db.execute("EXPLAIN QUERY PLAN \n "+query)
     print("\nQuery Plan:")
     print("-----------")
-    for row in db:
-      print(row[3])
+    for depth, detail in queryPlan(db, query, params):
+      print("  " * depth + detail)
+
+def queryPlan(db, query, params=None):
+    """
+    Explains the query exactly as it is run, parameters included
+    @param db - the database cursor
+    @param query - the query to explain
+    @param params - the params passed in the query
+    @return a list of (depth, detail) for the nodes of the plan tree, in
+    the order EXPLAIN QUERY PLAN lists them
+    """
+    depths = {0: -1}
+    plan = []
+    for node, parent, unused, detail in db.execute(
+        "EXPLAIN QUERY PLAN \n " + query, params or ()).fetchall():
+      depths[node] = depths.get(parent, -1) + 1
+      plan.append((depths[node], detail))
+    return plan
 
 
 def printMenu():
@@ -442,24 +803,21 @@ def printMenu():
 
   This function loops until the user enters a valid choice.  It is not
   safe against non-integer input
-  Return: an integer from 1 to 8 corresponding to the query to execute
+  Return: an integer from 1 to 10 corresponding to the query to execute
   """
   choice = -1
-  while choice < 0 or choice > 8:
+  while choice < 0 or choice > 10:
     print()
     print("Menu of options:")
     print("(0) Exit")
-    print("(1) Query 1: Cast of the Princess Bride")
-    print("(2) Query 2: Actor Filmography")
-    print("(3) Query 3: Co-stars")
-    print("(4) Query 4: Prolific Directors")
-    print("(5) Query 5: Bacon's Favorites")
-    print("(6) Query 6: Versatile Actors")
-    print("(7) Query 7: Programmer's Choice")
+    for query in queryregistry.QUERIES:
+      print("(%d) Query %d: %s" % (query.number, query.number, query.title))
     print("(8) test: test queries")
+    print("(9) Query 9: Bacon Number")
+    print("(10) Query 10: Name Search")
     choice = int(input("Enter your choice: "))
   print()
   return choice
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
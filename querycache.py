@@ -0,0 +1,145 @@
+"""
+querycache.py
+
+Description: An in-memory LRU cache of query results.  Results are keyed
+on the SQL text, its parameters and the identity of the database file
+(device, inode, size and modification time).  When createdb.py rebuilds
+or updates the file its identity changes, so earlier results can no
+longer be looked up and age out of the cache.  The cache is bounded both
+in entries and in the total number of result cells.  It can optionally
+be saved to a file on exit and reloaded on the next run; reloaded entries
+for an older version of the database are discarded.
+"""
+
+import collections
+import os
+import pickle
+
+# Default bounds: the most results kept, and the most cells (rows times
+# columns) summed over all of them.  A single result larger than the cell
+# bound is never cached.
+MAX_ENTRIES = 128
+MAX_CELLS = 1000000
+
+def fileVersion(path):
+  """
+  @param path - the path of the database file
+  @return a tuple that changes whenever the file is rewritten or replaced
+  """
+  st = os.stat(path)
+  return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def resultCells(entry):
+  """
+  @param entry - a (columns, rows) cache entry
+  @return the number of cells in the result
+  """
+  columns, rows = entry
+  return max(1, len(columns) * len(rows))
+
+class QueryCache:
+  """
+  LRU cache of (column names, rows) results for one database file
+  """
+
+  def __init__(self, path, maxEntries=MAX_ENTRIES, maxCells=MAX_CELLS,
+               persistFile=None):
+    """
+    @param path - the path of the database file whose results are cached
+    @param maxEntries - the most results to keep
+    @param maxCells - the most result cells to keep over all results
+    @param persistFile - a file to load the cache from now and save it to
+      in save(), or None to keep it in memory only
+    """
+    self.path = path
+    self.maxEntries = maxEntries
+    self.maxCells = maxCells
+    self.persistFile = persistFile
+    self.entries = collections.OrderedDict()
+    self.cells = 0
+    self.hits = 0
+    self.misses = 0
+    if persistFile:
+      self.load()
+
+  def key(self, sql, params):
+    """
+    @param sql - the SQL text of the query
+    @param params - the query parameters, or None
+    @return the cache key for the query against the current file
+    """
+    return (sql, tuple(params) if params is not None else None,
+            fileVersion(self.path))
+
+  def get(self, sql, params=None):
+    """
+    Looks up the result of a query, marking it most recently used
+    @param sql - the SQL text of the query
+    @param params - the query parameters, or None
+    @return the (columns, rows) result, or None if it is not cached
+    """
+    key = self.key(sql, params)
+    entry = self.entries.get(key)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.entries.move_to_end(key)
+    self.hits += 1
+    return entry
+
+  def put(self, sql, params, columns, rows):
+    """
+    Stores the result of a query, evicting the least recently used
+    results until the cache is within its bounds
+    @param sql - the SQL text of the query
+    @param params - the query parameters, or None
+    @param columns - the names of the result columns
+    @param rows - the list of result rows
+    """
+    entry = (tuple(columns), list(rows))
+    size = resultCells(entry)
+    if size > self.maxCells:
+      return
+    key = self.key(sql, params)
+    if key in self.entries:
+      self.cells -= resultCells(self.entries.pop(key))
+    self.entries[key] = entry
+    self.cells += size
+    while len(self.entries) > self.maxEntries or self.cells > self.maxCells:
+      self.cells -= resultCells(self.entries.popitem(last=False)[1])
+
+  def clear(self):
+    """
+    Empties the cache
+    """
+    self.entries.clear()
+    self.cells = 0
+
+  def load(self):
+    """
+    Reloads the entries saved by save() that are still valid for the
+    current version of the database file.  A missing or unreadable file
+    leaves the cache empty.
+    """
+    try:
+      with open(self.persistFile, "rb") as f:
+        saved = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+      return
+    version = fileVersion(self.path)
+    for key, entry in saved:
+      if key[2] == version:
+        self.put(key[0], key[1], *entry)
+
+  def save(self):
+    """
+    Writes the cache to its persist file, if it has one.  The file is
+    written under a temporary name and renamed into place, so a reader
+    never sees a partial file.
+    """
+    if not self.persistFile:
+      return
+    tmp = self.persistFile + ".tmp"
+    with open(tmp, "wb") as f:
+      pickle.dump(list(self.entries.items()), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, self.persistFile)
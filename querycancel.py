@@ -0,0 +1,265 @@
+"""
+querycancel.py
+
+Description: Time limits and cancellation for queryDB.py.  Once
+Cursor.execute starts a statement, the calling thread cannot do anything
+else until SQLite returns.  So a QueryRunner runs the statement on a worker
+thread, which hands the result rows back in batches, and the calling
+thread stays free to:
+  - print the rows as they arrive;
+  - report progress (elapsed time, VM steps, rows so far) while a query
+    runs a long time without returning rows;
+  - stop the query when Ctrl-C is pressed or its time limit passes.
+
+A query is stopped in two ways at once.  Connection.interrupt() aborts it
+at SQLite's next check, and the runner's progress handler returns nonzero
+the next time SQLite calls it.  The query then fails with "interrupted",
+which the runner turns into QueryCancelled or QueryTimedOut.  The
+connection stays usable.
+
+deadline() applies only the time limit to a query run on the calling
+thread, as batch mode does.
+"""
+
+import contextlib
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+import querytrace
+
+# Seconds between progress reports while a query runs without returning
+# rows
+PROGRESS_SECONDS = 2.0
+
+# Result batches the worker may fetch ahead of the rows printed
+QUEUE_BATCHES = 4
+
+class QueryStopped(Exception):
+  """
+  A query was stopped before it finished
+  """
+
+class QueryCancelled(QueryStopped):
+  """
+  A query was cancelled with Ctrl-C
+  """
+
+class QueryTimedOut(QueryStopped):
+  """
+  A query ran past its time limit
+  """
+
+def isInterrupted(error):
+  """
+  @param error - an exception raised by a query
+  @return True if SQLite stopped the query because it was interrupted
+  """
+  return isinstance(error, sqlite3.OperationalError) and "interrupted" in str(error)
+
+@contextlib.contextmanager
+def deadline(conn, seconds, interrupt=None):
+  """
+  Interrupts the statements run in a with block once it has run for the
+  given time
+  @param conn - the connection the statements run on
+  @param seconds - the time limit, or None for none
+  @param interrupt - a function also called at the time limit, e.g. the
+    set method of the stop event given to shards.ShardRouter.query, or None
+  @raise QueryTimedOut if the time limit passed
+  """
+  if seconds is None:
+    yield
+    return
+  conn = getattr(conn, "connection", conn)
+  expired = threading.Event()
+  def stop():
+    expired.set()
+    conn.interrupt()
+    if interrupt is not None:
+      interrupt()
+  timer = threading.Timer(seconds, stop)
+  timer.daemon = True
+  timer.start()
+  try:
+    yield
+  except sqlite3.OperationalError as e:
+    if expired.is_set() and isInterrupted(e):
+      raise QueryTimedOut("timed out (%g-second limit)" % seconds)
+    raise
+  finally:
+    timer.cancel()
+
+class QueryRunner:
+  """
+  Runs one query on a worker thread and hands its rows back to the calling
+  thread, which reports progress and can stop the query
+  """
+  def __init__(self, conn, timeout=None, out=sys.stderr, interval=PROGRESS_SECONDS,
+               chain=None, interrupt=None):
+    """
+    @param conn - the connection the query runs on, opened with
+      check_same_thread=False
+    @param timeout - the most seconds the query may run, or None
+    @param out - the file progress reports are written to
+    @param interval - the seconds between progress reports
+    @param chain - a progress handler already installed on the connection,
+      e.g. a querytrace.ConnectionTrace's; the runner's handler calls it,
+      and it is put back afterwards
+    @param interrupt - a function that also stops the query, for work the
+      connection does not run itself (the set method of the stop event
+      given to shards.ShardRouter.query), or None
+    """
+    self.conn = getattr(conn, "connection", conn)
+    self.timeout = timeout
+    self.out = out
+    self.interval = interval
+    self.chain = chain
+    self.interrupt = interrupt
+    self.batches = queue.Queue(QUEUE_BATCHES)
+    self.worker = None
+    self.stopped = None      # QueryCancelled or QueryTimedOut once stopping
+    self.done = False
+    self.steps = 0
+    self.rows = 0
+    self.start = None
+
+  def progress(self):
+    """
+    The progress handler installed while the query runs
+    @return nonzero to abort the query once it is being stopped
+    """
+    self.steps += 1
+    if self.chain is not None:
+      self.chain()
+    return 1 if self.stopped is not None else 0
+
+  def run(self, begin):
+    """
+    Starts a query on the worker thread and waits for its first rows
+    @param begin - a function run on the worker thread that starts the
+      query and returns (column names, iterable of row batches)
+    @return (column names, generator of row batches); the generator must
+      be consumed, or close() called
+    @raise QueryCancelled or QueryTimedOut if the query was stopped
+    """
+    def work():
+      try:
+        columns, batches = begin()
+        self.batches.put(("columns", columns))
+        for batch in batches:
+          self.batches.put(("batch", batch))
+        self.batches.put(("done", None))
+      except BaseException as e:
+        self.batches.put(("error", e))
+
+    self.start = time.monotonic()
+    self.conn.set_progress_handler(self.progress, querytrace.PROGRESS_STEPS)
+    self.worker = threading.Thread(target=work, daemon=True)
+    self.worker.start()
+    kind, value = self.wait()
+    return value, self.fetch()
+
+  def fetch(self):
+    """
+    @return a generator of the row batches, as the worker fetches them
+    """
+    try:
+      while True:
+        kind, value = self.wait()
+        if kind == "done":
+          self.done = True
+          return
+        self.rows += len(value)
+        yield value
+    finally:
+      self.close()
+
+  def wait(self):
+    """
+    Waits for the worker's next message, reporting progress and stopping
+    the query at Ctrl-C or its time limit
+    @return the message: ("columns", names), ("batch", rows) or ("done", None)
+    @raise the worker's error, or QueryCancelled or QueryTimedOut
+    """
+    lastReport = time.monotonic()
+    while True:
+      wait = self.interval
+      if self.timeout is not None and self.stopped is None:
+        wait = min(wait, max(0.0, self.start + self.timeout - time.monotonic()))
+      try:
+        kind, value = self.batches.get(timeout=wait)
+      except queue.Empty:
+        elapsed = time.monotonic() - self.start
+        if self.timeout is not None and elapsed >= self.timeout and self.stopped is None:
+          self.stop(QueryTimedOut("timed out (%g-second limit)" % self.timeout))
+        elif self.stopped is None and time.monotonic() - lastReport >= self.interval:
+          self.report(elapsed)
+          lastReport = time.monotonic()
+        continue
+      except KeyboardInterrupt:
+        if self.stopped is None:
+          self.stop(QueryCancelled("cancelled"))
+        continue
+      if kind == "error":
+        self.finish()
+        if self.stopped is not None and isInterrupted(value):
+          raise self.stopped
+        raise value
+      if self.stopped is not None:
+        if kind != "done":
+          continue   # drain the worker until it notices
+        self.finish()
+        raise self.stopped
+      return kind, value
+
+  def report(self, elapsed):
+    """
+    Prints how far a long-running query has got
+    @param elapsed - the seconds it has run so far
+    """
+    print(" ... running for %.1f seconds: %d VM steps, %d rows so far "
+          "(Ctrl-C to cancel)" % (elapsed, self.steps * querytrace.PROGRESS_STEPS,
+                                  self.rows), file=self.out)
+    self.out.flush()
+
+  def stop(self, reason):
+    """
+    Stops the query
+    @param reason - the QueryCancelled or QueryTimedOut to raise for it
+    """
+    self.stopped = reason
+    self.conn.interrupt()
+    if self.interrupt is not None:
+      self.interrupt()
+
+  def finish(self):
+    """
+    Waits for the worker to end and puts the connection's progress
+    handler back
+    """
+    if self.worker is not None:
+      self.worker.join()
+      self.worker = None
+      if self.chain is not None:
+        self.conn.set_progress_handler(self.chain, querytrace.PROGRESS_STEPS)
+      else:
+        self.conn.set_progress_handler(None, 0)
+
+  def close(self):
+    """
+    Stops the query if it is still running, e.g. when the rows stop being
+    read, and waits for the worker to end
+    """
+    if self.worker is None:
+      return
+    if self.worker.is_alive() and self.stopped is None and not self.done:
+      self.stop(QueryCancelled("cancelled"))
+    while self.worker is not None and self.worker.is_alive():
+      try:
+        self.batches.get(timeout=0.05)   # unblock a worker waiting to hand over rows
+      except queue.Empty:
+        pass
+    self.finish()
@@ -0,0 +1,557 @@
+"""
+queryregistry.py
+
+Description: The registry of the movie database queries.  Each query is
+defined once, as a Query: its number, the name batch mode and server.py
+know it by, its menu title, its parameterized SQL, and its parameters,
+each with a type and, where the query has one, a default.  The same entry
+holds the variants of the SQL: the one reading derived tables when the
+database has them (the filmography snapshot, the summary tables, the
+co-star graph), and the pair of statements that run it on a partitioned
+database (see shards.py).
+
+queryDB.py builds its menu, batch lookups and query plans from the
+registry, and server.py its endpoints; indexadvisor.py, planguard.py and
+benchmark.py take their workload from it.  The SQL is never built from
+user input, so each connection compiles each statement once and reuses
+it from its statement cache.  Which variant a connection runs is also
+worked out once per connection (statements(), on a Connection), and again
+only when its schema changes.
+"""
+
+import sqlite3
+
+import costar
+import filmography
+import summaries
+
+############ QUERY SQL ##########################
+
+# Cast of a movie (title)
+QUERY1_SQL = """SELECT DISTINCT A.fname, A.lname 
+          FROM Actor AS A
+          JOIN Casts AS C ON A.id = C.actorID
+          JOIN Movie AS M ON C.movieID = M.id
+          WHERE M.title = ?
+          ORDER BY A.fname, A.lname 
+          """
+
+# Actor filmography (fname, lname)
+QUERY2_SQL = """
+      SELECT DISTINCT M.title
+      FROM Actor AS A
+      JOIN Casts AS C ON A.id = C.actorID
+      JOIN Movie AS M ON C.movieID = M.id
+      WHERE A.fname = ?
+        AND A.lname = ?
+      ORDER BY M.title
+      """
+
+# Co-starred movies (fname1, lname1, fname2, lname2)
+QUERY3_SQL = """
+      SELECT DISTINCT M.id, M.title
+      FROM Actor AS A
+      JOIN Casts AS C ON A.id = C.actorID
+      JOIN Movie AS M ON C.movieID = M.id
+      WHERE A.fname = ?
+        AND A.lname = ?
+
+      INTERSECT
+
+      SELECT DISTINCT M.id, M.title
+      FROM Actor AS A
+      JOIN Casts AS C ON A.id = C.actorID
+      JOIN Movie AS M ON C.movieID = M.id
+      WHERE A.fname = ?
+        AND A.lname = ?
+
+      """
+
+# Prolific directors
+QUERY4_SQL = """
+      SELECT DISTINCT D.fname, D.lname, COUNT(M.id) AS FilmCount
+      FROM Director AS D
+      JOIN DirectsMovie AS DM ON DM.directorID = D.id
+      JOIN Movie AS M ON DM.movieID = M.id
+      GROUP BY DM.directorID
+      HAVING COUNT(M.id) >= 500
+      ORDER BY COUNT(M.id) DESC;
+      """
+
+# An actor's favorite co-stars (fname, lname); ?1 and ?2 are each used
+# twice
+QUERY5_SQL = """
+    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) as 'NumFilms'
+    FROM Actor AS A
+    JOIN Casts AS C ON A.id = C.actorID
+    WHERE  C.movieID IN
+      (SELECT cB.movieID
+      FROM Actor AS B
+      JOIN Casts AS cB ON B.id = cB.actorID
+      WHERE  B.fname = ?1
+        AND B.lname = ?2)
+      AND A.id != 
+        (SELECT B.id
+        FROM   Actor AS B
+        WHERE  B.fname = ?1
+          AND  B.lname = ?2)
+    GROUP BY A.id
+      HAVING COUNT(DISTINCT C.movieID) >= 8
+      ORDER BY NumFilms DESC;
+    """
+
+# An actor's favorite co-stars, read from the CoStar graph when it has
+# been built (createdb.py --costar).  A name that several actors share is
+# answered from Casts, as QUERY5_SQL answers it: a co-star's films are
+# counted once over the movies of all of them, which the per-pair counts
+# of CoStar cannot be added up to.  The test of the name sits inside the
+# movie list, so for a single actor that half reads no Casts rows.
+QUERY5_COSTAR_SQL = """
+    SELECT A.fname, A.lname, S.numFilms AS 'NumFilms'
+    FROM CoStar AS S
+    JOIN Actor AS A ON A.id = S.costarID
+    WHERE S.actorID =
+        (SELECT B.id
+        FROM   Actor AS B
+        WHERE  B.fname = ?1
+          AND  B.lname = ?2)
+      AND S.numFilms >= 8
+      AND (SELECT COUNT(*)
+          FROM   Actor AS B
+          WHERE  B.fname = ?1
+            AND  B.lname = ?2) = 1
+
+    UNION ALL
+
+    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID)
+    FROM Actor AS A
+    JOIN Casts AS C ON A.id = C.actorID
+    WHERE  C.movieID IN
+      (SELECT cB.movieID
+      FROM Actor AS B
+      JOIN Casts AS cB ON B.id = cB.actorID
+      WHERE  B.fname = ?1
+        AND B.lname = ?2
+        AND (SELECT COUNT(*)
+            FROM   Actor AS B
+            WHERE  B.fname = ?1
+              AND  B.lname = ?2) > 1)
+      AND A.id !=
+        (SELECT B.id
+        FROM   Actor AS B
+        WHERE  B.fname = ?1
+          AND  B.lname = ?2)
+    GROUP BY A.id
+      HAVING COUNT(DISTINCT C.movieID) >= 8
+    ORDER BY NumFilms DESC;
+    """
+
+# Actors with 5+ roles in one movie of a year (year)
+QUERY6_SQL = """
+    SELECT A.fname, A.lname, M.title, COUNT(*) AS NumRoles
+    FROM Actor A
+    JOIN Casts C  ON A.id = C.actorID
+    JOIN Movie M  ON C.movieID = M.id
+    WHERE M.id IN 
+      (SELECT id
+      FROM Movie
+      WHERE year = ?)
+    GROUP BY A.id, M.id
+    HAVING COUNT(*) >= 5
+    ORDER BY NumRoles DESC, M.title, A.fname, A.lname;
+  """
+
+# Top 10 actors by film count
+QUERY7_SQL = """
+    SELECT A.fname, A.lname, COUNT(DISTINCT C.movieID) AS TotalMovie
+    FROM Actor A
+    JOIN Casts C ON A.id = C.actorID
+    GROUP BY A.id
+    ORDER BY TotalMovie DESC
+    LIMIT 10;
+  """
+
+# Queries 1 and 2 read one key range of the filmography snapshot, already
+# in output order, when it has been built (createdb.py --filmography)
+QUERY1_SNAPSHOT_SQL = """
+      SELECT fname, lname
+      FROM MovieCast
+      WHERE title = ?
+      ORDER BY fname, lname
+      """
+
+QUERY2_SNAPSHOT_SQL = """
+      SELECT title
+      FROM ActorFilmography
+      WHERE fname = ?
+        AND lname = ?
+      ORDER BY title
+      """
+
+# Queries 4, 6 and 7 read from the summary tables maintained by
+# summaries.py when the database has them
+QUERY4_SUMMARY_SQL = """
+      SELECT DISTINCT D.fname, D.lname, F.numFilms AS FilmCount
+      FROM DirectorFilmCount AS F
+      JOIN Director AS D ON D.id = F.directorID
+      WHERE F.numFilms >= 500
+      ORDER BY F.numFilms DESC;
+      """
+
+QUERY6_SUMMARY_SQL = """
+    SELECT A.fname, A.lname, M.title, R.numRoles AS NumRoles
+    FROM ActorMovieRoles R
+    JOIN Actor A  ON A.id = R.actorID
+    JOIN Movie M  ON M.id = R.movieID
+    WHERE R.numRoles >= 5
+      AND M.year = ?
+    ORDER BY NumRoles DESC, M.title, A.fname, A.lname;
+  """
+
+QUERY7_SUMMARY_SQL = """
+    SELECT A.fname, A.lname, F.numFilms AS TotalMovie
+    FROM ActorFilmCount F
+    JOIN Actor A ON A.id = F.actorID
+    ORDER BY F.numFilms DESC
+    LIMIT 10;
+  """
+
+# How queries run on a partitioned database: the SQL run on every shard,
+# with the shared file attached, and the SQL merging their rows from
+# temp.Part.  Every row about a movie is in the movie's shard, so
+# per-movie joins and counts are complete within a shard, and per-actor
+# and per-director counts are summed across shards.
+QUERY1_MERGE_SQL = """
+      SELECT DISTINCT fname, lname
+      FROM Part
+      ORDER BY fname, lname
+      """
+
+QUERY2_MERGE_SQL = """
+      SELECT DISTINCT title
+      FROM Part
+      ORDER BY title
+      """
+
+QUERY3_MERGE_SQL = """
+      SELECT DISTINCT id, title
+      FROM Part
+      ORDER BY id, title
+      """
+
+QUERY4_SHARD_SQL = """
+      SELECT DM.directorID, COUNT(M.id) AS numFilms
+      FROM DirectsMovie AS DM
+      JOIN Movie AS M ON DM.movieID = M.id
+      GROUP BY DM.directorID
+      """
+
+QUERY4_MERGE_SQL = """
+      SELECT DISTINCT D.fname, D.lname, SUM(P.numFilms) AS FilmCount
+      FROM Part AS P
+      JOIN Director AS D ON D.id = P.directorID
+      GROUP BY P.directorID
+      HAVING SUM(P.numFilms) >= 500
+      ORDER BY SUM(P.numFilms) DESC;
+      """
+
+# Queries 4 and 7 only need some directors' and actors' counts from each
+# shard: those with at least a share of a total, or a shard's top actors,
+# and then every shard's counts for them (see
+# shards.ShardRouter.prunedFanOut)
+QUERY4_LEAST_SQL = """
+      SELECT DM.directorID, COUNT(M.id) AS numFilms
+      FROM DirectsMovie AS DM
+      JOIN Movie AS M ON DM.movieID = M.id
+      GROUP BY DM.directorID
+      HAVING COUNT(M.id) >= ?
+      """
+
+QUERY4_KEYS_SQL = """
+      SELECT DM.directorID, COUNT(M.id) AS numFilms
+      FROM DirectsMovie AS DM
+      JOIN Movie AS M ON DM.movieID = M.id
+      WHERE DM.directorID IN (SELECT value FROM json_each(?))
+      GROUP BY DM.directorID
+      """
+
+QUERY5_SHARD_SQL = """
+    SELECT C.actorID, COUNT(DISTINCT C.movieID) AS numFilms
+    FROM Casts AS C
+    WHERE  C.movieID IN
+      (SELECT cB.movieID
+      FROM Actor AS B
+      JOIN Casts AS cB ON B.id = cB.actorID
+      WHERE  B.fname = ?1
+        AND B.lname = ?2)
+      AND C.actorID !=
+        (SELECT B.id
+        FROM   Actor AS B
+        WHERE  B.fname = ?1
+          AND  B.lname = ?2)
+    GROUP BY C.actorID
+    """
+
+QUERY5_MERGE_SQL = """
+    SELECT A.fname, A.lname, SUM(P.numFilms) AS 'NumFilms'
+    FROM Part AS P
+    JOIN Actor AS A ON A.id = P.actorID
+    GROUP BY P.actorID
+      HAVING SUM(P.numFilms) >= 8
+      ORDER BY NumFilms DESC;
+    """
+
+QUERY6_MERGE_SQL = """
+    SELECT fname, lname, title, NumRoles
+    FROM Part
+    ORDER BY NumRoles DESC, title, fname, lname;
+  """
+
+QUERY7_SHARD_SQL = """
+    SELECT C.actorID, COUNT(DISTINCT C.movieID) AS numFilms
+    FROM Casts C
+    GROUP BY C.actorID
+  """
+
+QUERY7_LEAST_SQL = """
+    SELECT C.actorID, COUNT(DISTINCT C.movieID) AS numFilms
+    FROM Casts C
+    GROUP BY C.actorID
+    HAVING COUNT(DISTINCT C.movieID) >= ?
+  """
+
+QUERY7_TOP_SQL = """
+    SELECT C.actorID, COUNT(DISTINCT C.movieID) AS numFilms
+    FROM Casts C
+    GROUP BY C.actorID
+    ORDER BY numFilms DESC
+    LIMIT ?
+  """
+
+QUERY7_KEYS_SQL = """
+    SELECT C.actorID, COUNT(DISTINCT C.movieID) AS numFilms
+    FROM Casts C
+    WHERE C.actorID IN (SELECT value FROM json_each(?))
+    GROUP BY C.actorID
+  """
+
+QUERY7_MERGE_SQL = """
+    SELECT A.fname, A.lname, T.TotalMovie
+    FROM (SELECT actorID, SUM(numFilms) AS TotalMovie
+          FROM Part
+          GROUP BY actorID
+          ORDER BY TotalMovie DESC
+          LIMIT 10) AS T
+    JOIN Actor A ON A.id = T.actorID
+    ORDER BY TotalMovie DESC;
+  """
+
+############ THE REGISTRY ##########################
+
+# How each parameter type is described in error messages
+TYPE_NAMES = {str: "text", int: "an integer"}
+
+class Param:
+  """
+  A typed parameter of a query
+  """
+  def __init__(self, name, prompt, type=str, default=None):
+    """
+    @param name - its name, e.g. the server.py query string argument
+    @param prompt - what the menu asks for it
+    @param type - str or int
+    @param default - the value used when it is not given, or None if it
+      must be
+    """
+    self.name = name
+    self.prompt = prompt
+    self.type = type
+    self.default = default
+
+  def parse(self, value):
+    """
+    @param value - the value given, e.g. typed at the menu or read from a
+      batch file
+    @return the value as the parameter's type
+    @raise ValueError if it is not one
+    """
+    try:
+      return self.type(value)
+    except (TypeError, ValueError):
+      raise ValueError("%s must be %s, got %r" % (self.name, TYPE_NAMES[self.type], value))
+
+class Query:
+  """
+  One query of the movie database, with its parameters and the variants
+  of its SQL
+  """
+  def __init__(self, number, name, title, sql, params=(), sample=None,
+               derived=None, shard=None, shardYear=None, shardPrune=None,
+               actors=()):
+    """
+    @param number - the query number, shown in the menu
+    @param name - the name batch mode and server.py know it by
+    @param title - its menu title
+    @param sql - its SQL, with a ? (or ?N) for each parameter
+    @param params - its Params, in order; those with defaults come last
+    @param sample - parameters to measure it with (indexadvisor.py,
+      planguard.py, benchmark.py), by default the defaults
+    @param derived - (test, sql): a function of a connection that is True
+      if the database has the derived tables the SQL reads, or None
+    @param shard - (shard SQL, merge SQL) that run it on a partitioned
+      database (see shards.ShardRouter.query), or None
+    @param shardYear - the name of the parameter limiting it to the shards
+      holding one year, or None
+    @param shardPrune - how the shards prune the per-key counts of the
+      shard SQL (see shards.ShardRouter.prunedFanOut), or None
+    @param actors - pairs of parameter names (fname, lname) that name
+      actors, so a misspelled name can be suggested a correction
+    """
+    self.number = number
+    self.key = "query%d" % number
+    self.name = name
+    self.title = title
+    self.sql = sql
+    self.params = list(params)
+    self.sample = tuple(sample if sample is not None
+                        else (p.default for p in self.params))
+    self.derived = derived
+    self.shard = shard
+    self.shardYear = shardYear
+    self.shardPrune = shardPrune
+    self.actors = list(actors)
+
+  def bind(self, values):
+    """
+    @param values - the parameter values given, in order; those with
+      defaults may be left off the end
+    @return the parameter tuple to run the query with, typed and with the
+      defaults filled in
+    @raise ValueError if too few or too many values are given, or one has
+      the wrong type
+    """
+    required = sum(1 for p in self.params if p.default is None)
+    if not required <= len(values) <= len(self.params):
+      expected = ("%d" % required if required == len(self.params)
+                  else "%d to %d" % (required, len(self.params)))
+      raise ValueError("%s takes %s parameters, got %d"
+                       % (self.key, expected, len(values)))
+    return (tuple(p.parse(v) for p, v in zip(self.params, values))
+            + tuple(p.default for p in self.params[len(values):]))
+
+  def resolve(self, db):
+    """
+    @param db - the database connection or cursor
+    @return the SQL the query runs on the database: the derived-table
+      variant if the database has its tables, the original otherwise
+    """
+    if self.derived is not None and self.derived[0](db):
+      return self.derived[1]
+    return self.sql
+
+  def year(self, params):
+    """
+    @param params - the parameter tuple, as bind returns it
+    @return the year the query is limited to, or None
+    """
+    if self.shardYear is None:
+      return None
+    return params[[p.name for p in self.params].index(self.shardYear)]
+
+  def actorNames(self, params):
+    """
+    @param params - the parameter tuple, as bind returns it
+    @return the (fname, lname) of each actor named in the parameters
+    """
+    value = dict(zip((p.name for p in self.params), params))
+    return [(value[fname], value[lname]) for fname, lname in self.actors]
+
+QUERIES = [
+  Query(1, "cast", "Cast of a Movie", QUERY1_SQL,
+        [Param("title", "Enter a movie title", default="The Princess Bride")],
+        derived=(filmography.hasFilmography, QUERY1_SNAPSHOT_SQL),
+        shard=(QUERY1_SQL, QUERY1_MERGE_SQL)),
+  Query(2, "filmography", "Actor Filmography", QUERY2_SQL,
+        [Param("fname", "Enter Actor's first name"),
+         Param("lname", "Enter Actor's last name")],
+        sample=("Kevin", "Bacon"),
+        derived=(filmography.hasFilmography, QUERY2_SNAPSHOT_SQL),
+        shard=(QUERY2_SQL, QUERY2_MERGE_SQL),
+        actors=[("fname", "lname")]),
+  Query(3, "costars", "Co-stars", QUERY3_SQL,
+        [Param("fname1", "Enter first actor's first name"),
+         Param("lname1", "Enter first actor's last name"),
+         Param("fname2", "Enter second actor's first name"),
+         Param("lname2", "Enter second actor's last name")],
+        sample=("Kevin", "Bacon", "Tom", "Hanks"),
+        shard=(QUERY3_SQL, QUERY3_MERGE_SQL),
+        actors=[("fname1", "lname1"), ("fname2", "lname2")]),
+  Query(4, "directors", "Prolific Directors", QUERY4_SQL,
+        derived=(summaries.hasSummaries, QUERY4_SUMMARY_SQL),
+        shard=(QUERY4_SHARD_SQL, QUERY4_MERGE_SQL),
+        shardPrune=(500, None, QUERY4_LEAST_SQL, None, QUERY4_KEYS_SQL)),
+  Query(5, "bacon", "Favorite Co-stars", QUERY5_SQL,
+        [Param("fname", "Enter Actor's first name", default="Kevin"),
+         Param("lname", "Enter Actor's last name", default="Bacon")],
+        derived=(costar.hasCoStar, QUERY5_COSTAR_SQL),
+        shard=(QUERY5_SHARD_SQL, QUERY5_MERGE_SQL),
+        actors=[("fname", "lname")]),
+  Query(6, "versatile", "Versatile Actors", QUERY6_SQL,
+        [Param("year", "Enter a year", int, default=2010)],
+        derived=(summaries.hasSummaries, QUERY6_SUMMARY_SQL),
+        shard=(QUERY6_SQL, QUERY6_MERGE_SQL), shardYear="year"),
+  Query(7, "top", "Programmer's Choice", QUERY7_SQL,
+        derived=(summaries.hasSummaries, QUERY7_SUMMARY_SQL),
+        shard=(QUERY7_SHARD_SQL, QUERY7_MERGE_SQL),
+        shardPrune=(None, 10, QUERY7_LEAST_SQL, QUERY7_TOP_SQL, QUERY7_KEYS_SQL)),
+]
+
+# The queries by number and by name
+BY_NUMBER = {query.number: query for query in QUERIES}
+BY_NAME = {query.name: query for query in QUERIES}
+
+# Query name, SQL and sample parameters for each query, used as the
+# default workload by indexadvisor.py
+WORKLOAD = [(query.key, query.sql, query.sample) for query in QUERIES]
+
+def find(name):
+  """
+  @param name - a query number, "queryN", or the name of a query
+  @return the Query
+  @raise ValueError if the name is not a known query
+  """
+  name = str(name).strip().lower()
+  if name.startswith("query"):
+    name = name[len("query"):]
+  query = BY_NAME.get(name)
+  if query is None and name.isdigit():
+    query = BY_NUMBER.get(int(name))
+  if query is None:
+    raise ValueError("unknown query %r" % name)
+  return query
+
+class Connection(sqlite3.Connection):
+  """
+  A connection that keeps the SQL it runs for each query (see
+  statements()), so the cache goes away with the connection.  Pass it to
+  sqlite3.connect as the factory.
+  """
+  # (schema version, {number: SQL}) once statements() has run
+  statementSQL = None
+
+def statements(db):
+  """
+  @param db - the database connection or cursor
+  @return a dict mapping each query number to the SQL it runs on the
+    connection, worked out again only when the connection's schema changes
+    (e.g. createdb.py --update builds the summary tables).  It is only kept
+    on a Connection; other connections work it out on every call.
+  """
+  conn = getattr(db, "connection", db)
+  version = conn.execute("PRAGMA schema_version").fetchone()[0]
+  entry = getattr(conn, "statementSQL", None)
+  if entry is None or entry[0] != version:
+    entry = (version, {query.number: query.resolve(conn) for query in QUERIES})
+    if isinstance(conn, Connection):
+      conn.statementSQL = entry
+  return entry[1]
@@ -0,0 +1,236 @@
+"""
+querytrace.py
+
+Description: Query tracing for queryDB.py and server.py.  A QueryTracer
+hooks each connection it is attached to with set_trace_callback, which
+reports every statement SQLite runs with its parameters bound, and
+set_progress_handler, which counts virtual machine steps.  Each execution
+wrapped in trace() records its latency, the rows returned, the VM steps
+and statements run, and the statement's sorts, full scan steps and
+automatic index rows (see sqlitestatus).
+
+The latencies of the last WINDOW executions of each query are kept as a
+rolling histogram.  An execution slower than the threshold is appended
+to the slow-query log, one JSON line per execution, with its parameters
+and query plan, so tail latency can be traced to a query and its inputs.
+"""
+
+import bisect
+import collections
+import contextlib
+import datetime
+import json
+import threading
+import time
+import weakref
+
+import sqlitestatus
+
+# Executions kept per query for the latency histogram
+WINDOW = 1000
+
+# Executions slower than this many seconds are written to the slow log
+SLOW_SECONDS = 0.1
+
+# VM instructions between calls of the progress handler, so it costs
+# little; VM steps are counted to this granularity
+PROGRESS_STEPS = 1000
+
+# Upper bounds, in seconds, of the latency histogram's buckets
+BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]
+
+class ConnectionTrace:
+  """
+  The hooks installed on one connection and what they counted during the
+  current execution.  Statements run outside an execution are not kept.
+  """
+  def __init__(self, conn):
+    self.active = False
+    self.progressCalls = 0
+    self.statements = []
+    conn.set_trace_callback(self.traced)
+    conn.set_progress_handler(self.progress, PROGRESS_STEPS)
+
+  def traced(self, statement):
+    if self.active:
+      self.statements.append(statement)
+
+  def progress(self):
+    self.progressCalls += 1
+    return 0   # never abort the statement
+
+  def start(self):
+    self.active = True
+    self.progressCalls = 0
+    self.statements = []
+
+  def stop(self):
+    self.active = False
+
+class QueryTracer:
+  """
+  Traces query executions on any number of connections, which may be used
+  from different threads (each by one thread at a time)
+  """
+  def __init__(self, threshold=SLOW_SECONDS, slowLog=None, window=WINDOW,
+               explain=None):
+    """
+    @param threshold - the seconds above which an execution is slow
+    @param slowLog - the file to append slow executions to, or None
+    @param window - the executions of each query kept for its histogram
+    @param explain - a function (db, sql, params) returning the query plan
+      as a list of (depth, detail), e.g. queryDB.queryPlan; None logs no
+      plan
+    """
+    self.threshold = threshold
+    self.window = window
+    self.explain = explain
+    self.slowLog = open(slowLog, "a") if slowLog else None
+    # connection -> ConnectionTrace, dropped when the connection goes away
+    self.connections = weakref.WeakKeyDictionary()
+    self.latencies = collections.defaultdict(
+        lambda: collections.deque(maxlen=self.window))
+    self.slowCount = collections.Counter()
+    self.lock = threading.Lock()
+
+  def attach(self, conn):
+    """
+    Installs the trace and progress hooks on a connection, once
+    @param conn - a connection of a sqlite3.Connection subclass, e.g. a
+      queryregistry.Connection, so it can be weakly referenced; its entry
+      goes away with it
+    @return its ConnectionTrace
+    """
+    with self.lock:
+      hooks = self.connections.get(conn)
+      if hooks is None:
+        hooks = self.connections[conn] = ConnectionTrace(conn)
+      return hooks
+
+  @contextlib.contextmanager
+  def trace(self, db, name, sql, params=None):
+    """
+    Traces the statements run in a with block as one execution of a query.
+    The block sets the "rows" entry of the record it is given.
+    @param db - the connection or cursor the query runs on
+    @param name - the query's name, e.g. "query2"
+    @param sql - the query's SQL
+    @param params - its parameters
+    """
+    conn = getattr(db, "connection", db)
+    hooks = self.attach(conn)
+    before = sqlitestatus.statementCounters(conn, sql)
+    record = {"query": name, "rows": None}
+    hooks.start()
+    start = time.perf_counter()
+    try:
+      yield record
+    except Exception as e:
+      record["error"] = str(e)
+      raise
+    finally:
+      record["seconds"] = time.perf_counter() - start
+      hooks.stop()
+      record["vmSteps"] = hooks.progressCalls * PROGRESS_STEPS
+      changes = sqlitestatus.counterChanges(before, sqlitestatus.statementCounters(conn, sql))
+      for name, column in sqlitestatus.COUNTERS:
+        record[name] = changes[name] if changes is not None else None
+      record["statements"] = hooks.statements
+      self.finish(conn, record, sql, params)
+
+  def finish(self, conn, record, sql, params):
+    """
+    Adds an execution to its query's histogram, and to the slow log if it
+    was slow
+    """
+    with self.lock:
+      self.latencies[record["query"]].append(record["seconds"])
+      slow = record["seconds"] > self.threshold
+      if slow:
+        self.slowCount[record["query"]] += 1
+    record["slow"] = slow
+    if not slow or self.slowLog is None:
+      return
+    entry = dict(record, time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                 sql=sql, params=list(params or ()))
+    if self.explain is not None:
+      try:
+        entry["plan"] = [[depth, detail] for depth, detail
+                         in self.explain(conn, sql, params)]
+      except Exception as e:   # e.g. interrupted at a deadline
+        entry["plan"] = None
+        entry["planError"] = str(e)
+    line = json.dumps(entry, default=str)
+    with self.lock:
+      self.slowLog.write(line + "\n")
+      self.slowLog.flush()
+
+  def histogram(self, name):
+    """
+    @param name - a query name
+    @return the counts of its recent latencies in each of BUCKETS, as a list
+      of (upper bound, count); the last bound is None, for slower ones
+    """
+    with self.lock:
+      latencies = list(self.latencies.get(name, ()))
+    counts = [0] * (len(BUCKETS) + 1)
+    for seconds in latencies:
+      counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+    return list(zip(BUCKETS + [None], counts))
+
+  def summary(self):
+    """
+    @return a dict mapping each query traced to the count, mean, p50, p95,
+      p99 and max of its recent latencies, its number of slow executions
+      and its histogram
+    """
+    with self.lock:
+      names = sorted(self.latencies)
+      windows = {name: sorted(self.latencies[name]) for name in names}
+      slow = dict(self.slowCount)
+    report = {}
+    for name in names:
+      ordered = windows[name]
+      pct = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+      report[name] = {"count": len(ordered), "mean": sum(ordered) / len(ordered),
+                      "p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99),
+                      "max": ordered[-1], "slow": slow.get(name, 0),
+                      "histogram": self.histogram(name)}
+    return report
+
+  def close(self):
+    """
+    Closes the slow log
+    """
+    if self.slowLog is not None:
+      self.slowLog.close()
+      self.slowLog = None
+
+def formatRecord(record):
+  """
+  @param record - the record of one traced execution
+  @return a one-line description of its counters
+  """
+  counters = ["%d VM steps" % record["vmSteps"]]
+  for key, label in (("fullScanSteps", "full scan steps"), ("sorts", "sorts"),
+                     ("autoIndexRows", "automatic index rows")):
+    if record.get(key) is not None:
+      counters.append("%d %s" % (record[key], label))
+  return ", ".join(counters) + (" (slow)" if record.get("slow") else "")
+
+def printSummary(summary, out):
+  """
+  Prints the latency summary of each query and its histogram
+  @param summary - the dict returned by QueryTracer.summary
+  @param out - the file to print to
+  """
+  for name, stats in summary.items():
+    print("%s: %d executions (%d slow), latency mean %.4f p50 %.4f p95 %.4f "
+          "p99 %.4f max %.4f seconds"
+          % (name, stats["count"], stats["slow"], stats["mean"], stats["p50"],
+             stats["p95"], stats["p99"], stats["max"]), file=out)
+    for bound, count in stats["histogram"]:
+      if count:
+        label = "<= %gs" % bound if bound is not None else "> %gs" % BUCKETS[-1]
+        print("  %10s %6d %s" % (label, count, "#" * max(1, 60 * count // stats["count"])),
+              file=out)
@@ -0,0 +1,57 @@
+"""
+resultwriter.py
+
+Description: Streams query results to a file object in one of several
+formats.  Rows are pulled from the cursor with fetchmany and written as
+they arrive, so memory use does not grow with the size of the result.
+"""
+
+import csv
+import json
+
+# Output formats understood by rowWriter
+FORMATS = ["table", "csv", "tsv", "jsonl"]
+
+# Rows fetched from the cursor at a time
+FETCH_SIZE = 1000
+
+def fetchBatches(cursor, size=FETCH_SIZE):
+  """
+  @param cursor - a cursor that has executed a query
+  @param size - the number of rows per batch
+  @return a generator of non-empty lists of rows
+  """
+  while True:
+    batch = cursor.fetchmany(size)
+    if not batch:
+      return
+    yield batch
+
+def rowWriter(format, columns, out):
+  """
+  Writes the header for a result in the given format and returns a
+  function that writes one row
+  @param format - one of FORMATS
+  @param columns - the names of the result columns
+  @param out - the text file object to write to
+  @return a function taking a row tuple
+  """
+  if format == "table":
+    template = "%-20s " * len(columns) + "\n"
+    out.write(template % tuple(columns))
+    out.write("-" * 20 * len(columns) + "\n")
+    return lambda row: out.write(template % tuple(row))
+
+  if format == "csv" or format == "tsv":
+    writer = csv.writer(out, delimiter="," if format == "csv" else "\t",
+                        lineterminator="\n")
+    writer.writerow(columns)
+    return writer.writerow
+
+  if format == "jsonl":
+    names = list(columns)
+    return lambda row: out.write(json.dumps(dict(zip(names, row)),
+                                            ensure_ascii=False) + "\n")
+
+  raise ValueError("unknown output format %r (expected one of %s)"
+                   % (format, ", ".join(FORMATS)))
@@ -0,0 +1,332 @@
+"""
+search.py
+
+Description: Name search over actors, directors and movie titles.  Every
+name is stored once more in the NameSearch table, normalized: case
+folded, accents and apostrophes removed, other punctuation turned into
+spaces.  Three indexes sit on top of it:
+
+  idx_namesearch_norm  a B-tree on (kind, normName), so a name that starts
+                       with the typed text is an index range read
+  NameSearchWords      an FTS5 index of the words, with prefix indexes, so
+                       any word of a name can be matched by its prefix
+  NameSearchTrigrams   an FTS5 trigram index, used for misspelled names
+
+search() tries them in that order and ranks exact matches first, then
+name prefixes, word prefixes and fuzzy matches.  The tables are derived
+from Actor, Director and Movie: createdb.py builds them with the indexes,
+and updateSearch re-indexes the names an --update changed.
+
+Usage: python3 search.py databaseName [text] [--kind KIND] [--limit N]
+  with text, searches the names; without it, (re)builds the search tables
+"""
+
+import argparse
+import difflib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+
+# The kinds of name indexed, and the SQL that lists each with its id
+KINDS = {
+  "actor": "SELECT id, fname || ' ' || lname FROM Actor",
+  "director": "SELECT id, fname || ' ' || lname FROM Director",
+  "movie": "SELECT id, title FROM Movie",
+}
+
+SEARCH_SQL = {
+  "NameSearch": """CREATE TABLE NameSearch (
+    kind VARCHAR(10),
+    refID INTEGER,
+    name TEXT,
+    normName TEXT
+  )""",
+
+  # external content tables: the text is read from NameSearch, so only the
+  # indexes take space
+  "NameSearchWords": """CREATE VIRTUAL TABLE NameSearchWords USING fts5(
+    normName, content='NameSearch', content_rowid='rowid',
+    prefix='1 2 3', tokenize='unicode61')""",
+
+  "NameSearchTrigrams": """CREATE VIRTUAL TABLE NameSearchTrigrams USING fts5(
+    normName, content='NameSearch', content_rowid='rowid',
+    tokenize='trigram')""",
+}
+
+# The names of a kind with ids in a JSON array, as stored in NameSearch
+REFS_SQL = """
+    SELECT rowid, normName
+    FROM NameSearch
+    WHERE kind = ? AND refID IN (SELECT value FROM json_each(?))"""
+
+SEARCH_INDEXES = [
+  "CREATE INDEX IF NOT EXISTS idx_namesearch_norm ON NameSearch(kind, normName);",
+]
+
+# Names that start with the text, in index order
+PREFIX_SQL = """
+    SELECT rowid, kind, refID, name, normName
+    FROM NameSearch
+    WHERE kind = ? AND normName >= ? AND normName < ?
+    ORDER BY normName
+    LIMIT ?"""
+
+# Names with a word starting with each word of the text, of the kind given
+# (any kind if it is NULL), closest in length to the text first.  Every
+# match is ordered before the LIMIT, so the best names are never cut off
+# by an arbitrary first few; a sorter bounded by the LIMIT keeps only
+# that many rows.
+WORDS_SQL = """
+    SELECT S.rowid, S.kind, S.refID, S.name, S.normName
+    FROM NameSearchWords AS W, NameSearch AS S
+    WHERE W.NameSearchWords MATCH ? AND S.rowid = W.rowid
+      AND (? IS NULL OR S.kind = ?)
+    ORDER BY length(S.normName), S.normName
+    LIMIT ?"""
+
+# Names of the kind given (any if NULL) sharing trigrams with the text, most
+# shared first
+TRIGRAMS_SQL = """
+    SELECT S.rowid, S.kind, S.refID, S.name, S.normName
+    FROM NameSearchTrigrams AS T, NameSearch AS S
+    WHERE T.NameSearchTrigrams MATCH ? AND S.rowid = T.rowid
+      AND (? IS NULL OR S.kind = ?)
+    ORDER BY T.rank
+    LIMIT ?"""
+
+# Results returned by default, fuzzy candidates scored per result wanted,
+# and the lowest similarity (0 to 1) a fuzzy match may have
+LIMIT = 10
+CANDIDATES = 20
+FUZZY_MIN = 0.6
+
+# Match types, best first
+EXACT, PREFIX, WORD, FUZZY = "exact", "prefix", "word", "fuzzy"
+
+# Characters dropped outright ("O'Brien" is found as "obrien"), and runs of
+# anything else that is not a letter or digit, which separate words
+DROPPED = re.compile(r"['’ʼ.]")
+SEPARATORS = re.compile(r"[\W_]+")
+
+def normalize(text):
+  """
+  @param text - a name as stored or as typed
+  @return the text case folded, without accents or punctuation, and with
+    single spaces between words
+  """
+  text = unicodedata.normalize("NFKD", text or "")
+  text = "".join(c for c in text if not unicodedata.combining(c))
+  text = DROPPED.sub("", text.casefold())
+  return SEPARATORS.sub(" ", text).strip()
+
+def hasSearch(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the search tables have been built
+  """
+  names = [row[0] for row in db.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table'")]
+  return all(table in names for table in SEARCH_SQL)
+
+def dropSearch(db):
+  """
+  Removes the search tables and their index
+  @param db - the database connection or cursor
+  """
+  for table in reversed(list(SEARCH_SQL)):
+    db.execute("DROP TABLE IF EXISTS " + table)
+
+def buildSearch(db):
+  """
+  Builds (or rebuilds) the search tables from Actor, Director and Movie
+  @param db - the database connection
+  @return the number of names indexed
+  """
+  dropSearch(db)
+  for table in SEARCH_SQL:
+    db.execute(SEARCH_SQL[table])
+  count = 0
+  for kind, sql in KINDS.items():
+    rows = [(kind, refID, name, normalize(name))
+            for refID, name in db.execute(sql) if name]
+    db.executemany("INSERT INTO NameSearch (kind, refID, name, normName) "
+                   "VALUES (?, ?, ?, ?)", rows)
+    count += len(rows)
+  for table in ("NameSearchWords", "NameSearchTrigrams"):
+    db.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (table, table))
+  for sql in SEARCH_INDEXES:
+    db.execute(sql)
+  db.commit()
+  return count
+
+def updateSearch(db, kind, ids):
+  """
+  Re-indexes the names of some actors, directors or movies after their
+  rows were inserted, changed or deleted.  Their old entries are removed
+  from NameSearch and from both FTS5 indexes, which are told the old text
+  since they do not store it, and the current names are added.  Nothing
+  is committed.
+  @param db - the database connection or cursor
+  @param kind - "actor", "director" or "movie"
+  @param ids - the ids of the rows that changed
+  @return the number of names indexed for them
+  """
+  ids = json.dumps(sorted(ids))
+  old = db.execute(REFS_SQL, (kind, ids)).fetchall()
+  for table in ("NameSearchWords", "NameSearchTrigrams"):
+    db.executemany("INSERT INTO %s (%s, rowid, normName) VALUES ('delete', ?, ?)"
+                   % (table, table), old)
+  db.executemany("DELETE FROM NameSearch WHERE rowid = ?", [(rowid,) for rowid, norm in old])
+  rows = [(kind, refID, name, normalize(name)) for refID, name in db.execute(
+          KINDS[kind] + " WHERE id IN (SELECT value FROM json_each(?))", (ids,)) if name]
+  db.executemany("INSERT INTO NameSearch (kind, refID, name, normName) "
+                 "VALUES (?, ?, ?, ?)", rows)
+  new = db.execute(REFS_SQL, (kind, ids)).fetchall()
+  for table in ("NameSearchWords", "NameSearchTrigrams"):
+    db.executemany("INSERT INTO %s (rowid, normName) VALUES (?, ?)" % table, new)
+  return len(new)
+
+def ensureSearch(db, rebuild=False):
+  """
+  Builds the search tables if the database does not have them yet (or
+  rebuild is set), and recreates their index if it was dropped
+  @param db - the database connection
+  @param rebuild - rebuild the tables even if they exist, e.g. after the
+    names changed
+  """
+  if rebuild or not hasSearch(db):
+    print("...Building Name Search...")
+    start = time.time()
+    count = buildSearch(db)
+    print("  %d names in %.2f seconds" % (count, time.time() - start))
+    return
+  for sql in SEARCH_INDEXES:
+    db.execute(sql)
+  db.commit()
+
+def phrase(text):
+  """
+  @param text - a word or trigram
+  @return the text as an FTS5 string, so it is never read as an operator
+  """
+  return '"%s"' % text.replace('"', '""')
+
+def fuzzyScore(norm, candidate):
+  """
+  @param norm - the normalized search text
+  @param candidate - a normalized name
+  @return how similar they are, from 0 to 1.  A name longer than the text
+    is compared by its start, so a partly typed name can still match.
+  """
+  head = candidate[:len(norm) + 2]
+  return max(difflib.SequenceMatcher(None, norm, candidate).ratio(),
+             difflib.SequenceMatcher(None, norm, head).ratio())
+
+def search(db, text, kind=None, limit=LIMIT, fuzzy=True):
+  """
+  Looks a name up the way an autocomplete box does
+  @param db - the database connection or cursor
+  @param text - the name or the start of it, in any case and with or
+    without accents
+  @param kind - "actor", "director" or "movie", or None for all of them
+  @param limit - the most results to return
+  @param fuzzy - whether to fall back to misspelled matches when nothing
+    else matches
+  @return a list of (kind, id, name, match) tuples, best first, where match
+    is "exact", "prefix", "word" or "fuzzy"
+  """
+  norm = normalize(text)
+  if not norm or limit < 1:
+    return []
+  kinds = [kind] if kind else list(KINDS)
+  found = {}    # rowid -> (match, order, row)
+
+  def add(match, rows):
+    for order, (rowid, rowKind, refID, name, normName) in enumerate(rows):
+      if rowid not in found and rowKind in kinds:
+        kindOf = EXACT if match == PREFIX and normName == norm else match
+        found[rowid] = (kindOf, order, (rowKind, refID, name, kindOf))
+
+  # 1) the whole name starts with the text
+  for k in kinds:
+    add(PREFIX, db.execute(PREFIX_SQL, (k, norm, norm + "\uffff", limit)))
+
+  # 2) every word of the text starts a word of the name; the names closest
+  # in length to the text come first.  Enough are read to fill the results
+  # even if all the names already found are among them.
+  if len(found) < limit:
+    query = " AND ".join(phrase(word) + "*" for word in norm.split())
+    add(WORD, db.execute(WORDS_SQL, (query, kind, kind, limit + len(found))))
+
+  # 3) names that share trigrams with the text, if it is long enough
+  if fuzzy and not found and len(norm) >= 3:
+    grams = sorted({norm[i:i + 3] for i in range(len(norm) - 2)})
+    query = " OR ".join(phrase(g) for g in grams)
+    scored = []
+    params = (query, kind, kind, CANDIDATES * limit)
+    for row in db.execute(TRIGRAMS_SQL, params):
+      if row[0] not in found and row[1] in kinds:
+        score = fuzzyScore(norm, row[4])
+        if score >= FUZZY_MIN:
+          scored.append((-score, row[4], row))
+    add(FUZZY, [row for unused, unused, row in sorted(scored)])
+
+  rank = {EXACT: 0, PREFIX: 1, WORD: 2, FUZZY: 3}
+  ordered = sorted(found.values(), key=lambda item: (rank[item[0]], item[1]))
+  return [result for unused, unused, result in ordered[:limit]]
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="search.py",
+      description="Searches actor, director and movie names, or (re)builds "
+                  "the search tables")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("text", nargs="?",
+      help="the name, or the start of it, to search for")
+  parser.add_argument("--kind", choices=list(KINDS),
+      help="only search this kind of name")
+  parser.add_argument("--limit", type=int, default=LIMIT,
+      help="most results to show (default %(default)s)")
+  parser.add_argument("--no-fuzzy", action="store_true",
+      help="do not fall back to misspelled matches")
+  return parser.parse_args(argv)
+
+def main():
+  args = parseArgs(sys.argv[1:])
+  if not os.path.exists(args.filename):
+    print("Error: file does not exist")
+    return 1
+
+  db = sqlite3.connect(args.filename)
+  if args.text is None:
+    ensureSearch(db, rebuild=True)
+    db.close()
+    return 0
+
+  if not hasSearch(db):
+    print("Error: the database has no search tables; run "
+          "python3 search.py %s first" % args.filename)
+    return 1
+  start = time.perf_counter()
+  results = search(db, args.text, args.kind, args.limit, not args.no_fuzzy)
+  end = time.perf_counter()
+  format = "%-9s %-9s %-8s %s"
+  print(format % ("kind", "id", "match", "name"))
+  print("-"*60)
+  for kind, refID, name, match in results:
+    print(format % (kind, refID, match, name))
+  print("\n %d results; completed in %.4f seconds" % (len(results), end - start))
+  db.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
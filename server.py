@@ -0,0 +1,561 @@
+"""
+server.py
+
+Description: A local HTTP/JSON service for the movie database.  Queries
+1-7 and the Bacon number search are exposed as GET endpoints and answered
+from a pool of read-only, immutable SQLite connections, each with its own
+statement cache.  Every request runs under a deadline: a timer calls
+interrupt() on the request's connection when the deadline passes, and stops
+the shard queries of a partitioned database.
+
+SQLite releases the GIL while a statement runs, so requests on different
+connections of the pool execute in parallel.  Two front ends are
+available: a thread-pool HTTP server, and an asyncio server that hands
+each query to the same kind of thread pool.
+
+Because the connections are opened immutable, restart the server after
+createdb.py rebuilds or updates the database.  A snapshot written by
+publish.py is also memory-mapped.  On a partitioned database
+(see shards.py) queries 1-7 run on its shards, and the Bacon number and
+name search endpoints are not available.
+
+Usage: python3 server.py databaseName [--mode threads|asyncio] [--port N]
+                                      [--pool N] [--timeout SECONDS]
+                                      [--trace] [--slow-log FILE]
+
+Endpoints (all GET, all answering JSON):
+  /                               the list of endpoints
+  /health                         pool status
+  /stats                          latency summary and histogram of each
+                                  query (with --trace)
+  /query/N?param=V&param=V        query N (1-7, queryN or a name) with
+                                  positional parameters
+  /cast[?title=T]                 query 1 (default The Princess Bride)
+  /filmography?fname=F&lname=L    query 2
+  /costars?fname1=..&lname1=..&fname2=..&lname2=..
+                                  query 3
+  /directors, /top                queries 4 and 7
+  /bacon[?fname=F&lname=L]        query 5 (default Kevin Bacon)
+  /versatile[?year=Y]             query 6 (default 2010)
+  /baconnumber?fname=F&lname=L    shortest co-star chain to Kevin Bacon (or
+                                  to fname2, lname2)
+  /search?q=TEXT[&kind=K][&limit=N]
+                                  actors, directors and movies whose names
+                                  start with or resemble TEXT
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import http.server
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+import costar
+import publish
+import queryDB
+import queryregistry
+import querytrace
+import resultwriter
+import shards
+import search
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8044
+
+# Connections in the pool, and the seconds a request may run for
+POOL_SIZE = os.cpu_count() or 4
+REQUEST_TIMEOUT = 10.0
+
+# Bytes of an unused request body read at a time
+DRAIN_SIZE = 1 << 16
+
+class RequestError(Exception):
+  """
+  A request that cannot be answered, with the HTTP status to answer it with
+  """
+
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+class ConnectionPool:
+  """
+  A fixed set of read-only connections to one database file, handed out
+  one request at a time
+  """
+
+  def __init__(self, filename, size=POOL_SIZE, tracer=None):
+    """
+    @param filename - the path of the database file
+    @param size - the number of connections
+    @param tracer - a querytrace.QueryTracer to trace the queries run on
+      the connections, or None
+    """
+    self.size = size
+    self.tracer = tracer
+    self.idle = queue.Queue()
+    with contextlib.closing(queryDB.openReadOnly(filename)) as db:
+      mmap = publish.isSnapshot(db)
+    for i in range(size):
+      db = queryDB.openReadOnly(filename, immutable=True, mmap=mmap)
+      if tracer is not None:
+        tracer.attach(db)
+      self.idle.put(db)
+    self.router = None
+    if shards.isSharded(db):
+      self.router = shards.ShardRouter(filename, immutable=True)
+
+  @contextlib.contextmanager
+  def connection(self, timeout):
+    """
+    Borrows a connection for the duration of a with block
+    @param timeout - the most seconds to wait for a free connection
+    @raise RequestError (503) if none becomes free in time
+    """
+    try:
+      db = self.idle.get(timeout=timeout)
+    except queue.Empty:
+      raise RequestError(503, "all %d connections are busy" % self.size)
+    try:
+      yield db
+    finally:
+      self.idle.put(db)
+
+  def close(self):
+    """
+    Closes the idle connections
+    """
+    if self.router is not None:
+      self.router.close()
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+def withDeadline(db, timeout, work):
+  """
+  Runs work(db, stop), interrupting the connection and setting stop if it
+  takes too long
+  @param db - the connection
+  @param timeout - the most seconds work may take
+  @param work - a function of the connection and a threading.Event that
+    is set at the deadline, for the shard queries of a partitioned database
+  @return the value of work(db, stop)
+  @raise RequestError (504) if the deadline passed
+  """
+  stop = threading.Event()
+  def expire():
+    stop.set()
+    db.interrupt()
+  timer = threading.Timer(timeout, expire)
+  timer.daemon = True
+  timer.start()
+  try:
+    return work(db, stop)
+  except sqlite3.OperationalError as e:
+    if stop.is_set() and "interrupted" in str(e):
+      raise RequestError(504, "query took longer than %.3g seconds" % timeout)
+    raise
+  finally:
+    timer.cancel()
+
+def runQuery(db, name, params, tracer=None, router=None, stop=None):
+  """
+  @param db - the connection
+  @param name - the query number or name
+  @param params - the list of parameters
+  @param tracer - a querytrace.QueryTracer to trace the query with, or None
+  @param router - the shards.ShardRouter of a partitioned database, or None
+  @param stop - a threading.Event that stops the shard queries once set,
+    or None
+  @return the JSON-ready result
+  """
+  try:
+    query, sql, params = queryDB.lookupSQL(db, name, params)
+  except ValueError as e:
+    raise RequestError(400, str(e))
+  traced = tracer.trace(db, query.key, sql, params) if tracer else None
+  start = time.perf_counter()
+  with traced or contextlib.nullcontext({}) as record:
+    if router is not None and query.shard is not None:
+      columns, rows, unused = queryDB.routeQuery(router, query, params, db, stop)
+    else:
+      cursor = db.execute(sql, params)
+      columns = [d[0] for d in cursor.description]
+      rows = []
+      for batch in resultwriter.fetchBatches(cursor):
+        rows.extend(batch)
+    record["rows"] = len(rows)
+  return {"query": query.key, "params": list(params),
+          "columns": columns, "rows": rows, "count": len(rows),
+          "seconds": round(time.perf_counter() - start, 6)}
+
+def runBaconNumber(db, args):
+  """
+  @param db - the connection
+  @param args - the request's query string arguments
+  @return the JSON-ready chain of co-stars
+  """
+  try:
+    fname, lname = args["fname"][0], args["lname"][0]
+  except KeyError:
+    raise RequestError(400, "baconnumber needs fname and lname")
+  fname2 = args.get("fname2", ["Kevin"])[0]
+  lname2 = args.get("lname2", ["Bacon"])[0]
+  start = time.perf_counter()
+  source = costar.actorIDs(db, fname, lname)
+  target = costar.actorIDs(db, fname2, lname2)
+  if not source or not target:
+    raise RequestError(404, "no actor named %s %s"
+                       % ((fname, lname) if not source else (fname2, lname2)))
+  path = costar.baconPath(db, source[0], target[0])
+  chain = []
+  for i, actorID in enumerate(path or []):
+    first, last = db.execute("SELECT fname, lname FROM Actor WHERE id = ?",
+                             (actorID,)).fetchone()
+    link = {"id": actorID, "fname": first, "lname": last}
+    if i + 1 < len(path):
+      link["movie"] = costar.sharedMovies(db, actorID, path[i + 1])[0][1]
+    chain.append(link)
+  return {"baconNumber": None if path is None else len(path) - 1,
+          "path": chain, "seconds": round(time.perf_counter() - start, 6)}
+
+def runSearch(db, args):
+  """
+  @param db - the connection
+  @param args - the request's query string arguments
+  @return the JSON-ready search results
+  """
+  text = args.get("q", [""])[0]
+  kind = args.get("kind", [None])[0]
+  if not text:
+    raise RequestError(400, "search needs q")
+  if kind is not None and kind not in search.KINDS:
+    raise RequestError(400, "kind must be one of " + ", ".join(search.KINDS))
+  try:
+    limit = int(args.get("limit", [search.LIMIT])[0])
+  except ValueError:
+    raise RequestError(400, "limit must be an integer")
+  if not search.hasSearch(db):
+    raise RequestError(404, "the database has no search tables")
+  start = time.perf_counter()
+  results = search.search(db, text, kind, max(1, min(limit, 100)))
+  return {"q": text, "results": [{"kind": k, "id": refID, "name": name, "match": match}
+                                 for k, refID, name, match in results],
+          "count": len(results), "seconds": round(time.perf_counter() - start, 6)}
+
+def endpoints():
+  """
+  @return the JSON-ready list of endpoints
+  """
+  named = {}
+  for query in queryregistry.QUERIES:
+    named["/" + query.name] = {"query": query.key,
+                               "params": [p.name for p in query.params]}
+  return {"endpoints": named,
+          "generic": "/query/N?param=...&param=...",
+          "baconnumber": "/baconnumber?fname=...&lname=...[&fname2=...&lname2=...]",
+          "search": "/search?q=...[&kind=actor|director|movie][&limit=N]",
+          "stats": "/stats"}
+
+def handleRequest(pool, target, timeout=REQUEST_TIMEOUT):
+  """
+  Answers one GET request.  Shared by both server front ends.
+  @param pool - the ConnectionPool
+  @param target - the request target (path and query string)
+  @param timeout - the request deadline in seconds
+  @return (HTTP status, JSON-ready body)
+  """
+  url = urllib.parse.urlsplit(target)
+  path = url.path.rstrip("/") or "/"
+  args = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+  deadline = time.monotonic() + timeout
+
+  try:
+    if path == "/":
+      return 200, endpoints()
+    if path == "/health":
+      return 200, {"connections": pool.size, "idle": pool.idle.qsize()}
+    if path == "/stats":
+      if pool.tracer is None:
+        raise RequestError(404, "tracing is off; start the server with --trace")
+      return 200, pool.tracer.summary()
+
+    if path in ("/baconnumber", "/search") and pool.router is not None:
+      raise RequestError(404, "%s is not available on a partitioned database" % path)
+    if path == "/baconnumber":
+      work = lambda db, stop: runBaconNumber(db, args)
+    elif path == "/search":
+      work = lambda db, stop: runSearch(db, args)
+    elif path.startswith("/query/"):
+      name, params = path[len("/query/"):], args.get("param", [])
+      work = lambda db, stop: runQuery(db, name, params, pool.tracer, pool.router, stop)
+    elif path[1:] in queryregistry.BY_NAME:
+      query = queryregistry.BY_NAME[path[1:]]
+      missing = [p.name for p in query.params if p.name not in args and p.default is None]
+      if missing:
+        raise RequestError(400, "missing parameter(s): " + ", ".join(missing))
+      params = [args[p.name][0] if p.name in args else p.default for p in query.params]
+      work = lambda db, stop: runQuery(db, query.number, params, pool.tracer,
+                                       pool.router, stop)
+    else:
+      raise RequestError(404, "no endpoint %s" % path)
+
+    with pool.connection(max(0.0, deadline - time.monotonic())) as db:
+      return 200, withDeadline(db, max(0.001, deadline - time.monotonic()), work)
+  except RequestError as e:
+    return e.status, {"error": str(e)}
+  except sqlite3.Error as e:
+    return 500, {"error": str(e)}
+
+def bodyLength(contentLength, transferEncoding):
+  """
+  @param contentLength - the Content-Length header of a request, or None
+  @param transferEncoding - its Transfer-Encoding header, or None
+  @return the length of the request's body (0 if it has none), or None if
+    it cannot be told, e.g. for a chunked body
+  """
+  if transferEncoding is not None:
+    return None
+  if contentLength is None:
+    return 0
+  contentLength = contentLength.strip()
+  return int(contentLength) if contentLength.isdigit() else None
+
+def encodeBody(body):
+  """
+  @param body - a JSON-ready object
+  @return the UTF-8 JSON encoding of body
+  """
+  return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+############### thread-pool server ###########################
+class PooledHTTPServer(http.server.HTTPServer):
+  """
+  An HTTPServer that handles each connection on a fixed pool of threads,
+  rather than a new thread per connection
+  """
+
+  daemon_threads = True
+
+  def __init__(self, address, handler, threads):
+    http.server.HTTPServer.__init__(self, address, handler)
+    self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+  def process_request(self, request, client_address):
+    self.executor.submit(self.processRequestThread, request, client_address)
+
+  def processRequestThread(self, request, client_address):
+    try:
+      self.finish_request(request, client_address)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      self.shutdown_request(request)
+
+  def server_close(self):
+    http.server.HTTPServer.server_close(self)
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+def makeHandler(pool, timeout):
+  """
+  @param pool - the ConnectionPool
+  @param timeout - the request deadline in seconds
+  @return a BaseHTTPRequestHandler subclass answering from pool
+  """
+  class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+      # no request has a body; one is read past so the next request on the
+      # connection starts where it ends, or the connection is closed
+      length = bodyLength(self.headers.get("Content-Length"),
+                          self.headers.get("Transfer-Encoding"))
+      if length is None:
+        self.send_error(400, "request bodies need a Content-Length")
+        return
+      while length > 0:
+        chunk = self.rfile.read(min(length, DRAIN_SIZE))
+        if not chunk:
+          self.close_connection = True
+          return
+        length -= len(chunk)
+      status, body = handleRequest(pool, self.path, timeout)
+      data = encodeBody(body)
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json; charset=utf-8")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def log_message(self, format, *args):
+      pass
+
+  return Handler
+
+def serveThreads(pool, host, port, timeout, threads):
+  """
+  Serves requests on a thread-pool HTTP server until interrupted
+  """
+  server = PooledHTTPServer((host, port), makeHandler(pool, timeout), threads)
+  print("Serving on http://%s:%d/ (threads)" % server.server_address[:2])
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+############### asyncio server ###########################
+async def handleClient(reader, writer, pool, timeout, executor):
+  """
+  Answers the HTTP/1.1 requests of one client connection, running each
+  query on the executor
+  """
+  loop = asyncio.get_running_loop()
+  try:
+    while True:
+      line = await reader.readline()
+      if not line:
+        return
+      parts = line.decode("latin-1").split()
+      headers = {}
+      while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+          break
+        key, sep, value = header.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+
+      # a body is read past, so the next request starts where it ends; one
+      # of unknown length leaves nowhere to start, so the connection closes
+      length = bodyLength(headers.get("content-length"),
+                          headers.get("transfer-encoding"))
+      while length:
+        chunk = await reader.read(min(length, DRAIN_SIZE))
+        if not chunk:
+          return
+        length -= len(chunk)
+
+      if length is None:
+        status, body = 400, {"error": "request bodies need a Content-Length"}
+      elif len(parts) != 3 or parts[0] != "GET":
+        status, body = 405, {"error": "only GET requests are supported"}
+      else:
+        status, body = await loop.run_in_executor(executor, handleRequest,
+                                                  pool, parts[1], timeout)
+      data = encodeBody(body)
+      close = (length is None or headers.get("connection", "").lower() == "close"
+               or len(parts) == 3 and parts[2] == "HTTP/1.0")
+      writer.write(("HTTP/1.1 %d %s\r\n"
+                    "Content-Type: application/json; charset=utf-8\r\n"
+                    "Content-Length: %d\r\n%s\r\n"
+                    % (status, http.server.BaseHTTPRequestHandler.responses
+                                 .get(status, ("",))[0],
+                       len(data), "Connection: close\r\n" if close else ""))
+                   .encode("latin-1") + data)
+      await writer.drain()
+      if close:
+        return
+  except (ConnectionError, asyncio.IncompleteReadError):
+    pass
+  finally:
+    writer.close()
+
+def serveAsyncio(pool, host, port, timeout, threads):
+  """
+  Serves requests on an asyncio server until interrupted
+  """
+  executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+  async def run():
+    server = await asyncio.start_server(
+        lambda r, w: handleClient(r, w, pool, timeout, executor), host, port)
+    print("Serving on http://%s:%d/ (asyncio)"
+          % server.sockets[0].getsockname()[:2])
+    async with server:
+      await server.serve_forever()
+
+  try:
+    asyncio.run(run())
+  except KeyboardInterrupt:
+    pass
+  finally:
+    executor.shutdown(wait=False, cancel_futures=True)
+
+############### main program ###########################
+def parseArgs(argv):
+  """
+  Parses the command line
+  @param argv - the command line arguments, without the program name
+  @return an argparse.Namespace with the parsed options
+  """
+  parser = argparse.ArgumentParser(prog="server.py",
+      description="Serves the movie database queries over HTTP as JSON")
+  parser.add_argument("filename", help="name of the database file")
+  parser.add_argument("--mode", choices=["threads", "asyncio"], default="threads",
+      help="server front end (default %(default)s)")
+  parser.add_argument("--host", default=DEFAULT_HOST,
+      help="address to listen on (default %(default)s)")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+      help="port to listen on (default %(default)s)")
+  parser.add_argument("--pool", type=int, default=POOL_SIZE,
+      help="read-only connections in the pool (default %(default)s)")
+  parser.add_argument("--threads", type=int,
+      help="worker threads (default twice --pool)")
+  parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT,
+      help="seconds a request may run before it is interrupted "
+           "(default %(default)s)")
+  parser.add_argument("--trace", action="store_true",
+      help="keep a latency histogram of each query, served at /stats")
+  parser.add_argument("--slow-log", metavar="FILE",
+      help="append each query slower than --slow-ms to FILE as a JSON line, "
+           "with its parameters, plan and counters (implies --trace)")
+  parser.add_argument("--slow-ms", type=float,
+      default=1000 * querytrace.SLOW_SECONDS,
+      help="the latency in milliseconds above which a query is logged as "
+           "slow (default %(default)s)")
+  args = parser.parse_args(argv)
+  if args.pool < 1:
+    parser.error("--pool must be at least 1")
+  if args.timeout <= 0:
+    parser.error("--timeout must be positive")
+  if args.slow_ms < 0:
+    parser.error("--slow-ms must not be negative")
+  args.trace = args.trace or args.slow_log is not None
+  args.threads = args.threads or 2 * args.pool
+  return args
+
+def main():
+  args = parseArgs(sys.argv[1:])
+  if not os.path.exists(args.filename):
+    print("Error: file does not exist")
+    return 1
+
+  tracer = None
+  if args.trace:
+    tracer = querytrace.QueryTracer(args.slow_ms / 1000, args.slow_log,
+                                    explain=queryDB.queryPlan)
+  pool = ConnectionPool(args.filename, args.pool, tracer)
+  try:
+    if args.mode == "asyncio":
+      serveAsyncio(pool, args.host, args.port, args.timeout, args.threads)
+    else:
+      serveThreads(pool, args.host, args.port, args.timeout, args.threads)
+  finally:
+    pool.close()
+    if tracer is not None:
+      tracer.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
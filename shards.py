@@ -0,0 +1,396 @@
+"""
+shards.py
+
+Description: The partitioned layout built by createdb.py --shard-by.  The
+rows of Movie, Casts, DirectsMovie and Genre are split by movie into shard
+files, either by the decade of the movie's year or by a hash of its id.
+Actor and Director stay in the database file itself, the shared file,
+which also lists the shards in the Shards table.  Every row about a movie
+(its cast, directors and genres) is in the same shard as the movie, so a
+query that joins through one movie at a time can run on each shard alone.
+
+ShardRouter runs a query on the shards it needs, in parallel threads.
+Each shard connection has the shared file attached, so the query SQL
+can use Actor and Director unchanged.  The partial results are then merged
+by a second statement on the shared file, which reads them from
+temp.Part.  The shard queries release the GIL while SQLite runs them, so
+the threads use one CPU each.  A query on one year reads only the shards whose movies span
+that year.  With the decade layout that is a single shard.  Each shard
+can be rebuilt on its own (createdb.py --rebuild-shard).
+
+Usage: python3 shards.py databaseName
+  lists the shards of a partitioned database
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import urllib.parse
+
+# How movies can be assigned to shards
+SCHEMES = ["decade", "hash"]
+
+# Shards of the hash layout by default
+HASH_SHARDS = 8
+
+# Tables split across the shards, with the position of the movie id in
+# each; the others stay in the shared file
+SHARD_TABLES = {"Movie": 0, "Casts": 1, "DirectsMovie": 1, "Genre": 0}
+
+# VM instructions between the checks of a query's stop event
+STOP_STEPS = 1000
+
+# The name used for the shared file in ShardRouter and createdb.py
+# --rebuild-shard, and for the shard of movies without a year
+SHARED = "shared"
+UNKNOWN_YEAR = "unknown"
+
+LAYOUT_SQL = """CREATE TABLE ShardLayout (
+    scheme VARCHAR(10),
+    numShards INTEGER
+  )"""
+
+SHARDS_SQL = """CREATE TABLE IF NOT EXISTS Shards (
+    name VARCHAR(20) PRIMARY KEY,
+    file TEXT,
+    minYear INTEGER,
+    maxYear INTEGER,
+    numMovies INTEGER,
+    builtAt TEXT
+  )"""
+
+def shardDir(filename):
+  """
+  @param filename - the shared database file
+  @return the directory its shard files are kept in
+  """
+  return filename + ".shards"
+
+def shardFile(filename, name):
+  """
+  @param filename - the shared database file
+  @param name - the name of a shard
+  @return the path of the shard's file
+  """
+  return os.path.join(shardDir(filename), name + ".db")
+
+def shardName(scheme, numShards, movieID, year):
+  """
+  @param scheme - one of SCHEMES
+  @param numShards - the number of shards of the hash layout
+  @param movieID - the movie's id
+  @param year - the movie's year, as an int or string, or None
+  @return the name of the shard the movie belongs in: its decade, such as
+    "1990s" (UNKNOWN_YEAR if it has none), or "hash03" for the hash layout
+  """
+  if scheme == "hash":
+    return "hash%02d" % (int(movieID) % numShards)
+  try:
+    return "%ds" % (int(year) // 10 * 10)
+  except (TypeError, ValueError):
+    return UNKNOWN_YEAR
+
+def isSharded(db):
+  """
+  @param db - the database connection or cursor
+  @return True if the database is the shared file of a partitioned layout
+  """
+  return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                    "AND name = 'ShardLayout'").fetchone() is not None
+
+def layout(db):
+  """
+  @param db - a connection to the shared file
+  @return (scheme, number of hash shards)
+  """
+  return db.execute("SELECT scheme, numShards FROM ShardLayout").fetchone()
+
+def openShard(filename, name, immutable=False):
+  """
+  @param filename - the shared database file
+  @param name - the name of a shard, or SHARED for the shared file itself
+  @param immutable - open the files as immutable (see queryDB.openReadOnly)
+  @return a read-only connection to the shard, with the shared file
+    attached as "shared"
+  """
+  suffix = "?mode=ro" + ("&immutable=1" if immutable else "")
+  uri = lambda path: "file:%s%s" % (urllib.parse.quote(os.path.abspath(path)), suffix)
+  if name == SHARED:
+    return sqlite3.connect(uri(filename), uri=True, check_same_thread=False)
+  conn = sqlite3.connect(uri(shardFile(filename, name)), uri=True,
+                         check_same_thread=False)
+  conn.execute("ATTACH DATABASE ? AS shared", (uri(filename),))
+  return conn
+
+class ShardRouter:
+  """
+  Runs queries across the shards of a partitioned database and merges
+  their results.  Connections are kept per shard and reused; any number of
+  threads may use the router at once.
+  """
+  def __init__(self, filename, jobs=None, immutable=False):
+    """
+    @param filename - the shared database file
+    @param jobs - the number of threads running shard queries (default
+      one per CPU)
+    @param immutable - open the files as immutable; restart after a shard
+      is rebuilt
+    """
+    self.filename = filename
+    self.immutable = immutable
+    self.idle = collections.defaultdict(queue.SimpleQueue)   # name -> connections
+    self.pool = concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count() or 4)
+    with self.connection(SHARED) as db:
+      self.scheme, self.numShards = layout(db)
+      self.years = {name: (minYear, maxYear) for name, minYear, maxYear in db.execute(
+          "SELECT name, minYear, maxYear FROM Shards ORDER BY name")}
+
+  @contextlib.contextmanager
+  def connection(self, name):
+    """
+    Borrows a connection to a shard for the duration of a with block
+    @param name - the name of the shard, or SHARED
+    """
+    try:
+      db = self.idle[name].get_nowait()
+    except queue.Empty:
+      db = openShard(self.filename, name, self.immutable)
+    try:
+      yield db
+    finally:
+      self.idle[name].put(db)
+
+  def shards(self, year=None):
+    """
+    @param year - a year the query is limited to, or None
+    @return the names of the shards holding movies the query may read
+    """
+    return [name for name, (minYear, maxYear) in self.years.items()
+            if year is None or (minYear is not None and minYear <= year <= maxYear)]
+
+  def fanOut(self, sql, params, names, stop=None):
+    """
+    Runs a query on each of the named shards, in parallel
+    @param sql - the query
+    @param params - its parameters
+    @param names - the shards to run it on
+    @param stop - a threading.Event that aborts the query once set, or None
+    @return the column names and the rows of all the shards
+    @raise sqlite3.OperationalError ("interrupted") if stop was set
+    """
+    if not names:
+      # no shard can hold a match; only the column names are needed
+      names = list(self.years)[:1]
+      sql = "SELECT * FROM (%s) LIMIT 0" % sql.strip().rstrip(";")
+    columns, rows = None, []
+    for shardColumns, shardRows in self.runEach(sql, params, names, stop):
+      columns = shardColumns
+      rows.extend(shardRows)
+    return columns, rows
+
+  def runEach(self, sql, params, names, stop=None):
+    """
+    Runs a query on each of the named shards, in parallel
+    @param sql - the query
+    @param params - its parameters, or a dict of them by shard name
+    @param names - the shards to run it on
+    @param stop - a threading.Event that aborts the query once set, or None
+    @return a list of the column names and rows of each shard, in the
+      order of names
+    @raise sqlite3.OperationalError ("interrupted") if stop was set
+    """
+    def run(name):
+      shardParams = params[name] if isinstance(params, dict) else params
+      with self.connection(name) as db:
+        if stop is None:
+          cursor = db.execute(sql, shardParams)
+          return [d[0] for d in cursor.description], cursor.fetchall()
+        # checked by SQLite as the query runs, so a stop is never missed
+        # the way an interrupt between two statements is
+        if stop.is_set():
+          raise sqlite3.OperationalError("interrupted")
+        db.set_progress_handler(stop.is_set, STOP_STEPS)
+        try:
+          cursor = db.execute(sql, shardParams)
+          return [d[0] for d in cursor.description], cursor.fetchall()
+        finally:
+          db.set_progress_handler(None, 0)
+
+    return list(self.pool.map(run, names))   # an error cancels the rest
+
+  def shardCounts(self, sql, params, names, stop=None):
+    """
+    Runs a query returning (key, count) rows on each of the named shards
+    @param sql - the query
+    @param params - its parameters
+    @param names - the shards to run it on
+    @param stop - a threading.Event that aborts the query once set, or None
+    @return (column names, {shard name: {key: count}})
+    """
+    parts = self.runEach(sql, params, names, stop)
+    return parts[0][0], {name: dict(rows) for name, (columns, rows) in zip(names, parts)}
+
+  def fillCounts(self, counts, keysSQL, params, stop=None):
+    """
+    Reads from each shard the counts of the keys that other shards have
+    counts for and it does not, so the counts of every key are complete.
+    A key the shard has no rows for is given a count of 0.
+    @param counts - {shard name: {key: count}}, which is added to
+    @param keysSQL - the query returning the (key, count) rows of the keys
+      in one more parameter, a JSON array
+    @param params - the parameters of keysSQL before that one
+    @param stop - a threading.Event that aborts the queries once set, or None
+    """
+    keys = set().union(*counts.values())
+    missing = {name: sorted(keys - shardCounts.keys())
+               for name, shardCounts in counts.items() if keys - shardCounts.keys()}
+    shardParams = {name: params + (json.dumps(shardKeys),) for name, shardKeys in missing.items()}
+    for name, (columns, rows) in zip(missing, self.runEach(keysSQL, shardParams,
+                                                           list(missing), stop)):
+      counts[name].update(dict.fromkeys(missing[name], 0))
+      counts[name].update(rows)
+
+  def prunedFanOut(self, params, names, prune, stop=None):
+    """
+    Runs a query whose shard rows are (key, count) pairs that the merge
+    adds up, fetching only the keys that can be in the merged result: those
+    whose total reaches a least value, or the top keys by total.  A total
+    of least needs least / n of it on one of n shards, so each shard
+    returns its keys with that much, and then the counts of the keys it
+    did not return (see fillCounts).  For the top keys, each shard first
+    returns its own top keys, n times as many as wanted.  A key in none of
+    the lists has at most the sum of the smallest count of each full list;
+    if that could beat the wanted-th best total of the listed keys, the
+    keys with at least that total are read as well.
+    @param params - the parameters of the shard SQL
+    @param names - the shards to run it on
+    @param prune - (least total or None, number of top keys or None, the
+      shard SQL returning the keys with at least a count given in one more
+      parameter, the shard SQL returning the top keys up to a number given
+      in one more parameter, the shard SQL returning the keys in one more
+      parameter, a JSON array)
+    @param stop - a threading.Event that aborts the queries once set, or None
+    @return the column names and the (key, count) rows of all the shards
+      for the keys that can be in the merged result
+    """
+    least, top, leastSQL, topSQL, keysSQL = prune
+    share = lambda total: -(-total // len(names))   # rounded up
+    if top is None:
+      columns, counts = self.shardCounts(leastSQL, params + (share(least),), names, stop)
+      self.fillCounts(counts, keysSQL, params, stop)
+    else:
+      limit = top * len(names)
+      columns, counts = self.shardCounts(topSQL, params + (limit,), names, stop)
+      outside = sum(min(shardCounts.values()) for shardCounts in counts.values()
+                    if len(shardCounts) == limit)
+      self.fillCounts(counts, keysSQL, params, stop)
+      totals = collections.Counter()
+      for shardCounts in counts.values():
+        totals.update(shardCounts)
+      best = sorted(totals.values(), reverse=True)
+      least = best[top - 1] if len(best) >= top else 0
+      if outside > least:
+        unused, more = self.shardCounts(leastSQL, params + (share(least),), names, stop)
+        for name in names:
+          counts[name].update(more[name])
+        self.fillCounts(counts, keysSQL, params, stop)
+    return columns, [(key, count) for shardCounts in counts.values()
+                     for key, count in shardCounts.items() if count]
+
+  def query(self, shardSQL, mergeSQL, params=(), year=None, db=None, stop=None,
+            prune=None):
+    """
+    Runs a query across the shards and merges the results
+    @param shardSQL - the query run on each shard
+    @param mergeSQL - the query that merges the shard rows, run on the
+      shared file with them in temp.Part (columns named as in shardSQL)
+    @param params - the parameters of shardSQL
+    @param year - a year the query is limited to, or None
+    @param db - a connection or cursor on the shared file to merge on, e.g.
+      one being traced; by default one of the router's
+    @param stop - a threading.Event that aborts the shard queries once set,
+      e.g. at a time limit, or None
+    @param prune - how the shards prune the keys of a per-key count, as
+      prunedFanOut takes it, or None
+    @return (column names, rows, names of the shards read)
+    """
+    names = self.shards(year)
+    if prune is not None and names:
+      columns, rows = self.prunedFanOut(params, names, prune, stop)
+    else:
+      columns, rows = self.fanOut(shardSQL, params, names, stop)
+    if db is None:
+      with self.connection(SHARED) as db:
+        return self.merge(db, columns, rows, mergeSQL) + (names,)
+    return self.merge(getattr(db, "connection", db), columns, rows, mergeSQL) + (names,)
+
+  def merge(self, conn, columns, rows, mergeSQL):
+    """
+    @param conn - a connection to the shared file
+    @param columns - the column names of the shard rows
+    @param rows - the rows of all the shards
+    @param mergeSQL - the query that merges them from temp.Part
+    @return (column names, rows) of the merged result
+    """
+    # temp.Part lives in a savepoint, so rolling back to it removes the
+    # table without touching a transaction the caller has open
+    conn.execute("SAVEPOINT merge")
+    try:
+      conn.execute("CREATE TEMP TABLE Part (%s)" % ", ".join('"%s"' % c for c in columns))
+      conn.executemany("INSERT INTO temp.Part VALUES (%s)" % ", ".join("?" * len(columns)),
+                       rows)
+      cursor = conn.execute(mergeSQL)
+      return [d[0] for d in cursor.description], cursor.fetchall()
+    finally:
+      conn.execute("ROLLBACK TO merge")
+      conn.execute("RELEASE merge")
+
+  def close(self):
+    """
+    Stops the threads and closes the idle connections
+    """
+    self.pool.shutdown()
+    for connections in self.idle.values():
+      while True:
+        try:
+          connections.get_nowait().close()
+        except queue.Empty:
+          break
+
+############### main program ###########################
+def main():
+
+  if len(sys.argv) != 2:
+    print("Error: Incorrect arguments")
+    print("Usage: python3 shards.py databaseName")
+    return 1
+
+  if not os.path.exists(sys.argv[1]):
+    print("Error: file does not exist")
+    return 1
+
+  db = sqlite3.connect(sys.argv[1])
+  if not isSharded(db):
+    print("%s is not a partitioned database" % sys.argv[1])
+    return 1
+  scheme, numShards = layout(db)
+  print("Partitioned by %s%s" % (scheme, " into %d shards" % numShards
+                                 if scheme == "hash" else ""))
+  format = "%-10s %8s %8s %10s %12s  %s"
+  print(format % ("shard", "minYear", "maxYear", "movies", "size", "built"))
+  print("-"*80)
+  for name, minYear, maxYear, movies, builtAt in db.execute(
+      "SELECT name, minYear, maxYear, numMovies, builtAt FROM Shards ORDER BY name"):
+    path = shardFile(sys.argv[1], name)
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    print(format % (name, minYear, maxYear, movies, size, builtAt))
+  db.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
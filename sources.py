@@ -0,0 +1,136 @@
+"""
+sources.py
+
+Description: Locates the pipe-delimited source file for each table and
+streams its lines.  Inputs may be plain text or compressed with gzip,
+bzip2, xz or zstandard; compressed inputs are decoded on a background
+thread so decompression overlaps with the inserts.
+"""
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+try:
+  import zstandard
+except ImportError:   # only needed for .zst inputs
+  zstandard = None
+
+# File extensions tried, in order, when looking for a table's source file
+EXTENSIONS = [".txt", ".txt.gz", ".txt.bz2", ".txt.xz", ".txt.zst"]
+
+# Bytes of decoded text handed from the decompression thread to the reader
+# at a time, and the number of such blocks that may be waiting in the queue
+BLOCK_SIZE = 1 << 20
+QUEUE_BLOCKS = 8
+
+def findSources(tables, dataDir, overrides=None):
+  """
+  Finds the source file for each table
+  @param tables - the names of the tables
+  @param dataDir - the directory holding Table.txt (or Table.txt.gz, ...)
+  @param overrides - a dict mapping table names to explicit paths, which
+    take precedence over dataDir
+  @return a dict mapping each table name to the path of its source file
+  @raise FileNotFoundError if a table has no source file
+  """
+  overrides = overrides or {}
+  sources = {}
+  for table in tables:
+    if table in overrides:
+      candidates = [overrides[table]]
+    else:
+      candidates = [os.path.join(dataDir, table + ext) for ext in EXTENSIONS]
+    for path in candidates:
+      if os.path.exists(path):
+        sources[table] = path
+        break
+    else:
+      raise FileNotFoundError("no source file for %s (tried %s)"
+                              % (table, ", ".join(candidates)))
+  return sources
+
+def isCompressed(path):
+  """
+  @param path - the path of a source file
+  @return True if the file is decompressed when it is read
+  """
+  return path.endswith((".gz", ".bz2", ".xz", ".zst"))
+
+def openBinary(path):
+  """
+  Opens a source file for reading, decompressing it if its extension says
+  it is compressed
+  @param path - the path of the source file
+  @return a binary file object yielding the uncompressed bytes
+  """
+  if path.endswith(".gz"):
+    return gzip.open(path, "rb")
+  if path.endswith(".bz2"):
+    return bz2.open(path, "rb")
+  if path.endswith(".xz"):
+    return lzma.open(path, "rb")
+  if path.endswith(".zst"):
+    if zstandard is None:
+      raise RuntimeError("reading %s requires the zstandard package" % path)
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+  return open(path, "rb")
+
+def openText(path):
+  """
+  Opens a source file as text, the way the original loader did
+  @param path - the path of the source file
+  @return a text file object
+  """
+  return io.TextIOWrapper(openBinary(path), errors="backslashreplace")
+
+def readLines(path):
+  """
+  Streams the lines of a source file.  Compressed files are decoded on a
+  background thread, which hands blocks of lines to the caller through a
+  bounded queue.
+  @param path - the path of the source file
+  @return a generator of lines
+  """
+  if not isCompressed(path):
+    with openText(path) as f:
+      yield from f
+    return
+
+  blocks = queue.Queue(QUEUE_BLOCKS)
+  stop = threading.Event()
+
+  def decode():
+    try:
+      with openText(path) as f:
+        while not stop.is_set():
+          block = f.readlines(BLOCK_SIZE)
+          blocks.put(block)
+          if not block:
+            return
+    except BaseException as e:
+      blocks.put(e)
+
+  thread = threading.Thread(target=decode, name="decode-" + os.path.basename(path),
+                            daemon=True)
+  thread.start()
+  try:
+    while True:
+      block = blocks.get()
+      if isinstance(block, BaseException):
+        raise block
+      if not block:
+        return
+      yield from block
+  finally:
+    # if the caller stops early, let the thread finish its last put and exit
+    stop.set()
+    while thread.is_alive():
+      try:
+        blocks.get_nowait()
+      except queue.Empty:
+        thread.join(0.01)
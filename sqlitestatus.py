@@ -0,0 +1,57 @@
+"""
+sqlitestatus.py
+
+Description: SQLite's per-statement status counters, read with SQL from
+the sqlite_stmt virtual table (SQLite built with SQLITE_ENABLE_STMTVTAB,
+as the common distributions are).  For each statement prepared on a
+connection it reports the full scan steps, sorts and automatic index rows
+since the statement was prepared.  The sqlite3 module has no way to read
+a connection's page cache counters (sqlite3_db_status), so they are not
+reported.  Where sqlite_stmt is missing the helpers return None and
+callers report the counters as unknown.
+"""
+
+import sqlite3
+
+# The counters of each prepared statement, as named in the reports, and
+# the sqlite_stmt columns holding them
+COUNTERS = [("fullScanSteps", "nscan"), ("sorts", "nsort"), ("autoIndexRows", "naidx")]
+
+STMT_SQL = "SELECT sql, %s FROM sqlite_stmt" % ", ".join(column for name, column in COUNTERS)
+
+def statementCounters(db, sql):
+  """
+  Reads the counters of the prepared statements with the given SQL text,
+  e.g. one kept in the connection's statement cache
+  @param db - the connection or cursor the statement was prepared on
+  @param sql - the SQL text the statement was prepared from
+  @return a dict of its full scan steps, sorts and automatic index rows
+    since it was prepared (added up if it is prepared more than once), {}
+    if it is not prepared, or None if the counters cannot be read
+  """
+  try:
+    rows = db.execute(STMT_SQL).fetchall()
+  except sqlite3.Error:   # no sqlite_stmt, or the connection is interrupted
+    return None
+  counters = {}
+  for prepared, *values in rows:
+    # the statement's text ends at its semicolon, without what follows
+    if sql.startswith(prepared) and not sql[len(prepared):].strip(" \t\n;"):
+      for (name, column), value in zip(COUNTERS, values):
+        counters[name] = counters.get(name, 0) + value
+  return counters
+
+def counterChanges(before, after):
+  """
+  @param before - statementCounters before an execution
+  @param after - statementCounters after it
+  @return a dict of how much each counter grew, or None if either is
+    unknown.  A statement prepared again in between starts from zero.
+  """
+  if before is None or after is None:
+    return None
+  changes = {}
+  for name, column in COUNTERS:
+    old, new = before.get(name, 0), after.get(name, 0)
+    changes[name] = new - old if new >= old else new
+  return changes
@@ -0,0 +1,227 @@
+"""
+summaries.py
+
+Description: Materialized aggregates for the leaderboard queries.  Three
+summary tables hold per-actor film counts, per-director film counts and
+per-(actor, movie) role counts.  buildSummaries fills them from Casts and
+DirectsMovie once, after a load.  Triggers on Casts and DirectsMovie then
+keep them current through later inserts, updates and deletes, including
+createdb.py --update.  Each table has an index on its count, so a query
+like "top 10 actors by film count" is a short index range read.
+
+Usage: python3 summaries.py databaseName
+  (re)builds the summary tables of an existing database
+"""
+
+import os
+import sqlite3
+import sys
+import time
+
+import dictionary
+
+# CREATE TABLE statement for each summary table
+SUMMARY_SQL = {
+  "ActorMovieRoles": """CREATE TABLE ActorMovieRoles (
+    actorID INTEGER,
+    movieID INTEGER,
+    numRoles INTEGER,
+    PRIMARY KEY (actorID, movieID)
+  ) WITHOUT ROWID""",
+
+  "ActorFilmCount": """CREATE TABLE ActorFilmCount (
+    actorID INTEGER PRIMARY KEY,
+    numFilms INTEGER
+  )""",
+
+  "DirectorFilmCount": """CREATE TABLE DirectorFilmCount (
+    directorID INTEGER PRIMARY KEY,
+    numFilms INTEGER
+  )""",
+}
+
+# Statements that fill each summary table from scratch, in dependency order
+FILL_SQL = [
+  """INSERT INTO ActorMovieRoles (actorID, movieID, numRoles)
+     SELECT actorID, movieID, COUNT(*)
+     FROM Casts
+     GROUP BY actorID, movieID""",
+
+  """INSERT INTO ActorFilmCount (actorID, numFilms)
+     SELECT actorID, COUNT(*)
+     FROM ActorMovieRoles
+     GROUP BY actorID""",
+
+  """INSERT INTO DirectorFilmCount (directorID, numFilms)
+     SELECT directorID, COUNT(*)
+     FROM DirectsMovie
+     GROUP BY directorID""",
+]
+
+# The count indexes that turn leaderboard queries into range reads
+SUMMARY_INDEXES = [
+  "CREATE INDEX IF NOT EXISTS idx_actormovieroles_roles ON ActorMovieRoles(numRoles);",
+  "CREATE INDEX IF NOT EXISTS idx_actorfilmcount_films ON ActorFilmCount(numFilms);",
+  "CREATE INDEX IF NOT EXISTS idx_directorfilmcount_films ON DirectorFilmCount(numFilms);",
+]
+
+# Triggers that apply each change to Casts and DirectsMovie to the
+# summaries.  A role added to or removed from Casts adjusts ActorMovieRoles;
+# an (actor, movie) pair appearing in or disappearing from ActorMovieRoles
+# in turn adjusts ActorFilmCount.  Counts that reach zero are deleted.
+# {casts} is the table that holds the Casts rows (see dictionary.baseTable).
+TRIGGERS = [
+  """CREATE TRIGGER IF NOT EXISTS casts_insert_summary AFTER INSERT ON {casts}
+  BEGIN
+    INSERT INTO ActorMovieRoles (actorID, movieID, numRoles)
+    VALUES (NEW.actorID, NEW.movieID, 1)
+    ON CONFLICT (actorID, movieID) DO UPDATE SET numRoles = numRoles + 1;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS casts_delete_summary AFTER DELETE ON {casts}
+  BEGIN
+    UPDATE ActorMovieRoles SET numRoles = numRoles - 1
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID;
+    DELETE FROM ActorMovieRoles
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID AND numRoles <= 0;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS casts_update_summary
+  AFTER UPDATE OF actorID, movieID ON {casts}
+  BEGIN
+    UPDATE ActorMovieRoles SET numRoles = numRoles - 1
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID;
+    DELETE FROM ActorMovieRoles
+    WHERE actorID = OLD.actorID AND movieID = OLD.movieID AND numRoles <= 0;
+    INSERT INTO ActorMovieRoles (actorID, movieID, numRoles)
+    VALUES (NEW.actorID, NEW.movieID, 1)
+    ON CONFLICT (actorID, movieID) DO UPDATE SET numRoles = numRoles + 1;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS actormovieroles_insert_summary
+  AFTER INSERT ON ActorMovieRoles
+  BEGIN
+    INSERT INTO ActorFilmCount (actorID, numFilms)
+    VALUES (NEW.actorID, 1)
+    ON CONFLICT (actorID) DO UPDATE SET numFilms = numFilms + 1;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS actormovieroles_delete_summary
+  AFTER DELETE ON ActorMovieRoles
+  BEGIN
+    UPDATE ActorFilmCount SET numFilms = numFilms - 1
+    WHERE actorID = OLD.actorID;
+    DELETE FROM ActorFilmCount
+    WHERE actorID = OLD.actorID AND numFilms <= 0;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS directsmovie_insert_summary
+  AFTER INSERT ON DirectsMovie
+  BEGIN
+    INSERT INTO DirectorFilmCount (directorID, numFilms)
+    VALUES (NEW.directorID, 1)
+    ON CONFLICT (directorID) DO UPDATE SET numFilms = numFilms + 1;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS directsmovie_delete_summary
+  AFTER DELETE ON DirectsMovie
+  BEGIN
+    UPDATE DirectorFilmCount SET numFilms = numFilms - 1
+    WHERE directorID = OLD.directorID;
+    DELETE FROM DirectorFilmCount
+    WHERE directorID = OLD.directorID AND numFilms <= 0;
+  END""",
+
+  """CREATE TRIGGER IF NOT EXISTS directsmovie_update_summary
+  AFTER UPDATE OF directorID ON DirectsMovie
+  BEGIN
+    UPDATE DirectorFilmCount SET numFilms = numFilms - 1
+    WHERE directorID = OLD.directorID;
+    DELETE FROM DirectorFilmCount
+    WHERE directorID = OLD.directorID AND numFilms <= 0;
+    INSERT INTO DirectorFilmCount (directorID, numFilms)
+    VALUES (NEW.directorID, 1)
+    ON CONFLICT (directorID) DO UPDATE SET numFilms = numFilms + 1;
+  END""",
+]
+
+def hasSummaries(db):
+  """
+  @param db - the database connection or cursor
+  @return True if every summary table has been built
+  """
+  names = [row[0] for row in db.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table'")]
+  return all(table in names for table in SUMMARY_SQL)
+
+def dropSummaries(db):
+  """
+  Removes the summary tables, along with their indexes and the triggers
+  that maintain them
+  @param db - the database connection or cursor
+  """
+  triggers = [row[0] for row in db.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+      "AND name LIKE '%\\_summary' ESCAPE '\\'")]
+  for trigger in triggers:
+    db.execute("DROP TRIGGER " + trigger)
+  for table in SUMMARY_SQL:
+    db.execute("DROP TABLE IF EXISTS " + table)
+
+def buildSummaries(db):
+  """
+  Builds (or rebuilds) the summary tables from Casts and DirectsMovie and
+  installs the triggers that keep them current.  The triggers are created
+  after the tables are filled, so the bulk load does not fire them.
+  @param db - the database connection
+  """
+  dropSummaries(db)
+  for table in SUMMARY_SQL:
+    db.execute(SUMMARY_SQL[table])
+  for sql in FILL_SQL:
+    db.execute(sql)
+  for sql in SUMMARY_INDEXES:
+    db.execute(sql)
+  casts = dictionary.baseTable(db, "Casts")
+  for sql in TRIGGERS:
+    db.execute(sql.format(casts=casts))
+  db.commit()
+
+def ensureSummaries(db):
+  """
+  Builds the summary tables if the database does not have them yet, and
+  recreates any of their indexes that were dropped
+  @param db - the database connection
+  """
+  if not hasSummaries(db):
+    print("...Building Summaries...")
+    start = time.time()
+    buildSummaries(db)
+    print("  built in %.2f seconds" % (time.time() - start))
+    return
+  for sql in SUMMARY_INDEXES:
+    db.execute(sql)
+  db.commit()
+
+############### main program ###########################
+def main():
+
+  if len(sys.argv) != 2:
+    print("Error: Incorrect arguments")
+    print("Usage: python3 summaries.py databaseName")
+    return 1
+
+  if not os.path.exists(sys.argv[1]):
+    print("Error: file does not exist")
+    return 1
+
+  db = sqlite3.connect(sys.argv[1])
+  print("...Building Summaries...")
+  start = time.time()
+  buildSummaries(db)
+  print("  built in %.2f seconds" % (time.time() - start))
+  db.close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+test_queries.py
+
+Description: Checks that every variant of the registry's queries answers
+the way its plain SQL does.  A small database is generated with
+gendata.py and built four times with createdb.py: plain, with the derived
+tables (summaries, filmography snapshot, co-star graph), and partitioned
+by hash and by decade.  Each query is run with several parameters on the
+plain database and compared with the derived-table SQL and with the
+shard and merge SQL.  The data is changed so the variants meet the cases
+they treat differently: a second Kevin Bacon who plays in Tom Hanks's
+movies, and two directors with 500 or more films.
+
+Usage: python3 -m unittest test_queries
+"""
+
+import contextlib
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import gendata
+import queryDB
+import queryregistry
+import shards
+
+# Casts rows generated, and the skew that gives queries 5-7 results at
+# that size
+CASTS = 20000
+SKEW = 0.2
+
+# The actors the data is changed around (see gendata.NAMED_ACTORS)
+BACON, HANKS = 3, 5
+
+# The parameters each query is run with
+PARAMS = {
+  1: [("The Princess Bride",), ("The Mexican",), ("No Such Movie",)],
+  2: [("Kevin", "Bacon"), ("Tom", "Hanks"), ("No", "Body")],
+  3: [("Kevin", "Bacon", "Tom", "Hanks"), ("Tom", "Hanks", "Kevin", "Bacon"),
+      ("Tom", "Hanks", "No", "Body")],
+  4: [()],
+  5: [("Kevin", "Bacon"), ("Tom", "Hanks"), ("No", "Body")],
+  6: [(2010,), (2014,), (1800,)],
+  7: [()],
+}
+
+def readLines(dataDir, table):
+  """
+  @return the lines of a generated source file, split on "|"
+  """
+  with open(os.path.join(dataDir, table + ".txt"), encoding="utf-8") as f:
+    return [line.rstrip("\n").split("|") for line in f if line.strip()]
+
+def appendLines(dataDir, table, rows):
+  """
+  Adds rows to the end of a generated source file
+  """
+  with open(os.path.join(dataDir, table + ".txt"), "a", encoding="utf-8") as f:
+    for row in rows:
+      f.write("|".join(str(field) for field in row) + "\n")
+
+def generateData(dataDir):
+  """
+  Generates the source files, then adds a namesake of Kevin Bacon cast in
+  every movie of Tom Hanks and in every other movie of Kevin Bacon, and
+  makes director 1 direct every movie and director 2 the first 600
+  """
+  counts = gendata.generate(dataDir, CASTS, skew=SKEW)
+  namesake = counts["Actor"] + 1
+  appendLines(dataDir, "Actor", [(namesake, "Kevin", "Bacon", "M")])
+  movies = {}
+  for actorID, movieID, role in readLines(dataDir, "Casts"):
+    movies.setdefault(int(actorID), set()).add(int(movieID))
+  cast = movies[HANKS] | set(sorted(movies[BACON])[::2])
+  appendLines(dataDir, "Casts", [(namesake, m, "Himself") for m in sorted(cast)])
+  directs = {(int(d), int(m)) for d, m in readLines(dataDir, "DirectsMovie")}
+  extra = [(1, m) for m in range(1, counts["Movie"] + 1)]
+  extra += [(2, m) for m in range(1, 601)]
+  appendLines(dataDir, "DirectsMovie", [pair for pair in extra if pair not in directs])
+
+def createDB(filename, dataDir, *options):
+  """
+  Builds a database with createdb.py
+  """
+  subprocess.run([sys.executable, "createdb.py", filename, "--data-dir", dataDir]
+                 + list(options), cwd=os.path.dirname(os.path.abspath(__file__)),
+                 stdout=subprocess.DEVNULL, check=True)
+
+class QueryVariantsTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.TemporaryDirectory(prefix="moviedb-test-")
+    dataDir = os.path.join(cls.tmp.name, "data")
+    generateData(dataDir)
+    cls.files = {}
+    for name, options in [("plain", ()),
+                          ("derived", ("--summaries", "--filmography", "--costar")),
+                          ("hash", ("--shard-by", "hash", "--shards", "3")),
+                          ("decade", ("--shard-by", "decade"))]:
+      cls.files[name] = os.path.join(cls.tmp.name, name + ".db")
+      createDB(cls.files[name], dataDir, *options)
+    cls.plain = sqlite3.connect(cls.files["plain"])
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.plain.close()
+    cls.tmp.cleanup()
+
+  def expected(self, query, params):
+    """
+    @return the rows of the query's plain SQL on the plain database, sorted
+      so rows tied in the ORDER BY compare equal
+    """
+    return sorted(self.plain.execute(query.sql, params).fetchall())
+
+  def testDataHasMatches(self):
+    for number in PARAMS:
+      query = queryregistry.BY_NUMBER[number]
+      self.assertTrue(self.expected(query, PARAMS[number][0]),
+                      "%s has no rows to compare" % query.key)
+    namesakes = self.plain.execute("SELECT COUNT(*) FROM Actor WHERE fname = 'Kevin' "
+                                   "AND lname = 'Bacon'").fetchone()[0]
+    self.assertEqual(namesakes, 2)
+
+  def testDerivedTables(self):
+    with contextlib.closing(sqlite3.connect(self.files["derived"],
+        factory=queryregistry.Connection)) as db:
+      for number, paramSets in PARAMS.items():
+        query = queryregistry.BY_NUMBER[number]
+        sql = queryregistry.statements(db)[number]
+        if query.derived is None:
+          self.assertEqual(sql, query.sql)
+          continue
+        self.assertEqual(sql, query.derived[1], "%s does not read its derived "
+                         "tables" % query.key)
+        for params in paramSets:
+          with self.subTest(query=query.key, params=params):
+            self.assertEqual(sorted(db.execute(sql, params).fetchall()),
+                             self.expected(query, params))
+
+  def testShards(self):
+    for layout in ("hash", "decade"):
+      router = shards.ShardRouter(self.files[layout])
+      try:
+        with contextlib.closing(sqlite3.connect(self.files[layout])) as db:
+          for number, paramSets in PARAMS.items():
+            query = queryregistry.BY_NUMBER[number]
+            for params in paramSets:
+              with self.subTest(layout=layout, query=query.key, params=params):
+                columns, rows, names = queryDB.routeQuery(router, query, params, db)
+                self.assertEqual(sorted(rows), self.expected(query, params))
+      finally:
+        router.close()
+
+if __name__ == "__main__":
+  unittest.main()